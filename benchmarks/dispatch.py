@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Measures route dispatch cost, linear regex scan vs whirly.routing
+
+    python benchmarks/dispatch.py [number of lookups]
+
+"""
+
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from tornado.web import RequestHandler, URLSpec
+
+from whirly.routing import RouteIndex
+
+
+ROUTE_COUNTS = (10, 100, 10000)
+
+
+def make_specs(count):
+    """A mix of literal and parameterized routes, like a real urls module
+    """
+    specs = []
+    for i in xrange(count):
+        kind = i % 4
+        if kind == 0:
+            pattern = r'/page%d' % i
+        elif kind == 1:
+            pattern = r'/users%d/(\d+)' % i
+        elif kind == 2:
+            pattern = r'/blog/%d/(?P<slug>[^/]+)' % i
+        else:
+            pattern = r'/api/v%d/items/([a-z]+)/(\d+)' % i
+        specs.append(URLSpec(pattern, RequestHandler))
+    return specs
+
+
+def make_paths(count):
+    paths = []
+    for i in xrange(count):
+        kind = i % 4
+        if kind == 0:
+            paths.append('/page%d' % i)
+        elif kind == 1:
+            paths.append('/users%d/42' % i)
+        elif kind == 2:
+            paths.append('/blog/%d/hello-world' % i)
+        else:
+            paths.append('/api/v%d/items/book/7' % i)
+    paths.append('/not/found')
+    return paths
+
+
+def linear_match(specs, path):
+    for spec in specs:
+        match = spec.regex.match(path)
+        if match:
+            return spec, match
+    return None, None
+
+
+def bench(count, lookups):
+    specs = make_specs(count)
+    index = RouteIndex(specs)
+    paths = make_paths(count)
+    sample = [random.choice(paths) for _ in xrange(lookups)]
+
+    for path in paths:
+        assert linear_match(specs, path)[0] is index.match(path)[0], path
+
+    def run_linear():
+        for path in sample:
+            linear_match(specs, path)
+
+    def run_index():
+        for path in sample:
+            index.match(path)
+
+    linear = min(timeit.repeat(run_linear, number=1, repeat=3))
+    indexed = min(timeit.repeat(run_index, number=1, repeat=3))
+    print('%6d routes: linear %8.2fus/req  indexed %6.2fus/req  (%.1fx)' % (
+        count, linear * 1e6 / lookups, indexed * 1e6 / lookups,
+        linear / indexed))
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    random.seed(0)
+    for count in ROUTE_COUNTS:
+        bench(count, lookups)
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -38,6 +38,9 @@ setup(
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
-    packages=['whirly']
+    packages=['whirly'],
+    entry_points={
+        'console_scripts': ['whirly = whirly.management:main'],
+    },
 )
 
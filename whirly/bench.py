@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""In-process benchmark of the request pipeline
+
+Synthetic requests are pushed straight through Application.__call__ on
+fake connections, no socket is opened, so the numbers are whirly's own
+cost: routing, extensions, the handler, transforms and caches.
+
+    whirly bench <project>.settings [-n 1000] [-H 'Name: value'] / /about
+
+or from python:
+
+    bench = Benchmark(application)
+    report = bench.run(['/', '/about'], requests=1000)
+    print report.format()
+
+Every path is requested `requests` times after a warmup. The report gives
+the throughput and the p50/p99 latency by route, the mean time spent in
+every extension, and the memory behaviour per request of every route: the
+objects left alive, the objects only the cyclic collector could free, and
+the memory blocks left allocated where sys.getallocatedblocks exists.
+"""
+
+
+__all__ = ['Benchmark', 'BenchReport', 'FakeConnection', 'benchmark']
+
+
+import gc
+import cgi
+import sys
+import time
+import logging
+import optparse
+import functools
+
+from tornado import httputil
+from tornado import ioloop
+from tornado.httpserver import HTTPRequest
+
+from whirly.httpserver import FakeConnection
+
+
+# seconds an asynchronous request may take before it is given up
+ASYNC_TIMEOUT = 10
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class RouteStats(object):
+    def __init__(self, route):
+        self.route = route
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+        # per request, from the profiled pass
+        self.memory = None
+
+    def add(self, seconds, status, bytes_written):
+        self.latencies.append(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += bytes_written
+
+    def summary(self):
+        ordered = sorted(self.latencies)
+        total = sum(ordered)
+        return dict(route=self.route, requests=len(ordered),
+                    throughput=total and len(ordered) / total or 0.0,
+                    p50=_percentile(ordered, 0.5),
+                    p99=_percentile(ordered, 0.99),
+                    statuses=self.statuses,
+                    bytes=ordered and self.bytes / len(ordered) or 0,
+                    memory=self.memory)
+
+
+class _SpanCollector(object):
+    """Exporter of whirly.tracing summing the spans of every trace by name
+    """
+    def __init__(self):
+        # name -> [calls, seconds]
+        self.spans = {}
+        self.traces = 0
+
+    def export(self, trace):
+        self.traces += 1
+        for span in trace.spans:
+            entry = self.spans.get(span.name)
+            if entry is None:
+                entry = self.spans[span.name] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += span.duration
+
+
+class _Memory(object):
+    """Memory behaviour of the requests of a route, per request
+    """
+    def __init__(self):
+        self.requests = 0
+        self.retained = 0
+        self.cyclic = 0
+        # None without sys.getallocatedblocks, before python 3.4
+        self.blocks = None
+
+    def add(self, requests, retained, cyclic, blocks):
+        self.requests += requests
+        self.retained += retained
+        self.cyclic += cyclic
+        if blocks is not None:
+            self.blocks = (self.blocks or 0) + blocks
+
+    def per_request(self, value):
+        if value is None:
+            return None
+        return float(value) / max(self.requests, 1)
+
+
+class BenchReport(object):
+    def __init__(self, routes, elapsed, requests, spans, traces):
+        self.routes = routes
+        self.elapsed = elapsed
+        self.requests = requests
+        self.spans = spans
+        self.traces = traces
+
+    @property
+    def throughput(self):
+        return self.elapsed and self.requests / self.elapsed or 0.0
+
+    def route_summaries(self):
+        return [stats.summary() for route, stats
+                in sorted(self.routes.iteritems())]
+
+    def extension_summaries(self):
+        """(span name, calls per request, mean milliseconds per call)
+        """
+        rows = []
+        for name, (calls, seconds) in sorted(self.spans.iteritems()):
+            rows.append((name, float(calls) / max(self.traces, 1),
+                         seconds / calls * 1000))
+        return rows
+
+    def format(self):
+        lines = []
+        lines.append("%d requests in %.2fs, %.0f req/s" % (
+            self.requests, self.elapsed, self.throughput))
+        lines.append("")
+        lines.append("%-40s %8s %9s %9s %9s  %s" % (
+            "route", "requests", "req/s", "p50 ms", "p99 ms", "statuses"))
+        summaries = self.route_summaries()
+        for s in summaries:
+            statuses = ' '.join('%s:%d' % item
+                                for item in sorted(s['statuses'].items()))
+            lines.append("%-40s %8d %9.0f %9.3f %9.3f  %s" % (
+                s['route'][:40], s['requests'], s['throughput'],
+                s['p50'] * 1000, s['p99'] * 1000, statuses))
+        if [s for s in summaries if s['memory'] is not None]:
+            lines.append("")
+            lines.append("%-40s %9s %9s %9s" % (
+                "per request", "retained", "cyclic", "blocks"))
+            for s in summaries:
+                memory = s['memory']
+                if memory is None:
+                    continue
+                blocks = memory.per_request(memory.blocks)
+                lines.append("%-40s %9.2f %9.2f %9s" % (
+                    s['route'][:40], memory.per_request(memory.retained),
+                    memory.per_request(memory.cyclic),
+                    blocks is None and "n/a" or "%.1f" % blocks))
+        if self.spans:
+            lines.append("")
+            lines.append("%-40s %9s %9s" % ("span", "per req", "mean ms"))
+            for name, per_request, mean in self.extension_summaries():
+                lines.append("%-40s %9.2f %9.3f" % (name[:40], per_request,
+                                                    mean))
+        return '\n'.join(lines)
+
+
+class Benchmark(object):
+    def __init__(self, application, headers=None, remote_ip='127.0.0.1'):
+        self.application = application
+        self.headers = headers or {}
+        self.remote_ip = remote_ip
+        self.io_loop = ioloop.IOLoop.instance()
+
+    def request(self, method, uri, headers=None, body=None):
+        """Runs one request, returns (seconds, request, handler, connection)
+        """
+        all_headers = httputil.HTTPHeaders()
+        all_headers['Host'] = 'localhost'
+        all_headers.update(self.headers)
+        if headers:
+            all_headers.update(headers)
+        connection = FakeConnection()
+        request = HTTPRequest(method, uri, version="HTTP/1.1",
+                              headers=all_headers, body=body or "",
+                              remote_ip=self.remote_ip,
+                              connection=connection)
+        if body and all_headers.get("Content-Type", "").startswith(
+                "application/x-www-form-urlencoded"):
+            # done by HTTPConnection once the body is read
+            for name, values in cgi.parse_qs(body).iteritems():
+                request.arguments.setdefault(name, []).extend(values)
+        start = time.time()
+        handler = self.application(request)
+        if not connection.finished:
+            self._wait(connection)
+        return time.time() - start, request, handler, connection
+
+    def _wait(self, connection):
+        # finished later by the IOLoop, an asynchronous handler or extension
+        io_loop = self.io_loop
+        connection.on_finish = io_loop.stop
+        timeout = io_loop.add_timeout(time.time() + ASYNC_TIMEOUT,
+                                      io_loop.stop)
+        io_loop.start()
+        io_loop.remove_timeout(timeout)
+        if not connection.finished:
+            logging.warning("A request did not finish in %ss" % ASYNC_TIMEOUT)
+
+    def run(self, paths, requests=1000, warmup=100, method="GET",
+            headers=None, body=None, profile=True):
+        """Requests every path `requests` times, returns a BenchReport
+
+        With profile a second, shorter pass measures the memory of every
+        route, and a third one is traced to break the time down by
+        extension.
+        """
+        application = self.application
+        saved_log = application.settings.get('log_function')
+        # logging every request would be most of what is measured
+        application.settings['log_function'] = lambda handler: None
+        try:
+            request = functools.partial(self.request, method,
+                                        headers=headers, body=body)
+            for path in paths:
+                for i in xrange(warmup):
+                    request(path)
+            routes = {}
+            started = time.time()
+            for path in paths:
+                for i in xrange(requests):
+                    seconds, req, handler, connection = request(path)
+                    route = getattr(req, 'route_pattern', '<unmatched>')
+                    stats = routes.get(route)
+                    if stats is None:
+                        stats = routes[route] = RouteStats(route)
+                    stats.add(seconds, handler.get_status(),
+                              connection.bytes_written)
+            elapsed = time.time() - started
+            spans, traces = {}, 0
+            if profile:
+                spans, traces = self._profile(
+                    paths, max(requests / 10, 1), request, routes)
+        finally:
+            if saved_log is None:
+                del application.settings['log_function']
+            else:
+                application.settings['log_function'] = saved_log
+        return BenchReport(routes, elapsed, len(paths) * requests, spans,
+                           traces)
+
+    def _measure(self, path, requests, request):
+        """(route, retained objects, cyclic garbage, memory blocks) of
+        requests to path
+        """
+        allocated_blocks = getattr(sys, 'getallocatedblocks', None)
+        enabled = gc.isenabled()
+        gc.collect()
+        # the garbage of the requests is left for the collection below
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            blocks = allocated_blocks and allocated_blocks()
+            for i in xrange(requests):
+                req = request(path)[1]
+            cyclic = gc.collect()
+            retained = len(gc.get_objects()) - before
+            if allocated_blocks is not None:
+                blocks = allocated_blocks() - blocks
+        finally:
+            if enabled:
+                gc.enable()
+        return (getattr(req, 'route_pattern', '<unmatched>'), retained,
+                cyclic, blocks)
+
+    def _profile(self, paths, requests, request, routes):
+        application = self.application
+
+        for path in paths:
+            route, retained, cyclic, blocks = self._measure(path, requests,
+                                                            request)
+            stats = routes.get(route)
+            if stats is None:
+                stats = routes[route] = RouteStats(route)
+            if stats.memory is None:
+                stats.memory = _Memory()
+            stats.memory.add(requests, retained, cyclic, blocks)
+
+        # every request traced, its spans summed by name
+        from whirly import tracing
+        collector = _SpanCollector()
+        saved_tracer = application.tracer
+        application.tracer = tracing.Tracer(1.0, collector)
+        try:
+            for path in paths:
+                for i in xrange(requests):
+                    request(path)
+        finally:
+            application.tracer = saved_tracer
+        return collector.spans, collector.traces
+
+
+def benchmark(settings_module, args):
+    """The bench command of whirly.management
+    """
+    from whirly import management
+
+    parser = optparse.OptionParser(
+        usage="whirly bench <project>.settings [options] [path ...]")
+    parser.add_option("-n", "--requests", type="int", default=1000,
+                      help="requests per path")
+    parser.add_option("-w", "--warmup", type="int", default=100,
+                      help="requests per path before measuring")
+    parser.add_option("-m", "--method", default="GET")
+    parser.add_option("-H", "--header", action="append", default=[],
+                      help="'Name: value', may be repeated")
+    parser.add_option("-d", "--data", default=None, help="request body")
+    parser.add_option("--no-profile", action="store_false", dest="profile",
+                      default=True, help="skip the traced pass")
+    opts, paths = parser.parse_args(args)
+
+    handlers, extensions, settings = management._application_args(
+        settings_module)
+    # imported once the project environment is set
+    from whirly.web import Application
+
+    # the numbers are meaningless with the debug reloading and checks
+    settings['debug'] = False
+    application = Application(handlers=handlers, extensions=extensions,
+                              **settings)
+    headers = {}
+    for header in opts.header:
+        name, _, value = header.partition(':')
+        headers[name.strip()] = value.strip()
+    report = Benchmark(application).run(
+        paths or ['/'], opts.requests, opts.warmup, opts.method.upper(),
+        headers, opts.data, opts.profile)
+    print report.format()
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
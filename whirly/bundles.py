@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Static file bundles
+
+A bundle is one css or js file made of several files of static_path, they
+are declared in the settings:
+
+    application = {
+        'static_bundles': {
+            'bundles/site.css': ['css/reset.css', 'css/site.css'],
+            'bundles/site.js': ['js/jquery.js', 'js/site.js'],
+        },
+    }
+
+`whirly build_static` concatenates and minifies the sources into the
+bundle, before fingerprinting the static files. Templates call
+static_bundle('bundles/site.css'), which gives the tag of the bundle, or
+one tag per source file in debug mode so the sources are served as they
+are edited.
+
+The javascript is minified by rjsmin or jsmin when one is installed,
+otherwise it is only concatenated: stripping lines would change the
+strings spanning several lines.
+
+Application settings:
+
+    static_bundles      {bundle name: [source names]}, relative to
+                        static_path
+"""
+
+
+__all__ = ['build_bundles', 'bundle_tags', 'minify_css', 'minify_js']
+
+
+import os
+import re
+import logging
+
+from tornado.escape import xhtml_escape
+
+
+TAGS = {
+    '.css': '<link rel="stylesheet" type="text/css" href="%s"/>',
+    '.js': '<script type="text/javascript" src="%s"></script>',
+}
+
+# strings are kept as they are, comments are dropped unless /*! */
+_CSS_TOKEN_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|'
+                           r'(/\*.*?\*/)', re.S)
+_CSS_SPACE_RE = re.compile(r'\s+')
+_CSS_PUNCTUATION_RE = re.compile(r' ?([{};,>]) ?')
+
+
+def minify_css(text):
+    parts = []
+    code = []
+    position = 0
+    for match in _CSS_TOKEN_RE.finditer(text):
+        code.append(text[position:match.start()])
+        position = match.end()
+        string, comment = match.groups()
+        if comment is not None and not comment.startswith('/*!'):
+            # a comment may be all that separates two words
+            code.append(' ')
+            continue
+        parts.append(_minify_css_code(''.join(code)))
+        parts.append(match.group())
+        code = []
+    code.append(text[position:])
+    parts.append(_minify_css_code(''.join(code)))
+    return ''.join(parts).strip()
+
+
+def _minify_css_code(code):
+    code = _CSS_SPACE_RE.sub(' ', code)
+    return _CSS_PUNCTUATION_RE.sub(r'\1', code).replace(';}', '}')
+
+
+def _load_jsmin():
+    try:
+        import rjsmin
+        return rjsmin.jsmin
+    except ImportError:
+        pass
+    try:
+        import jsmin
+        return jsmin.jsmin
+    except ImportError:
+        return None
+
+_jsmin = _load_jsmin()
+
+
+def minify_js(text):
+    """text minified, or as it is without rjsmin and jsmin
+    """
+    if _jsmin is None:
+        return text.strip()
+    return _jsmin(text).strip()
+
+
+MINIFIERS = {
+    '.css': (minify_css, '\n'),
+    # a source missing its last semicolon must not run into the next one
+    '.js': (minify_js, ';\n'),
+}
+
+
+def build_bundles(root, bundles):
+    """Writes every bundle under root, returns their names
+    """
+    written = []
+    for name, sources in sorted(bundles.iteritems()):
+        ext = os.path.splitext(name)[1]
+        if ext not in MINIFIERS:
+            raise ValueError("Bundle %s is neither css nor js" % name)
+        minify, separator = MINIFIERS[ext]
+        if ext == '.js' and _jsmin is None:
+            logging.warning("Bundle %s is not minified, install rjsmin or "
+                            "jsmin" % name)
+        parts = []
+        for source in sources:
+            f = open(os.path.join(root, source), 'rb')
+            try:
+                parts.append(minify(f.read()))
+            finally:
+                f.close()
+        path = os.path.join(root, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(path, 'wb')
+        try:
+            f.write(separator.join(parts) + '\n')
+        finally:
+            f.close()
+        logging.info("Bundle %s: %d files" % (name, len(sources)))
+        written.append(name)
+    return written
+
+
+def bundle_tags(handler, name):
+    """The html tags loading bundle name, one per source in debug mode
+    """
+    sources = handler.settings.get('static_bundles', {}).get(name)
+    if sources is None:
+        raise KeyError("No static bundle named %s" % name)
+    if not handler.settings.get('debug'):
+        sources = [name]
+    tag = TAGS[os.path.splitext(name)[1]]
+    return '\n'.join(tag % xhtml_escape(handler.static_url(source))
+                     for source in sources)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Response compression
+
+Replaces tornado's GZipContentEncoding when the compress or gzip setting is
+on. The encoding is negotiated from Accept-Encoding, gzip is preferred to
+deflate at the same quality. Responses smaller than compress_min_size, of
+another content type, or already encoded are sent as they are.
+
+The page cache and the cache decorator store the compressed bytes with
+the encoding in their key, a hit is written without compressing again.
+
+Application settings:
+
+    compress            True to compress the responses, tornado's gzip
+                        setting turns it on too
+    compress_level      zlib level from 1 to 9, 6 default
+    compress_min_size   smaller bodies are not compressed, 256 bytes default
+    compress_types      content types which are compressed, text, css,
+                        javascript, json and xml by default
+"""
+
+
+__all__ = ['Compressor', 'ContentEncoding', 'CONTENT_TYPES', 'add_vary']
+
+
+import zlib
+
+from tornado.web import OutputTransform
+
+
+CONTENT_TYPES = frozenset([
+    "text/plain", "text/html", "text/css", "text/xml", "text/javascript",
+    "application/javascript", "application/x-javascript", "application/json",
+    "application/xml", "application/atom+xml", "application/rss+xml",
+    "application/xhtml+xml", "image/svg+xml"])
+
+# in order of preference, with the window bits of their zlib stream
+ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+_WBITS = dict(ENCODINGS)
+
+
+def _accepted(header):
+    """{coding: quality} of an Accept-Encoding header
+    """
+    accepted = {}
+    for item in header.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+class Compressor(object):
+    def __init__(self, level=6, min_size=256, content_types=CONTENT_TYPES):
+        self.level = level
+        self.min_size = min_size
+        self.content_types = frozenset(content_types)
+        # Accept-Encoding -> encoding, browsers send a handful of values
+        self._negotiated = {}
+
+    def negotiate(self, request):
+        """The encoding of the responses to request, '' for none
+        """
+        # like tornado, a streamed HTTP/1.0 response could not be delimited
+        if not request.supports_http_1_1():
+            return ''
+        header = request.headers.get("Accept-Encoding", "")
+        try:
+            return self._negotiated[header]
+        except KeyError:
+            pass
+        accepted = _accepted(header)
+        encoding, best = '', 0.0
+        for name, wbits in ENCODINGS:
+            quality = accepted.get(name, accepted.get('*', 0.0))
+            if quality > best:
+                encoding, best = name, quality
+        if len(self._negotiated) < 256:
+            self._negotiated[header] = encoding
+        return encoding
+
+    def compressible(self, headers, size=None):
+        """Whether a response with headers and a body of size bytes is
+        compressed, size is None when the body is streamed
+        """
+        if "Content-Encoding" in headers or "Content-Range" in headers:
+            return False
+        if "Accept-Ranges" in headers:
+            # ranges are of the identity body, whirly.static serves the
+            # precompressed variants itself
+            return False
+        if size is not None and size < self.min_size:
+            return False
+        content_type = headers.get("Content-Type", "").split(";")[0]
+        return content_type.strip().lower() in self.content_types
+
+    def compressobj(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+
+    def encode(self, headers, body, encoding):
+        """Compresses a whole body with encoding when the response is
+        compressible, returns the body and the encoding applied
+        """
+        if not encoding or not self.compressible(headers, len(body)):
+            return body, ''
+        compressor = self.compressobj(encoding)
+        body = compressor.compress(body) + compressor.flush()
+        headers["Content-Encoding"] = encoding
+        add_vary(headers)
+        if "Content-Length" in headers:
+            headers["Content-Length"] = str(len(body))
+        return body, encoding
+
+    def transform(self, request):
+        """Used as a transform class, see Application.transforms
+        """
+        return ContentEncoding(self, request)
+
+
+class ContentEncoding(OutputTransform):
+    """Compresses the response with the encoding negotiated by compressor
+    """
+    def __init__(self, compressor, request):
+        self._compressor = compressor
+        self._encoding = compressor.negotiate(request)
+        self._zlib = None
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        size = None
+        if finishing:
+            size = len(chunk)
+        elif "Content-Length" in headers:
+            # the length was promised, it can't change any more
+            return headers, chunk
+        compressor = self._compressor
+        if not compressor.compressible(headers, size):
+            return headers, chunk
+        # a shared cache must keep the variants apart
+        add_vary(headers)
+        if not self._encoding:
+            return headers, chunk
+        headers["Content-Encoding"] = self._encoding
+        self._zlib = compressor.compressobj(self._encoding)
+        chunk = self.transform_chunk(chunk, finishing)
+        if "Content-Length" in headers:
+            headers["Content-Length"] = str(len(chunk))
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._zlib is None:
+            return chunk
+        if finishing:
+            chunk = self._zlib.compress(chunk) + self._zlib.flush()
+            self._zlib = None
+            return chunk
+        return self._zlib.compress(chunk) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+
+def add_vary(headers, name="Accept-Encoding"):
+    vary = headers.get("Vary")
+    if not vary:
+        headers["Vary"] = name
+    elif name.lower() not in vary.lower():
+        headers["Vary"] = vary + ", " + name
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Futures for asynchronous extensions
+
+An extension hook may return a Future instead of the handler, the
+application carries on with the rest of the request once it resolves.
+The storage drivers whirly supports are blocking, ThreadPool runs their
+calls outside the IOLoop thread and resolves the futures back on the
+IOLoop, so callbacks never need locking. ProcessPool does the same for CPU
+bound work. Under WSGI no IOLoop runs, the pools are created inline and
+resolve the futures in their own threads.
+
+The application keeps the pools, see Application.get_executor():
+
+    executors       {name: threads} or {name: {'threads': n,
+                    'max_queue': n}}, pools not listed get 10 threads
+    process_pool    size of the process pool, defaults to the core count
+"""
+
+
+__all__ = ['Future', 'is_future', 'resolved', 'chain', 'ThreadPool',
+           'ProcessPool', 'PoolFullError']
+
+
+import sys
+import time
+import Queue
+import cPickle as pickle
+import logging
+import threading
+import functools
+import traceback
+
+
+class Future(object):
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """The result, or raises the exception the future failed with
+        """
+        if not self._done:
+            raise RuntimeError("Future is not done yet")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once it is done, right away if it is
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _set_done(self):
+        if self._done:
+            raise RuntimeError("Future is already done")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def is_future(value):
+    return isinstance(value, Future)
+
+
+def resolved(value):
+    """A Future already done with value
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _copy(source, target):
+    if source._exc_info is not None:
+        target.set_exc_info(source._exc_info)
+    else:
+        target.set_result(source._result)
+
+
+def chain(future, fn):
+    """Future of fn(result of future)
+
+    fn may return a Future itself, the exception of a failed future is
+    passed on without calling fn.
+    """
+    chained = Future()
+
+    def on_done(future):
+        try:
+            value = fn(future.result())
+        except Exception:
+            chained.set_exc_info(sys.exc_info())
+            return
+        if is_future(value):
+            value.add_done_callback(lambda inner: _copy(inner, chained))
+        else:
+            chained.set_result(value)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+class PoolFullError(Exception):
+    """Raised by submit() when the queue of a pool is full
+    """
+
+
+class ThreadPool(object):
+    """Runs blocking calls in up to max_workers threads
+
+    Create it in the process and thread running io_loop, the futures
+    returned by submit() are resolved there, or in the worker threads when
+    inline. At most max_queue calls wait for a thread, 0 means no limit.
+    on_wait(seconds) is called where the future is resolved with the time
+    every call waited in the queue.
+    """
+    def __init__(self, max_workers=10, io_loop=None, name='default',
+                 max_queue=0, on_wait=None, inline=False):
+        if io_loop is None and not inline:
+            import tornado.ioloop
+            io_loop = tornado.ioloop.IOLoop.instance()
+        self.name = name
+        self.max_workers = max_workers
+        self.io_loop = io_loop
+        self.on_wait = on_wait
+        self.rejected = 0
+        self._queue = Queue.Queue(max_queue)
+        self._threads = []
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def workers(self):
+        return len(self._threads)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            self._queue.put_nowait((future, fn, args, kwargs, time.time()))
+        except Queue.Full:
+            self.rejected += 1
+            raise PoolFullError("%s pool queue is full" % self.name)
+        if len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._work,
+                                      name='whirly-%s-%d' %
+                                      (self.name, len(self._threads)))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return future
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs, submitted = item
+            waited = time.time() - submitted
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                callback = functools.partial(self._done, future, waited,
+                                             None, sys.exc_info())
+            else:
+                callback = functools.partial(self._done, future, waited,
+                                             result, None)
+            if self.io_loop is None:
+                # no IOLoop runs, under WSGI
+                callback()
+            else:
+                # add_callback is the one IOLoop method safe from other
+                # threads
+                self.io_loop.add_callback(callback)
+            # do not keep the last request alive until the next job
+            item = future = fn = args = kwargs = result = callback = None
+
+    def _done(self, future, waited, result, exc_info):
+        if self.on_wait is not None:
+            self.on_wait(waited)
+        if exc_info is not None:
+            future.set_exc_info(exc_info)
+        else:
+            future.set_result(result)
+
+
+def _picklable_error(e, formatted):
+    """The exception e, or a RuntimeError saying what it was when it can't
+    come back from the pool process
+    """
+    try:
+        pickle.loads(pickle.dumps(e, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        e = RuntimeError("%s: %s" % (e.__class__.__name__, e))
+    return e, formatted
+
+
+def _timed_call(call, submitted):
+    """Runs in a pool process, the call comes pickled and the result goes
+    back pickled: multiprocessing would otherwise drop a call whose result
+    can't be pickled without ever calling back. Exceptions come back as
+    values because the traceback of the child can not be pickled
+    """
+    waited = time.time() - submitted
+    try:
+        fn, args, kwargs = pickle.loads(call)
+        result = fn(*args, **kwargs)
+        return waited, pickle.dumps(result, pickle.HIGHEST_PROTOCOL), None
+    except Exception, e:
+        return waited, None, _picklable_error(e, traceback.format_exc())
+
+
+class ProcessPool(object):
+    """Runs CPU bound calls in a multiprocessing pool
+
+    Same interface as ThreadPool, fn and its arguments and result must be
+    picklable, so fn has to be a module level function.
+    """
+    def __init__(self, processes=None, io_loop=None, name='process',
+                 max_queue=0, on_wait=None, inline=False):
+        if io_loop is None and not inline:
+            import tornado.ioloop
+            io_loop = tornado.ioloop.IOLoop.instance()
+        import multiprocessing
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        self.name = name
+        self.max_workers = processes
+        self.max_queue = max_queue
+        self.io_loop = io_loop
+        self.on_wait = on_wait
+        self.rejected = 0
+        self._pending = 0
+        # _pending is updated by the result thread too when inline
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(processes)
+
+    def queue_depth(self):
+        return max(0, self._pending - self.max_workers)
+
+    def workers(self):
+        return self.max_workers
+
+    def submit(self, fn, *args, **kwargs):
+        if self.max_queue and self.queue_depth() >= self.max_queue:
+            self.rejected += 1
+            raise PoolFullError("%s pool queue is full" % self.name)
+        # raises here rather than in the task thread of multiprocessing,
+        # which would never call back
+        call = pickle.dumps((fn, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        future = Future()
+        self._lock.acquire()
+        try:
+            self._pending += 1
+        finally:
+            self._lock.release()
+        self._pool.apply_async(_timed_call, (call, time.time()),
+                               callback=functools.partial(self._returned,
+                                                          future))
+        return future
+
+    def _returned(self, future, value):
+        # in the result thread of multiprocessing
+        if self.io_loop is None:
+            self._done(future, value)
+        else:
+            self.io_loop.add_callback(functools.partial(self._done, future,
+                                                        value))
+
+    def shutdown(self):
+        self._pool.terminate()
+
+    def _done(self, future, value):
+        self._lock.acquire()
+        try:
+            self._pending -= 1
+        finally:
+            self._lock.release()
+        waited, result, error = value
+        if self.on_wait is not None:
+            self.on_wait(waited)
+        if error is not None:
+            e, formatted = error
+            logging.debug("Call failed in the %s pool:\n%s", self.name,
+                          formatted)
+            future.set_exc_info((e.__class__, e, None))
+        else:
+            future.set_result(pickle.loads(result))
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -25,6 +25,7 @@ except:
 from google.appengine.ext import db
 
 from whirly import project
+from whirly.handlers import set_lazy_attribute
 from whirly.extensions.base import Extension
 from whirly.extensions.authbase.userbase import SESSION_AUTH_KEY
 from whirly.extensions.authbase.userbase import AbstractUser
@@ -299,14 +300,16 @@ class AuthHelper(UserHelper, PermissionHelper, GroupHelper):
 
 
 class DatastoreAuth(Extension):
+    requires = ('session',)
+
     def __init__(self):
         if not project.setting('extensions', 'whirly.extensions.session'):
             raise Exception("Auth extension need session support. ")
         super(DatastoreAuth, self).__init__('auth')
 
     def before(self, handler):
-        handler.auth = AuthHelper(handler)
-        handler.auth.get_user()
+        set_lazy_attribute(handler, 'auth', lambda: AuthHelper(handler))
+        set_lazy_attribute(handler, 'user', lambda: handler.auth.get_user())
         return handler
 
 
@@ -27,6 +27,8 @@ from pymongo.objectid import ObjectId
 from mongokit import Connection, Document
 
 from whirly import project
+from whirly.concurrent import chain
+from whirly.handlers import set_lazy_attribute
 from whirly.extensions.base import Extension
 from whirly.extensions.authbase.userbase import SESSION_AUTH_KEY
 from whirly.extensions.authbase.userbase import AbstractUserHelper
@@ -198,14 +200,21 @@ class AuthHelper(UserHelper, PermissionHelper, GroupHelper):
 
 
 class Auth(Extension):
+    requires = ('session',)
+
     def __init__(self):
         if not project.setting('extensions', 'whirly.extensions.session'):
             raise Exception("Auth Extension need session support. ")
         super(Auth, self).__init__('auth')
 
     def before(self, handler):
-        handler.auth = AuthHelper(handler)
-        handler.auth.get_user()
+        set_lazy_attribute(handler, 'auth', lambda: AuthHelper(handler))
+        if handler.application.settings.get('async_extensions'):
+            # mongo round trip in the thread pool instead of the IOLoop
+            future = handler.auth.get_user_async(
+                handler.application.get_executor('storage'))
+            return chain(future, lambda user: handler)
+        set_lazy_attribute(handler, 'user', lambda: handler.auth.get_user())
         return handler
 
 
@@ -16,6 +16,7 @@
 
 
 from whirly import project
+from whirly.handlers import set_lazy_attribute
 from whirly.extensions.base import Extension
 from whirly.extensions.authbase.userbase import AbstractUser
 from whirly.extensions.authbase.userbase import AbstractUserHelper
@@ -145,14 +146,16 @@ class AuthHelper(UserHelper, AbstractPermissionHelper):
 
 
 class NoDB(Extension):
+    requires = ('session',)
+
     def __init__(self):
         if not project.setting('extensions', 'whirly.extensions.session'):
             raise Exception("Auth extension need session support. ")
         super(NoDB, self).__init__('auth')
 
     def before(self, handler):
-        handler.auth = AuthHelper(handler)
-        handler.auth.get_user()
+        set_lazy_attribute(handler, 'auth', lambda: AuthHelper(handler))
+        set_lazy_attribute(handler, 'user', lambda: handler.auth.get_user())
         return handler
 
 
@@ -20,6 +20,7 @@ import hashlib
 import logging
 
 from whirly import project
+from whirly.concurrent import chain, resolved
 
 
 __all__ = ['UserProfile', 'AbstractUserHelper', 'AbstractUser',
@@ -128,6 +129,25 @@ class AbstractUserHelper(object):
         except KeyError:
             user = AnonymousUser()
         self.handler.user = user
+        return user
+
+    def get_user_async(self, executor):
+        """Like get_user() but load_user() runs in executor
+
+        Returns a Future of the user. The session must be loaded already.
+        """
+        try:
+            username = self.handler.session[SESSION_AUTH_KEY]
+        except KeyError:
+            self.handler.user = AnonymousUser()
+            return resolved(self.handler.user)
+
+        def loaded(user):
+            if not user:
+                user = AnonymousUser()
+            self.handler.user = user
+            return user
+        return chain(executor.submit(self.load_user, username), loaded)
 
     def load_user(self, username):
         """Load user data from different storage & create a user object return
@@ -15,7 +15,10 @@
 # under the License.
 
 
-__all__ = ['Extension']
+from __future__ import with_statement
+
+
+__all__ = ['Extension', 'with_extensions']
 
 
 import re
@@ -26,9 +29,38 @@ from tornado import web as utils
 from tornado.options import options
 
 import whirly.project
+from whirly import tracing
+from whirly.concurrent import chain, is_future
+from whirly.compression import ContentEncoding
+from whirly.pagecache import PageCapture
+
+
+# transforms which must see the body last, extension transforms go first
+_FINAL_TRANSFORMS = (ContentEncoding, utils.ChunkedTransferEncoding,
+                     PageCapture)
+
+
+class with_extensions(object):
+    """Declares the extensions a handler class needs
+
+        @with_extensions('session', 'auth')
+        class AccountHandler(BaseHandler):
+            ...
+
+    Extensions required by the given ones are added by the application.
+    """
+    def __init__(self, *names):
+        self.names = names
+
+    def __call__(self, handler_class):
+        handler_class.extensions = self.names
+        return handler_class
 
 
 class Extension(object):
+    # names of the extensions which must run before this one
+    requires = ()
+
     def __init__(self, name=None):
         self.name = name
         self.settings = whirly.project.extension_settings(self.name)
@@ -38,15 +70,24 @@ class Extension(object):
         self._check_required()
 
     def __call__(self, handler):
-        handler = self.before(handler)
-        handler = self.after(handler)
-        return handler
+        with tracing.span('%s.before' % self.name, 'extension'):
+            result = self.before(handler)
+        if is_future(result):
+            # before() went asynchronous, after() runs once it is done
+            return chain(result, self._after)
+        return self._after(result)
+
+    def _after(self, handler):
+        with tracing.span('%s.after' % self.name, 'extension'):
+            return self.after(handler)
 
     def append_transform(self, transform):
-        if isinstance(transform, utils.OutputTransform):
+        if isinstance(transform, type) and \
+           issubclass(transform, utils.OutputTransform):
             self.transform_classes.append(transform)
         else:
-            pass
+            logging.warning("%r is not an OutputTransform class, ignored" %
+                            (transform,))
 
     def define_required(self, setting_name, helptext):
         if not hasattr(self, '_required_settings'):
@@ -73,13 +114,27 @@ class Extension(object):
             sys.exit(1)
 
     def before(self, handler):
+        """Prepares handler before it is executed
+
+        Returns the handler, or a whirly.concurrent.Future of it when the
+        extension has to wait for a backend. Asynchronous extensions only
+        go asynchronous when the async_extensions setting is on.
+        """
         return handler
 
     def after(self, handler):
         """apply a transform object to handler
         """
-        for t in self.transform_classes:
-            handler._transforms.append(t(handler.request))
+        if not self.transform_classes or handler._transforms is None:
+            return handler
+        transforms = handler._transforms
+        position = len(transforms)
+        for index, transform in enumerate(transforms):
+            if isinstance(transform, _FINAL_TRANSFORMS):
+                position = index
+                break
+        transforms[position:position] = [t(handler.request)
+                                         for t in self.transform_classes]
         return handler
 
 
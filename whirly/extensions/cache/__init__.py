@@ -15,19 +15,46 @@
 # under the License.
 
 
+from __future__ import with_statement
+
 import sys
+import math
+import time
+import random
 import logging
 import inspect
 import functools
 
+from tornado import ioloop
+from tornado import httputil
+from tornado.httpserver import HTTPRequest
+
+from whirly.httpserver import FakeConnection
+
 from whirly import project
 from whirly import utils
+from whirly import tracing
+from whirly.compression import ContentEncoding, add_vary
+from whirly.extensions.cache import l1
+from whirly.extensions.cache import keys
+from whirly.extensions.cache import singleflight
 
 
-__all__ = ['whirly_cache', 'WC', 'cache', 'nocache']
+__all__ = ['whirly_cache', 'WC', 'cache', 'nocache', 'invalidate_namespace',
+           'invalidate_tags', 'add_tags']
 
 
 default_timeout = project.setting('cache', 'default_timeout', 300)
+default_namespace = project.setting('cache', 'namespace', 'whirly')
+
+# seconds between two reads of a key another process regenerates
+POLL_INTERVAL = 0.05
+
+# first item of the tuples stored by the decorator
+_ENTRY = 'whirly.cache'
+
+# request headers left out of the background refreshes
+_CREDENTIAL_HEADERS = ('Cookie', 'Authorization')
 
 
 def _get_cache_class():
@@ -41,52 +68,254 @@ def _get_cache_class():
     return cache_module.__dict__[_cls]
 
 
+def _two_tier(backend):
+    engine = getattr(backend, 'engine', None)
+    bus = project.setting('cache', 'l1_bus', None)
+    if bus is None:
+        bus = hasattr(engine, 'pubsub') and 'redis' or 'socket'
+    if bus == 'redis':
+        if not hasattr(engine, 'pubsub'):
+            logging.error("l1_bus 'redis' needs the Redis cache backend")
+            sys.exit(1)
+        bus = l1.RedisBus(engine, project.setting('cache', 'l1_channel',
+                                                  'whirly:l1'))
+    elif bus == 'socket':
+        directory = project.setting('cache', 'l1_socket_dir')
+        if directory is None:
+            directory = l1.default_socket_dir(project.project_name())
+        bus = l1.SocketBus(directory)
+    else:
+        logging.error("Unknown l1_bus %r, 'redis' or 'socket'" % bus)
+        sys.exit(1)
+    return l1.TwoTier(
+        backend, bus,
+        timeout=project.setting('cache', 'l1_timeout', 5),
+        max_entries=project.setting('cache', 'l1_max_entries', 1000),
+        max_bytes=project.setting('cache', 'l1_max_bytes', 8 * 1024 * 1024))
+
+
 whirly_cache = WC = _get_cache_class()(default_timeout)()
+if project.setting('cache', 'l1', False):
+    # see l1 for its settings
+    whirly_cache = WC = _two_tier(WC)
 
+# the namespace and tag versions, read once a second rather than on every
+# lookup
+_versions = keys.Versions(WC, project.setting('cache', 'version_timeout', 1))
 
-def _make_cache_key(func, key_dict, self):
+
+def _make_cache_key(func, key_dict, self, namespace, tags=()):
+    """(key, versions of tags), the tags read with the namespace
+    """
     cls = None
     if hasattr(func, 'im_func'):
         cls = func.im_class
         func = func.im_func
-        cache_key = func.__name__
-    else:
-        cache_key = func.__name__
-
-    if key_dict:
-        cache_key += "_" + "_".join(["%s_%s" % (k, v) for k, v in
-                                     key_dict.iteritems()])
     if not cls and self:
         cls = getattr(self, '__class__', None)
     if cls:
-        return '%s_%s_%s' % (cls.__module__.replace('.', '_'), cls.__name__,
-                             cache_key)
+        name = '%s.%s.%s' % (cls.__module__, cls.__name__, func.__name__)
     else:
-        return '%s_%s' % (func.__module__.replace('.', '_'), cache_key)
+        name = '%s.%s' % (func.__module__, func.__name__)
+    with tracing.span('cache.namespace', 'storage', namespace=namespace):
+        version, versions = _versions.read(namespace, tags)
+    return keys.make_key(namespace, version, name, key_dict), versions
 
 
 def _make_dict_from_args(func, args):
-    dict_ = {}
-    for i, arg in enumerate(inspect.getargspec(func)[0]):
-        if arg != 'handler':
-            dict_[arg] = args[i]
+    # args come without the handler, the first argument of func
+    names = inspect.getargspec(func)[0][1:]
+    dict_ = dict(zip(names, args))
+    # by position when func takes *args, decorated by asynchronous say
+    for i, arg in enumerate(args[len(names):]):
+        dict_['*%d' % i] = arg
     return dict_
 
 
-def _wrapper(f, cache_key, timeout):
+def invalidate_namespace(namespace=None):
+    """Drops every entry cached in namespace at once, the default namespace
+    of the cache decorator when None
+    """
+    if namespace is None:
+        namespace = default_namespace
+    _versions.invalidate_namespace(namespace)
+
+
+def _wrapper(handler, f, cache_key, timeout, encoding='', flight=None,
+             stale=0, started=None, tags=()):
     @functools.wraps(f)
-    def setcache(*args, **kwargs):
-        chunk = args[0]
-        WC.set(cache_key, chunk, timeout)
-        return f(*args, **kwargs)
+    def setcache(chunk=None):
+        if chunk is not None:
+            handler.write(chunk)
+        if handler.get_status() != 200:
+            # a redirect or an error, for a login page say
+            if flight is not None:
+                flight.release()
+            return f()
+        body = ''.join(handler._write_buffer)
+        # the ETag is computed once here, cache hits reuse it
+        etag = utils.weak_etag((body,))
+        handler.set_header('Etag', etag)
+        compressor = getattr(handler.application, 'compressor', None)
+        transforms = handler._transforms or ()
+        # stored compressed unless another transform has to see the body
+        # first, the compression transform leaves an encoded body as it is
+        if compressor is not None and encoding and transforms and \
+           isinstance(transforms[0], ContentEncoding):
+            body, encoding_applied = compressor.encode(handler._headers, body,
+                                                       encoding)
+            handler._write_buffer = [body]
+        else:
+            encoding_applied = ''
+        data = (etag, body, encoding_applied)
+        # the versions of the tags added by the handler are the current
+        # ones, the others were read before it ran
+        known = set(tag for tag, version in tags)
+        added = [tag for tag in getattr(handler, 'cache_tags', ())
+                 if tag not in known]
+        stamped = tuple(tags) + tuple(zip(added, _versions.tags(added)))
+        now = time.time()
+        # fresh for timeout, then served stale while it is regenerated,
+        # the backend drops it once stale too
+        entry = (_ENTRY, now + timeout, now - (started or now), data,
+                 stamped)
+        with tracing.span('cache.set', 'storage', key=cache_key):
+            WC.set(cache_key, entry, timeout + stale)
+        if flight is not None:
+            flight.resolve(data)
+        return f()
     return setcache
 
 
+def _unpack(entry):
+    """Returns (data, soft expiry, regeneration seconds, tag versions) of a
+    stored entry, entries written before soft expiries existed never go
+    stale
+    """
+    if isinstance(entry, tuple) and entry and entry[0] == _ENTRY:
+        if len(entry) == 5:
+            return entry[3], entry[1], entry[2], entry[4]
+        return entry[3], entry[1], entry[2], ()
+    return entry, None, 0, ()
+
+
+def _tags_current(tags, known=()):
+    """Whether none of the (tag, version) of an entry was invalidated,
+    known the (tag, current version) already read
+    """
+    if not tags:
+        return True
+    current = dict(known)
+    unknown = [tag for tag, version in tags if tag not in current]
+    # the tags added while the response was generated
+    current.update(zip(unknown, _versions.tags(unknown)))
+    for tag, version in tags:
+        if current[tag] != version:
+            return False
+    return True
+
+
+def add_tags(handler, *tags):
+    """Tags the response handler is generating, on top of the tags of the
+    cache decorator
+    """
+    handler.cache_tags = getattr(handler, 'cache_tags', ()) + tuple(tags)
+
+
+def invalidate_tags(*tags):
+    """Drops every entry tagged with one of tags
+    """
+    _versions.invalidate_tags(tags)
+
+
+def _refresh_early(now, soft_expires, delta, beta):
+    """Whether to regenerate a fresh entry already, more likely as it gets
+    closer to its expiry and the longer it takes to regenerate
+
+    Entries written together are regenerated at different times this way,
+    see "Optimal Probabilistic Cache Stampede Prevention", Vattani et al.
+    """
+    if not beta or not delta:
+        return False
+    return now - delta * beta * math.log(random.random() or 1e-12) >= \
+        soft_expires
+
+
+def _respond(handler, data):
+    """Finishes handler with the cached data
+    """
+    if isinstance(data, tuple):
+        if len(data) == 3:
+            etag, data, encoding = data
+            if encoding:
+                handler.set_header('Content-Encoding', encoding)
+                add_vary(handler._headers)
+        else:
+            etag, data = data
+        handler.set_header('Etag', etag)
+    return handler.finish(data)
+
+
 class cache(object):
-    def __init__(self, timeout=None, with_query_args=False):
+    """Caches the response of a handler method
+
+    A response is fresh for timeout seconds, then served stale for up to
+    stale seconds more while one request regenerates it in the background.
+    Fresh entries may be regenerated early, at random, so the entries
+    written together don't all expire together. Concurrent misses of the
+    same key are coalesced, see singleflight.
+
+    Entries are keyed on the handler method, its arguments and, with
+    with_query_args, the query arguments, in namespace. See keys and
+    invalidate_namespace(). Entries can be tagged, with tags, a list or
+    tags(handler, *args, **kwargs) returning one, and with add_tags() while
+    the response is generated. invalidate_tags() drops the entries of a
+    tag:
+
+        @cache(tags=lambda handler, user_id: ['user:%s' % user_id])
+        def get(self, user_id):
+            ...
+
+        invalidate_tags('user:42')
+
+    Settings of the cache section:
+
+        namespace                   default of namespace, 'whirly'
+        version_timeout             seconds this process keeps the
+                                    versions of namespaces and tags, 1 by
+                                    default, 0 reads them on every lookup
+        stale_timeout               default of stale, the timeout when
+                                    not set
+        early_refresh_beta          how early entries are regenerated, 0
+                                    disables it, 1 by default
+
+        single_flight               False regenerates on every miss
+        single_flight_timeout       seconds a request waits for another
+                                    to regenerate the page, 5 by default
+        single_flight_lock          True to coalesce across processes
+                                    with a lock in the backend
+        single_flight_lock_timeout  seconds the lock is held at most, 10
+                                    by default
+    """
+    def __init__(self, timeout=None, with_query_args=False,
+                 single_flight=None, stale=None, namespace=None, tags=None):
         self.timeout = timeout or project.setting('cache', 'default_timeout', 300)
+        if stale is None:
+            stale = project.setting('cache', 'stale_timeout', self.timeout)
+        self.stale = stale
+        self.beta = project.setting('cache', 'early_refresh_beta', 1.0)
         self.anonymous_only = project.setting('cache', 'anonymous_only', False)
         self.with_query_args = with_query_args
+        self.namespace = namespace or default_namespace
+        self.tags = tags
+        if single_flight is None:
+            single_flight = project.setting('cache', 'single_flight', True)
+        self.single_flight = single_flight
+        self.wait_timeout = project.setting('cache', 'single_flight_timeout',
+                                            5)
+        self.lock = project.setting('cache', 'single_flight_lock', False)
+        self.lock_timeout = project.setting('cache',
+                                            'single_flight_lock_timeout', 10)
 
     def __call__(self, func):
         def _process(instance, *args, **kwargs):
@@ -97,17 +326,237 @@ class cache(object):
             cache_key_dict = kwargs.copy()
             cache_key_dict.update(_make_dict_from_args(func, args))
             if self.with_query_args:
-                cache_key_dict.update(instance.request.arguments)
-            cache_key = _make_cache_key(func, cache_key_dict, instance)
-            data = WC.get(cache_key)
+                # apart from the arguments of the same name
+                for name, values in instance.request.arguments.iteritems():
+                    cache_key_dict['?' + name] = values
+            # read with the namespace, before the entry
+            tags = self.tags
+            if callable(tags):
+                tags = tags(instance, *args, **kwargs)
+            tags = tuple(tags or ())
+            cache_key, versions = _make_cache_key(
+                func, cache_key_dict, instance, self.namespace, tags)
+            tags = zip(tags, versions)
+            encoding = ''
+            compressor = getattr(instance.application, 'compressor', None)
+            if compressor is not None:
+                encoding = compressor.negotiate(instance.request)
+                if encoding:
+                    cache_key += '_' + encoding
+            miss = functools.partial(self._regenerate, instance, func, args,
+                                     kwargs, cache_key, encoding, tags)
+            refresh = getattr(instance.request, 'cache_refresh', None)
+            if refresh is not None:
+                # the background regeneration of a stale entry
+                return miss(refresh)
+            with tracing.span('cache.get', 'storage', key=cache_key) as s:
+                data, soft_expires, delta, stamped = _unpack(
+                    WC.get(cache_key))
+                if data and not _tags_current(stamped, tags):
+                    # invalidated, not even served stale
+                    data = None
+                s.set(hit=bool(data))
+            metrics = getattr(instance.application, 'metrics', None)
             logging.debug("Cache key: %s" % cache_key)
-            if not data:
-                logging.debug("Cache not exist. Need to regenerate. ")
-                instance.finish = _wrapper(instance.finish, cache_key, self.timeout)
-                return func(instance, *args, **kwargs)
-            return instance.finish(data)
+            if data:
+                now = time.time()
+                if soft_expires is None or (now < soft_expires and
+                        not _refresh_early(now, soft_expires, delta,
+                                           self.beta)):
+                    result = 'hit'
+                else:
+                    result = 'stale'
+                    self._refresh_later(instance, cache_key)
+                if metrics is not None:
+                    metrics.cache[result].inc()
+                return _respond(instance, data)
+            if not self.single_flight:
+                if metrics is not None:
+                    metrics.cache['miss'].inc()
+                return miss()
+            flight, leader = singleflight.join(cache_key)
+            if metrics is not None:
+                metrics.cache[leader and 'miss' or 'coalesced'].inc()
+            if not leader:
+                return self._wait(flight, instance, miss)
+            if self.lock and not singleflight.acquire_lock(
+                    WC, cache_key, self.lock_timeout):
+                # another process regenerates it, its value is awaited
+                return self._poll(flight, instance, cache_key, miss)
+            if self.lock:
+                flight.backend = WC
+            return miss(flight)
         return _process
 
+    def _regenerate(self, instance, func, args, kwargs, cache_key, encoding,
+                    tags, flight=None):
+        # tags, the (tag, version) read before the response is generated,
+        # an invalidation meanwhile drops it
+        logging.debug("Cache not exist. Need to regenerate. ")
+        instance.finish = _wrapper(instance, instance.finish, cache_key,
+                                   self.timeout, encoding, flight, self.stale,
+                                   time.time(), tags)
+        if flight is None:
+            return func(instance, *args, **kwargs)
+        if not instance.application._wsgi:
+            self._watch(flight, instance)
+        try:
+            result = func(instance, *args, **kwargs)
+        except Exception:
+            flight.release()
+            raise
+        if instance._finished:
+            # finished without the wrapper, nothing was stored
+            flight.release()
+        return result
+
+    def _watch(self, flight, instance):
+        """Releases the flight of an asynchronous leader which doesn't
+        store its response in time, or whose client goes away
+        """
+        io_loop = ioloop.IOLoop.instance()
+        # a no-op once the flight landed
+        io_loop.add_timeout(time.time() + self.wait_timeout, flight.release)
+        connection = getattr(instance.request, 'connection', None)
+        if connection is None:
+            return
+
+        def closed():
+            flight.release()
+            instance.application.connection_closed(instance)
+        connection.stream.set_close_callback(closed)
+
+    def _wait(self, flight, instance, miss):
+        """Finishes instance with the value regenerated by flight
+        """
+        if instance.application._wsgi:
+            data = flight.wait(self.wait_timeout)
+            if data is None:
+                return miss()
+            return _respond(instance, data)
+
+        # finished once the flight lands, like an asynchronous handler
+        instance._auto_finish = False
+        io_loop = ioloop.IOLoop.instance()
+        state = {}
+
+        def landed(data):
+            if state.get('done'):
+                return
+            state['done'] = True
+            io_loop.remove_timeout(timeout)
+            if data is None:
+                _run_later(instance, miss)
+            else:
+                _respond(instance, data)
+
+        def timed_out():
+            if state.get('done'):
+                return
+            state['done'] = True
+            logging.warning("Waited %ss for %s to be regenerated" % (
+                self.wait_timeout, flight.key))
+            # the leader is stuck, the next misses must not wait for it
+            flight.release()
+            _run_later(instance, miss)
+
+        timeout = io_loop.add_timeout(time.time() + self.wait_timeout,
+                                      timed_out)
+        flight.add_callback(landed)
+
+    def _poll(self, flight, instance, cache_key, miss):
+        """Polls the backend for the value another process regenerates,
+        takes over when it takes too long
+        """
+        deadline = time.time() + self.wait_timeout
+        if instance.application._wsgi:
+            while time.time() < deadline:
+                time.sleep(POLL_INTERVAL)
+                data = _unpack(WC.get(cache_key))[0]
+                if data:
+                    flight.resolve(data)
+                    return _respond(instance, data)
+            return miss(flight)
+
+        instance._auto_finish = False
+        io_loop = ioloop.IOLoop.instance()
+
+        def poll():
+            data = _unpack(WC.get(cache_key))[0]
+            if data:
+                flight.resolve(data)
+                _respond(instance, data)
+            elif time.time() < deadline:
+                io_loop.add_timeout(time.time() + POLL_INTERVAL, poll)
+            else:
+                _run_later(instance, functools.partial(miss, flight))
+
+        io_loop.add_timeout(time.time() + POLL_INTERVAL, poll)
+
+    def _refresh_later(self, instance, cache_key):
+        """Regenerates the entry served to instance once it is answered,
+        unless a regeneration of it is running already
+        """
+        request = instance.request
+        if request.method != "GET":
+            return
+        flight, leader = singleflight.join(cache_key)
+        if not leader:
+            return
+        if self.lock:
+            if not singleflight.acquire_lock(WC, cache_key, self.lock_timeout):
+                # another process refreshes it
+                flight.release()
+                return
+            flight.backend = WC
+        application = instance.application
+        refresh = functools.partial(_refresh, application, request, flight)
+        if application._wsgi:
+            application.get_executor().submit(refresh)
+            return
+        io_loop = ioloop.IOLoop.instance()
+        io_loop.add_callback(refresh)
+        # an asynchronous regeneration which never finishes must not block
+        # the next ones
+        io_loop.add_timeout(time.time() + self.wait_timeout, flight.release)
+
+
+def _refresh(application, request, flight):
+    """Runs a copy of request through application, its output is dropped
+    and the decorator regenerates the entry instead of reading it
+
+    The copy is anonymous: the entry is shared, it must not be generated
+    for the user whose request found it stale.
+    """
+    from whirly.web import Application
+
+    headers = httputil.HTTPHeaders(request.headers)
+    for name in _CREDENTIAL_HEADERS:
+        if name in headers:
+            del headers[name]
+    connection = FakeConnection()
+    copy = HTTPRequest(request.method, request.uri, request.version,
+                       headers=headers, remote_ip=request.remote_ip,
+                       connection=connection)
+    copy.cache_refresh = flight
+    try:
+        Application.__call__(application, copy)
+    except Exception:
+        logging.error("Could not regenerate %s" % flight.key, exc_info=True)
+    if connection.finished or application._wsgi:
+        # answered without storing anything, by an error page
+        flight.release()
+
+
+def _run_later(instance, method):
+    """Runs the handler method of an instance which is not auto finished,
+    the way RequestHandler._execute does
+    """
+    instance._auto_finish = True
+    method()
+    if instance._auto_finish and not instance._finished:
+        instance.finish()
+
 
 class nocache(object):
     def __call__(self, func):
@@ -56,6 +56,11 @@ class CacheMixIn:
     def set(self, key, value, timeout=300):
         raise NotImplementedError
 
+    def add(self, key, value, timeout=300):
+        """Sets key only if it is not set yet, returns whether it was
+        """
+        raise NotImplementedError
+
     def delete(self, key):
         raise NotImplementedError
 
@@ -70,12 +75,12 @@ class CacheMixIn:
         for k in keys:
             value = self.get(k)
             if value:
-                d[k] = value
+                data[k] = value
         return data
 
     def set_many(self, data, timeout=None):
         for k, v in data.items():
-            self.set(key, value, timeout)
+            self.set(k, v, timeout)
 
     def delete_many(self, keys):
         for k in keys:
@@ -121,6 +126,8 @@ class Redis(CacheBase, CacheMixIn):
         value = default
         now = time.time()
         data = self.engine.get(key)
+        if data is None:
+            return value
         expire_data, value_data = data.split(':', 1)
         expire = pickle.loads(expire_data)
         if expire < now:
@@ -129,15 +136,41 @@ class Redis(CacheBase, CacheMixIn):
             value = pickle.loads(value_data)
         return value
 
+    def get_many(self, keys):
+        data = {}
+        now = time.time()
+        # one round trip
+        for key, raw in zip(keys, self.engine.mget(keys)):
+            if raw is None:
+                continue
+            expire_data, value_data = raw.split(':', 1)
+            if pickle.loads(expire_data) >= now:
+                data[key] = pickle.loads(value_data)
+        return data
+
     def set(self, key, value, timeout=None):
         if not timeout:
             timeout = self.timeout
 
-        self._cleanup()
         now = time.time()
         expire_data = pickle.dumps(now + timeout, pickle.HIGHEST_PROTOCOL)
         value_data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-        self.engine.set(key, ':'.join(expire_data, value_data))
+        self.engine.set(key, ':'.join((expire_data, value_data)))
+        # redis drops it, no scan of every key
+        self.engine.expire(key, int(timeout) + 1)
+
+    def add(self, key, value, timeout=None):
+        if not timeout:
+            timeout = self.timeout
+
+        now = time.time()
+        expire_data = pickle.dumps(now + timeout, pickle.HIGHEST_PROTOCOL)
+        value_data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if not self.engine.setnx(key, ':'.join((expire_data, value_data))):
+            return False
+        # nothing else would ever remove it
+        self.engine.expire(key, int(timeout) + 1)
+        return True
 
     def delete(self, key):
         self.engine.delete(key)
@@ -159,17 +192,12 @@ class Redis(CacheBase, CacheMixIn):
     def clear(self):
         self.engine.flushdb()
 
-    def _cleanup(self):
-        for key in self.engine.keys('*'):
-            data = self.engine.get(key)
-            expire_data = data.split(':', 1)[0]
-            expire = pickle.loads(expire_data)
-            now = time.time()
-            if expire < now:
-                self.engine.delete(key)
-
 
 class Dir(CacheBase, CacheMixIn):
+    def __init__(self, timeout=300, **kwargs):
+        self.storage_url = project.setting('cache', 'storage_url')
+        super(Dir, self).__init__(timeout, **kwargs)
+
     def _prepare(self):
         self._prepare_dir()
         self._max_entries = 300
@@ -237,6 +265,33 @@ class Dir(CacheBase, CacheMixIn):
         except (IOError, OSError):
             pass
 
+    def add(self, key, value, timeout=None):
+        if not timeout:
+            timeout = self.timeout
+
+        # an expired entry is removed by contains()
+        if self.contains(key):
+            return False
+        filepath = self._get_path(key)
+        dirpath = os.path.dirname(filepath)
+        try:
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+        except OSError:
+            # made by another process meanwhile
+            pass
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError:
+            return False
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(time.time() + timeout, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        return True
+
     def delete(self, key):
         try:
             self._delete_file(self._get_path(key))
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Cache keys
+
+A key is built from a namespace, a name and parameters:
+
+    namespace:version:name:parameters
+
+The parameters are sorted by name and their values normalized, the same
+parameters always give the same key. A part longer than MAX_PART is
+replaced by its md5, so keys stay under the 250 bytes of memcached.
+
+The version of a namespace is a stamp stored in the backend. Changing it
+with invalidate_namespace() orphans every key of the namespace at once,
+the backend expires them, no key is scanned.
+
+Tags are versioned the same way: an entry keeps the versions its tags had
+when it was generated and is dropped on read once one of them changed,
+see invalidate_tags().
+
+Versions reads the stamps of a namespace and of tags at once, and keeps
+them in the process for a second or so: a lookup does not read them from
+the backend every time, an invalidation from another process is seen that
+much later.
+"""
+
+
+__all__ = ['make_key', 'canonical', 'namespace_version',
+           'invalidate_namespace', 'tag_versions', 'invalidate_tags',
+           'Versions']
+
+
+import time
+import random
+import urllib
+import hashlib
+
+from whirly.pagecache import MemoryStore
+
+
+# longer parts of a key are hashed
+MAX_PART = 64
+
+# seconds the version of a namespace is kept, the 30 days memcached allows
+VERSION_TIMEOUT = 30 * 24 * 3600
+
+
+def _quote(s):
+    # the separators of the key and the whitespace memcached refuses
+    return urllib.quote(s, safe='')
+
+
+def _fixed(part):
+    if len(part) > MAX_PART:
+        return hashlib.md5(part).hexdigest()
+    return part
+
+
+def canonical(value):
+    """The str of value in a key, equal values give equal strs
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_quote(canonical(v)) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(_quote(canonical(v)) for v in value))
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(sorted(
+            '%s:%s' % (_quote(canonical(k)), _quote(canonical(v)))
+            for k, v in value.iteritems()))
+    return canonical(unicode(value))
+
+
+def make_key(namespace, version, name, params=None):
+    """The key of name called with params, a dict, in namespace
+    """
+    parts = [_fixed(_quote(canonical(namespace))), version,
+             _fixed(_quote(canonical(name)))]
+    if params:
+        parts.append(_fixed('&'.join(sorted(
+            '%s=%s' % (_quote(canonical(k)), _quote(canonical(v)))
+            for k, v in params.iteritems()))))
+    return ':'.join(parts)
+
+
+def _stamp_key(kind, name):
+    return '%s:%s' % (kind, _fixed(_quote(canonical(name))))
+
+
+def _new_version():
+    return '%x%04x' % (int(time.time() * 1000), random.getrandbits(16))
+
+
+def _start_version(backend, key):
+    # new, or evicted: the keys of the previous version must not come
+    # back, a new version is started
+    version = _new_version()
+    add = getattr(backend, 'add', None)
+    if add is None:
+        backend.set(key, version, VERSION_TIMEOUT)
+        return version
+    if not add(key, version, VERSION_TIMEOUT):
+        # started by another process meanwhile
+        return backend.get(key) or version
+    return version
+
+
+def _get_many(backend, keys):
+    get_multi = getattr(backend, 'get_multi', None)
+    if get_multi is not None:
+        # the memcache clients
+        return get_multi(keys)
+    get_many = getattr(backend, 'get_many', None)
+    if get_many is not None:
+        return get_many(keys)
+    return dict((key, backend.get(key)) for key in keys)
+
+
+def namespace_version(backend, namespace):
+    """The current version of namespace in backend
+    """
+    key = _stamp_key('namespace', namespace)
+    return backend.get(key) or _start_version(backend, key)
+
+
+def invalidate_namespace(backend, namespace):
+    """Drops every key of namespace, returns the new version
+    """
+    version = _new_version()
+    backend.set(_stamp_key('namespace', namespace), version, VERSION_TIMEOUT)
+    return version
+
+
+def tag_versions(backend, tags):
+    """The current versions of tags in backend, in the same order, read at
+    once when the backend can
+    """
+    if not tags:
+        return ()
+    stamp_keys = [_stamp_key('tag', tag) for tag in tags]
+    found = _get_many(backend, stamp_keys)
+    return tuple(found.get(key) or _start_version(backend, key)
+                 for key in stamp_keys)
+
+
+def invalidate_tags(backend, tags):
+    """Drops every entry stored with one of tags
+    """
+    for tag in tags:
+        backend.set(_stamp_key('tag', tag), _new_version(), VERSION_TIMEOUT)
+
+
+class Versions(object):
+    """The versions of backend, the ones read kept timeout seconds in this
+    process
+    """
+    def __init__(self, backend, timeout=1, max_entries=10000):
+        self.backend = backend
+        self.timeout = timeout
+        self.local = MemoryStore(max_entries * 64, len, max_entries)
+
+    def _keep(self, key, version):
+        if self.timeout:
+            self.local.set(key, version, self.timeout)
+
+    def _read(self, stamp_keys):
+        found = {}
+        missing = []
+        for key in stamp_keys:
+            version = self.timeout and self.local.get(key)
+            if version:
+                found[key] = version
+            else:
+                missing.append(key)
+        if missing:
+            read = _get_many(self.backend, missing)
+            for key in missing:
+                version = read.get(key) or _start_version(self.backend, key)
+                found[key] = version
+                self._keep(key, version)
+        return found
+
+    def read(self, namespace, tags=()):
+        """(version of namespace, current versions of tags, in the same
+        order), read from the backend at once
+        """
+        namespace_key = _stamp_key('namespace', namespace)
+        stamp_keys = [_stamp_key('tag', tag) for tag in tags]
+        found = self._read([namespace_key] + stamp_keys)
+        return found[namespace_key], tuple(found[key] for key in stamp_keys)
+
+    def namespace(self, namespace):
+        """The current version of namespace
+        """
+        return self.read(namespace)[0]
+
+    def tags(self, tags):
+        """The current versions of tags, in the same order
+        """
+        if not tags:
+            return ()
+        stamp_keys = [_stamp_key('tag', tag) for tag in tags]
+        found = self._read(stamp_keys)
+        return tuple(found[key] for key in stamp_keys)
+
+    def invalidate_namespace(self, namespace):
+        version = invalidate_namespace(self.backend, namespace)
+        # seen at once by this process, by the others once their copy
+        # expired
+        self._keep(_stamp_key('namespace', namespace), version)
+        return version
+
+    def invalidate_tags(self, tags):
+        for tag in tags:
+            key = _stamp_key('tag', tag)
+            version = _new_version()
+            self.backend.set(key, version, VERSION_TIMEOUT)
+            self._keep(key, version)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""In-process tier in front of a cache backend
+
+TwoTier keeps the values read from or written to the backend in the
+memory of the worker for a few seconds, the keys read the most, and the
+namespace and tag versions read on every request, are served without a
+round trip.
+
+Every write, delete or clear is published on a bus, the other workers
+drop their copy of the key: through redis pub/sub when the backend is
+redis, else through unix datagram sockets, one per worker, in a shared
+directory. A lost message leaves a copy at most timeout seconds old.
+
+Settings of the cache section:
+
+    l1                  True to put the tier in front of the backend
+    l1_timeout          seconds a value is kept, 5 by default
+    l1_max_entries      values kept by every worker, 1000 by default
+    l1_max_bytes        bytes of values kept by every worker, 8MB default
+    l1_bus              'redis' or 'socket', redis for the Redis backend
+                        by default
+    l1_channel          redis channel, 'whirly:l1' by default
+    l1_socket_dir       directory of the sockets, in the temporary
+                        directory by default, the workers of a project
+                        must share it
+"""
+
+
+__all__ = ['TwoTier', 'RedisBus', 'SocketBus', 'default_socket_dir']
+
+
+import os
+import errno
+import socket
+import random
+import logging
+import tempfile
+import threading
+
+from whirly.pagecache import MemoryStore
+from whirly.extensions.cache.keys import _get_many
+
+
+# messages of the bus, followed by the key
+_DELETE = 'd'
+_CLEAR = 'c'
+
+
+def sizeof(value):
+    """Rough bytes taken by a cached value, its strings mostly
+    """
+    if isinstance(value, basestring):
+        return len(value) + 40
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(v) for v in value) + 56
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.iteritems()) + 280
+    return 24
+
+
+def _start_thread(target, name):
+    thread = threading.Thread(target=target, name=name)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+
+class RedisBus(object):
+    def __init__(self, engine, channel='whirly:l1'):
+        self.engine = engine
+        self.channel = channel
+
+    def start(self, callback):
+        """Calls callback(message) with the messages of the other workers,
+        from now on
+        """
+        pubsub = self.engine.pubsub()
+        pubsub.subscribe(self.channel)
+
+        def listen():
+            for message in pubsub.listen():
+                if message.get('type') == 'message':
+                    callback(message['data'])
+        _start_thread(listen, 'whirly-l1-redis')
+
+    def publish(self, message):
+        self.engine.publish(self.channel, message)
+
+
+class SocketBus(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self._socket = None
+
+    def start(self, callback):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another worker meanwhile
+                pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        path = os.path.join(self.directory, '%d.sock' % os.getpid())
+        if os.path.exists(path):
+            # left by a dead process of the same pid
+            os.remove(path)
+        sock.bind(path)
+        self._socket, self.path = sock, path
+
+        def listen():
+            while True:
+                try:
+                    callback(sock.recv(4096))
+                except socket.error, e:
+                    if e.args[0] != errno.EINTR:
+                        logging.error("L1 cache bus failed: %s" % e)
+                        return
+        _start_thread(listen, 'whirly-l1-socket')
+
+    def publish(self, message):
+        sock = self._socket
+        if sock is None:
+            return
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith('.sock'):
+                continue
+            try:
+                sock.sendto(message, path)
+            except socket.error, e:
+                if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                    # its worker is gone
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                elif e.args[0] != errno.EAGAIN:
+                    logging.warning("Could not reach %s: %s" % (path, e))
+
+
+class TwoTier(object):
+    """backend with a copy of its values in this process
+    """
+    def __init__(self, backend, bus=None, timeout=5, max_entries=1000,
+                 max_bytes=8 * 1024 * 1024):
+        self.backend = backend
+        self.bus = bus
+        self.timeout = timeout
+        self.local = MemoryStore(max_bytes, sizeof, max_entries)
+        self.hits = 0
+        self.misses = 0
+        # the bus is started in every worker, after the fork
+        self._pid = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def _listen(self):
+        pid = os.getpid()
+        if self._pid == pid or self.bus is None:
+            return
+        self._lock.acquire()
+        try:
+            if self._pid == pid:
+                return
+            # copied from the parent, its messages were not received
+            self.local.clear()
+            self._token = '%d-%x' % (pid, random.getrandbits(32))
+            try:
+                self.bus.start(self._receive)
+            except Exception, e:
+                logging.error("Could not start the L1 cache bus, values "
+                              "are not kept in this process: %s" % e)
+                self.bus = None
+                self.local = MemoryStore(0, sizeof, 0)
+            self._pid = pid
+        finally:
+            self._lock.release()
+
+    def _receive(self, message):
+        token, _, rest = message.partition('\n')
+        if token == self._token:
+            return
+        if rest[:1] == _CLEAR:
+            self.local.clear()
+        else:
+            self.local.delete(rest[1:])
+
+    def _publish(self, kind, key=''):
+        if self.bus is None:
+            return
+        try:
+            self.bus.publish('%s\n%s%s' % (self._token, kind, key))
+        except Exception, e:
+            logging.warning("Could not publish to the L1 cache bus: %s" % e)
+
+    def _keep(self, key, value, timeout=None):
+        if timeout:
+            timeout = min(timeout, self.timeout)
+        else:
+            timeout = self.timeout
+        self.local.set(key, value, timeout)
+
+    def get(self, key, default=None):
+        self._listen()
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.backend.get(key)
+        if value is None:
+            return default
+        self._keep(key, value)
+        return value
+
+    def get_many(self, keys):
+        self._listen()
+        data = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                data[key] = value
+        self.hits += len(data)
+        self.misses += len(missing)
+        if missing:
+            for key, value in _get_many(self.backend, missing).iteritems():
+                if value is not None:
+                    data[key] = value
+                    self._keep(key, value)
+        return data
+
+    def set(self, key, value, timeout=None):
+        self._listen()
+        if timeout is None:
+            self.backend.set(key, value)
+        else:
+            self.backend.set(key, value, timeout)
+        self._keep(key, value, timeout)
+        self._publish(_DELETE, key)
+
+    def add(self, key, value, timeout=None):
+        # atomic in the backend only, the locks of singleflight
+        self._listen()
+        if timeout is None:
+            added = self.backend.add(key, value)
+        else:
+            added = self.backend.add(key, value, timeout)
+        if added:
+            self.local.delete(key)
+            self._publish(_DELETE, key)
+        return added
+
+    def delete(self, key):
+        self._listen()
+        self.backend.delete(key)
+        self.local.delete(key)
+        self._publish(_DELETE, key)
+
+    def contains(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        self._listen()
+        self.backend.clear()
+        self.local.clear()
+        self._publish(_CLEAR)
+
+
+def default_socket_dir(project_name):
+    return os.path.join(tempfile.gettempdir(), 'whirly-l1-%s' % project_name)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
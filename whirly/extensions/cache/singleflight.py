@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""One regeneration per missing cache key
+
+The first request missing a key regenerates it, the requests missing the
+same key meanwhile wait for its result instead of regenerating it too:
+on the IOLoop under tornado, blocked on an event in a WSGI thread.
+
+Across worker processes the regenerating request can also take a short
+lock in the cache backend, the workers which don't get it poll the
+backend for the value.
+"""
+
+
+__all__ = ['Flight', 'join', 'acquire_lock', 'release_lock']
+
+
+import time
+import logging
+import functools
+import threading
+
+from tornado import ioloop
+from tornado import stack_context
+
+
+# cache key -> Flight regenerating it in this process
+_flights = {}
+_lock = threading.Lock()
+
+
+class Flight(object):
+    def __init__(self, key):
+        self.key = key
+        self.done = False
+        self.data = None
+        # set once the backend lock is taken, see acquire_lock()
+        self.backend = None
+        self._callbacks = []
+        self._event = threading.Event()
+
+    def add_callback(self, callback):
+        """callback(data) is called on the IOLoop once the flight lands,
+        with None when the regeneration failed
+        """
+        if self.done:
+            ioloop.IOLoop.instance().add_callback(
+                functools.partial(callback, self.data))
+            return
+        self._callbacks.append(stack_context.wrap(callback))
+
+    def wait(self, timeout):
+        """Blocks until the flight lands, returns its data
+        """
+        self._event.wait(timeout)
+        return self.data
+
+    def resolve(self, data):
+        """The regenerated value, given to every waiting request
+        """
+        self._land(data)
+
+    def release(self):
+        """The regeneration failed, the waiting requests do it themselves
+        """
+        self._land(None)
+
+    def _land(self, data):
+        if self.done:
+            return
+        _lock.acquire()
+        try:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        finally:
+            _lock.release()
+        self.done = True
+        self.data = data
+        if self.backend is not None:
+            release_lock(self.backend, self.key)
+            self.backend = None
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        if callbacks:
+            io_loop = ioloop.IOLoop.instance()
+            for callback in callbacks:
+                # a failing waiter must not break the others
+                io_loop.add_callback(functools.partial(callback, data))
+
+
+def join(key):
+    """Returns (flight, True) when the caller has to regenerate key, or
+    (flight, False) to wait for the flight in progress
+    """
+    _lock.acquire()
+    try:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight(key)
+        return flight, True
+    finally:
+        _lock.release()
+
+
+def _lock_key(key):
+    return key + ':lock'
+
+
+def acquire_lock(backend, key, timeout):
+    """Takes the lock of key in backend for timeout seconds, returns False
+    when another process holds it
+
+    The backend needs an atomic add(key, value, timeout), without it the
+    lock is always granted.
+    """
+    add = getattr(backend, 'add', None)
+    if add is None:
+        logging.warning("%s has no add(), cache regenerations are not "
+                        "coalesced across processes" %
+                        backend.__class__.__name__)
+        return True
+    try:
+        return bool(add(_lock_key(key), time.time(), int(timeout) or 1))
+    except Exception, e:
+        logging.warning("Could not lock %s: %s" % (key, e))
+        return True
+
+
+def release_lock(backend, key):
+    try:
+        backend.delete(_lock_key(key))
+    except Exception, e:
+        logging.warning("Could not unlock %s: %s" % (key, e))
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
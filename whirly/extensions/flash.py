@@ -16,6 +16,7 @@
 
 
 from whirly import utils
+from whirly.handlers import set_lazy_attribute
 from whirly.extensions.base import Extension
 
 
@@ -54,7 +55,7 @@ class Flash(Extension):
         super(Flash, self).__init__('flash')
 
     def before(self, handler):
-        handler.flash = FlashMessage(handler)
+        set_lazy_attribute(handler, 'flash', lambda: FlashMessage(handler))
         return handler
 
 
@@ -23,16 +23,21 @@ from tornado.web import HTTPError
 
 import whirly.web
 import whirly.utils
+from whirly import tracing
 
+from whirly.concurrent import chain, resolved
+from whirly.handlers import set_lazy_attribute
 from whirly.extensions.base import Extension
 from whirly.extensions.session.store import SessionStoreDelegate
+from whirly.extensions.session.store import InstrumentedSessionStore
+from whirly.extensions.session.store import AsyncSessionStore
 
 
 __all__ = ['Session']
 
 
 class Session(whirly.utils.ThreadedDict):
-    def __init__(self, request_handler, **kwargs):
+    def __init__(self, request_handler, load=True, **kwargs):
         self.__dict__['_request_handler'] = request_handler
         self.__dict__['_settings'] = self._request_handler.application.settings
         self.__dict__['_last_cleanup_time'] = 0
@@ -45,33 +50,64 @@ class Session(whirly.utils.ThreadedDict):
         self.__dict__['_cookie_expires_days'] = self._settings.get(
             'cookie_expires_days', None)
         self.__dict__['store'] = SessionStoreDelegate(self._session_storage_url)
+        metrics = getattr(self._request_handler.application, 'metrics', None)
+        if metrics is not None or tracing.current_trace() is not None:
+            self.__dict__['store'] = InstrumentedSessionStore(self.store,
+                                                              metrics)
         if (self._session_storage_url.startswith("cookie")):
             # cookie based session need current handler
             self.store.set_handler(self._request_handler)
         self.session_id = self._request_handler.get_secure_cookie(self._session_cookie_name)
         self.lifetime = self._settings.get('session_lifetime', 7200)
         self._killed = False
-        self._cleanup()
-        request = self._request_handler.request
+        if load:
+            self._apply(*self._fetch(self.session_id, self.lifetime))
+
+    @classmethod
+    def load_async(cls, request_handler, executor):
+        """Returns a Future of the session of request_handler, the store is
+        read in executor
+        """
+        session = cls(request_handler, load=False)
+        future = executor.submit(session._fetch, session.session_id,
+                                 session.lifetime)
+        return chain(future, lambda result: session._apply(*result) or session)
 
-        if self.session_id:
+    def _fetch(self, session_id, lifetime):
+        """Does the store round trips of loading the session
+
+        Runs in a worker thread when loading asynchronously, so it touches
+        nothing but the store: the session data is thread local. Returns
+        (session_id, data, expired), data is None for a new session.
+        """
+        self._cleanup(lifetime)
+        data = None
+        if session_id:
             # TODO do we need session id verify here
             logging.debug("Get session id from secure cookie: %s" %
-                          self.session_id)
-            if  self.session_id not in self.store:
-                if self._settings.get('session_ignore_expiry', True):
-                    self.session_id = None
-                else:
+                          session_id)
+            if session_id not in self.store:
+                if not self._settings.get('session_ignore_expiry', True):
                     logging.debug('User has a id but it is not in store. ')
-                    return self.expired()
+                    return session_id, None, True
+                session_id = None
             else:
-                self.update(self.store[self.session_id])
-                self._validate_ip(request.remote_ip)
-                self._validate_user_agent(request.headers.get('User-Agent'))
+                data = self.store[session_id]
 
-        if not self.session_id:
+        if not session_id:
             logging.debug("Session id is invalid or not set, gen a new one")
-            self.session_id = self._generate_session_id()
+            session_id = self._generate_session_id()
+        return session_id, data, False
+
+    def _apply(self, session_id, data, expired):
+        self.session_id = session_id
+        if expired:
+            return self.expired()
+        request = self._request_handler.request
+        if data is not None:
+            self.update(data)
+            self._validate_ip(request.remote_ip)
+            self._validate_user_agent(request.headers.get('User-Agent'))
 
         # always update to the current 
         self.ip = request.remote_ip
@@ -84,11 +120,10 @@ class Session(whirly.utils.ThreadedDict):
     def __str__(self):
         return self.session_id
 
-    def _cleanup(self):
+    def _cleanup(self, lifetime):
         """ clean expired sessions
         """
         current_time = time.time()
-        lifetime = self.lifetime
         if current_time - self._last_cleanup_time > lifetime:
             self.store.cleanup(lifetime)
             self.__dict__['_last_cleanup_time'] = current_time
@@ -128,17 +163,37 @@ class Session(whirly.utils.ThreadedDict):
     def save(self):
         if not self.get('_killed'):
             self.store[self.session_id] = dict(self)
-            self._request_handler.set_secure_cookie(
-                self._session_cookie_name,
-                self.session_id,
-                domain=self._cookie_domain,
-                path=self._cookie_path,
-                expires_days=self._cookie_expires_days
-            )
+            self._set_cookie()
         else:
             logging.debug('Clean "session_id" in the cookie of user. ')
             self._request_handler.clear_cookie(self._session_cookie_name)
 
+    def save_async(self, executor=None):
+        """Like save() but the store is written in executor, the storage
+        thread pool of the application by default
+
+        Returns a Future resolved once the session is stored.
+        """
+        if self.get('_killed'):
+            self.save()
+            return resolved(None)
+        if executor is None:
+            executor = self._request_handler.application.get_executor(
+                'storage')
+        store = AsyncSessionStore(self.store, executor)
+        future = store.set(self.session_id, dict(self))
+        self._set_cookie()
+        return future
+
+    def _set_cookie(self):
+        self._request_handler.set_secure_cookie(
+            self._session_cookie_name,
+            self.session_id,
+            domain=self._cookie_domain,
+            path=self._cookie_path,
+            expires_days=self._cookie_expires_days
+        )
+
     def flush(self):
         """Force to delete the current session and make a new one
         """
@@ -166,8 +221,18 @@ class SessionExtension(Extension):
         # you can append ur transform class here 
 
     def before(self, handler):
-        if not isinstance(handler, whirly.web.StaticFileHandler):
-            handler.session = Session(handler)
+        if isinstance(handler, whirly.web.StaticFileHandler):
+            return handler
+        settings = handler.application.settings
+        if settings.get('async_extensions') and not settings.get(
+                'session_storage_url', 'dir://').startswith('cookie'):
+            # loaded up front, reading it later must not block
+            def loaded(session):
+                handler.session = session
+                return handler
+            executor = handler.application.get_executor('storage')
+            return chain(Session.load_async(handler, executor), loaded)
+        set_lazy_attribute(handler, 'session', lambda: Session(handler))
         return handler
 
 
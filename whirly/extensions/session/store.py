@@ -15,7 +15,11 @@
 # under the License.
 
 
-__all__ = ['SessionStoreDelegate']
+from __future__ import with_statement
+
+
+__all__ = ['SessionStoreDelegate', 'InstrumentedSessionStore',
+           'AsyncSessionStore']
 
 
 import os
@@ -60,6 +64,7 @@ except ImportError:
 
 import whirly.project
 import whirly.utils
+from whirly import tracing
 from whirly.extensions.storage import StorageEngineMongoDB
 from whirly.extensions.storage import StorageEngineDatastore
 from whirly.extensions.storage import StorageEngineMySQL
@@ -558,6 +563,79 @@ class SessionStoreDatastore(SessionStore):
             s.delete()
 
 
+class InstrumentedSessionStore(object):
+    """Traces and counts every operation on store
+
+    metrics is the Metrics of the application, or None.
+    """
+    def __init__(self, store, metrics=None):
+        self.store = store
+        self.storage_url = store.storage_url
+        if metrics is not None:
+            self._counters = metrics.session_store
+        else:
+            self._counters = None
+
+    def _count(self, operation):
+        if self._counters is not None:
+            # from the storage threads too
+            self._counters[operation].inc()
+
+    def set_handler(self, handler):
+        self.store.set_handler(handler)
+
+    def __contains__(self, key):
+        self._count('contains')
+        with tracing.span('session.contains', 'storage'):
+            return key in self.store
+
+    def __getitem__(self, key):
+        self._count('get')
+        with tracing.span('session.get', 'storage'):
+            return self.store[key]
+
+    def __setitem__(self, key, value):
+        self._count('set')
+        with tracing.span('session.set', 'storage'):
+            self.store[key] = value
+
+    def __delitem__(self, key):
+        self._count('delete')
+        with tracing.span('session.delete', 'storage'):
+            del self.store[key]
+
+    def cleanup(self, timeout):
+        self._count('cleanup')
+        with tracing.span('session.cleanup', 'storage'):
+            self.store.cleanup(timeout)
+
+
+class AsyncSessionStore(object):
+    """Runs the operations of a blocking store in executor
+
+    Every method returns a whirly.concurrent.Future of the result of the
+    matching store operation.
+    """
+    def __init__(self, store, executor):
+        self.store = store
+        self.executor = executor
+
+    def contains(self, key):
+        return self.executor.submit(self.store.__contains__, key)
+
+    def get(self, key):
+        return self.executor.submit(self.store.__getitem__, key)
+
+    def set(self, key, value):
+        return self.executor.submit(self.store.__setitem__, key, value)
+
+    def delete(self, key):
+        return self.executor.submit(self.store.__delitem__, key)
+
+    def cleanup(self, timeout):
+        return self.executor.submit(self.store.cleanup, timeout)
+
+
 storage_cls_map = {
     'cookie': SessionStoreCookie,
     'dir': SessionStoreDirectory,
@@ -21,14 +21,21 @@ from whirly.extensions.base import Extension
 
 
 class TransformLoader(Extension):
+    """Adds the output transforms of the transforms settings to every
+    handler, {module name: [class names]}
+
+    Response compression is not an extension, see whirly.compression.
+    """
     def __init__(self):
         super(TransformLoader, self).__init__('transforms')
         for module_name in self.settings.keys():
             __import__(module_name)
-            transform_class_list = self.settings[t]
+            transform_class_list = self.settings[module_name]
             for transform_class in transform_class_list:
-                self.append_transform(sys.modules[t].__dict__[transform_class])
-                logging.debug("Transforms loaded: %s.%s" % (t, transform_class))
+                self.append_transform(
+                    sys.modules[module_name].__dict__[transform_class])
+                logging.debug("Transforms loaded: %s.%s" % (module_name,
+                                                            transform_class))
 
 
 ### EOF ###
@@ -16,9 +16,12 @@
 
 
 
+from __future__ import with_statement
+
 import os
 import logging
 import httplib
+import datetime
 import traceback
 
 import tornado.template
@@ -27,6 +30,37 @@ import tornado.web
 from whirly import project
 from whirly import helpers
 from whirly import utils
+from whirly import tracing
+from whirly.bundles import bundle_tags
+
+
+# keeps tornado from giving a HEAD the ETag of its empty body, removed
+# before the headers are sent
+_NO_ETAG = 'whirly.no-etag'
+
+# error bodies rendered ahead of time in non-debug mode
+PRERENDERED_STATUS_CODES = (400, 401, 403, 404, 405, 500, 502, 503, 504)
+
+
+def is_debug():
+    return project.setting('application', 'debug', True)
+
+
+def capture_traceback():
+    """Formatted lines of the traceback being handled, or [] when nobody
+    will read them
+
+    Formatting a traceback costs more than handling most requests, it is
+    only done in debug mode, where the error page shows it, and for traced
+    requests, where it goes into the trace.
+    """
+    trace = tracing.current_trace()
+    if trace is None and not is_debug():
+        return []
+    lines = traceback.format_exc().splitlines()
+    if trace is not None:
+        trace.args['traceback'] = '\n'.join(lines)
+    return lines
 
 
 class HTTPErrorWrapper(Exception):
@@ -37,16 +71,198 @@ class HTTPErrorWrapper(Exception):
         self.response = response
 
 
+class lazy_attribute(object):
+    """Handler attribute built by its extension on first access
+
+    Extensions register a factory with set_lazy_attribute() in before(), so
+    a handler which never reads the attribute never pays for it.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, handler, owner):
+        if handler is None:
+            return self
+        try:
+            factory = handler._lazy_factories[self.name]
+        except (AttributeError, KeyError):
+            raise AttributeError(self.name)
+        # kept until it succeeds, a later read raises the same error again
+        # rather than an AttributeError hiding it
+        value = factory()
+        del handler._lazy_factories[self.name]
+        # shadows the descriptor, later reads are plain attribute lookups
+        handler.__dict__[self.name] = value
+        return value
+
+
+def set_lazy_attribute(handler, name, factory):
+    """Let factory build handler.<name> when it is first read
+
+    Handlers without a lazy_attribute of that name get it built right away.
+    """
+    if isinstance(getattr(handler.__class__, name, None), lazy_attribute):
+        if '_lazy_factories' not in handler.__dict__:
+            handler._lazy_factories = {}
+        handler._lazy_factories[name] = factory
+    else:
+        setattr(handler, name, factory())
+
+
 class BaseHandler(tornado.web.RequestHandler):
     """ Base request handler of whirly framework.
     """
+    # names of the extensions applied to this handler, None applies all the
+    # configured extensions. see whirly.extensions.base.with_extensions
+    extensions = None
+
+    # pass the request body to data_received() chunk by chunk instead of
+    # buffering it, see whirly.httpserver
+    stream_request_body = False
+    # largest request body accepted in bytes, None for the max_body_size
+    # setting
+    max_body_size = None
+
+    # answer GET with a weak ETag, and GET and HEAD with 304 Not Modified
+    # when the client has the response already, see finish()
+    conditional_get = True
+
+    # iterable the WSGI server sends as the body instead of the written
+    # chunks, see whirly.wsgi
+    wsgi_body = None
+
+    # built by the session, auth and flash extensions on first access
+    session = lazy_attribute('session')
+    auth = lazy_attribute('auth')
+    user = lazy_attribute('user')
+    flash = lazy_attribute('flash')
+
     def render_string(self, template_name, **kwargs):
-        return self.application.template_engine.render_string(template_name,
-            self, **kwargs)
+        with tracing.span('render_string', 'template', template=template_name):
+            return self.application.template_engine.render_string(
+                template_name, self, **kwargs)
+
+    def static_url(self, path):
+        """The url of the fingerprinted copy of path when it is in the static
+        manifest, tornado's hashed url otherwise
+        """
+        manifest = self.application.static_manifest
+        name = manifest and manifest.get(path)
+        if name is None:
+            return super(BaseHandler, self).static_url(path)
+        if getattr(self, "include_host", False):
+            base = self.request.protocol + "://" + self.request.host
+        else:
+            base = ""
+        return base + self.settings.get('static_url_prefix',
+                                        '/static/') + name
+
+    def static_bundle(self, name):
+        """The tags loading the static bundle name, see whirly.bundles
+        """
+        return bundle_tags(self, name)
+
+    def data_received(self, chunk):
+        """Called with every chunk of the body when stream_request_body is
+        set, the handler method runs once the body is complete
+        """
+        raise NotImplementedError
+
+    def run_in_thread(self, fn, *args, **kwargs):
+        """Runs fn in the default thread pool of the application
+
+        Returns a whirly.concurrent.Future, in an asynchronous handler:
+
+            future = self.run_in_thread(slow_query, user_id)
+            future.add_done_callback(self.async_callback(self.on_result))
+
+        """
+        return self.application.get_executor().submit(fn, *args, **kwargs)
+
+    def run_in_process(self, fn, *args, **kwargs):
+        """Like run_in_thread, for CPU bound module level functions
+        """
+        return self.application.get_executor('process').submit(fn, *args,
+                                                                **kwargs)
+
+    def check_not_modified(self, etag=None, last_modified=None):
+        """Sets the validators of the response and finishes it with 304 Not
+        Modified when the client has it already
+
+        Call it before rendering anything, the body is not needed:
+
+            post = self.db.get_post(post_id)
+            if self.check_not_modified(etag=post.version,
+                                       last_modified=post.updated):
+                return
+
+        etag is any value changing with the response, last_modified a
+        datetime in UTC or a timestamp. Returns True when the response is
+        finished.
+        """
+        if etag is not None:
+            etag = str(etag)
+            if not (etag.startswith('"') or etag.startswith('W/"')):
+                etag = 'W/"%s"' % etag.replace('"', '')
+            self.set_header("Etag", etag)
+        if last_modified is not None:
+            if isinstance(last_modified, (int, long, float)):
+                last_modified = datetime.datetime.utcfromtimestamp(
+                    last_modified)
+            self.set_header("Last-Modified", last_modified)
+        if self.request.method not in ("GET", "HEAD") or \
+           not self._request_not_modified():
+            return False
+        self.set_status(304)
+        self.finish()
+        return True
+
+    def finish(self, chunk=None):
+        if chunk is not None:
+            self.write(chunk)
+        if self.wsgi_body is not None:
+            # the length and the ETag of the body are not known
+            self._headers_written = True
+        if self.conditional_get and not self._headers_written and \
+           self._status_code == 200 and \
+           self.request.method in ("GET", "HEAD"):
+            # the cache decorator and check_not_modified() set it without
+            # looking at the body
+            if "Etag" not in self._headers and self.request.method == "GET":
+                self.set_header("Etag", utils.weak_etag(self._write_buffer))
+            if self._request_not_modified():
+                self._write_buffer = []
+                self.set_status(304)
+            elif "Etag" not in self._headers:
+                # a HEAD has no body to hash, its ETag would never match
+                # the one of the GET
+                self._headers["Etag"] = _NO_ETAG
+        super(BaseHandler, self).finish()
+        if self._headers.get("Etag") == _NO_ETAG:
+            # under WSGI, the headers are sent after finish()
+            del self._headers["Etag"]
+
+    def flush(self, include_footers=False):
+        if self._headers.get("Etag") == _NO_ETAG:
+            del self._headers["Etag"]
+        super(BaseHandler, self).flush(include_footers)
+
+    def _request_not_modified(self):
+        headers = self.request.headers
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            etag = self._headers.get("Etag")
+            return etag is not None and \
+                utils.etag_matches(if_none_match, etag)
+        if_modified_since = headers.get("If-Modified-Since")
+        last_modified = self._headers.get("Last-Modified")
+        if if_modified_since is not None and last_modified is not None:
+            return utils.not_modified_since(if_modified_since, last_modified)
+        return False
 
     def send_error(self, status_code=500, **kwargs):
         e = kwargs.get('exception', Exception())
-        format_exc = traceback.format_exc().splitlines()
+        format_exc = capture_traceback()
         response = None
         if isinstance(e, tornado.web.HTTPError):
             response = e.response
@@ -62,34 +278,76 @@ class BaseHandler(tornado.web.RequestHandler):
 
 
 class ErrorPage(BaseHandler):
+    # compiled once, error.html does not change at runtime
+    _template = None
+    # status code -> body of the error page without message or traceback
+    _static_bodies = {}
+    # set for the message of an HTTPError, meant for the client, the
+    # others are the text of an exception
+    public_message = False
+
     def __init__(self, application, request, status_code, message=None,
                  format_exc=[]):
         super(ErrorPage, self).__init__(application, request)
         self.set_status(status_code)
         self.status_message = message
         self.format_exc = format_exc
-        self.is_debug = project.setting('application', 'debug', True)
+        self.is_debug = is_debug()
         self._headers.update(utils.no_cache_headers())
 
-    def get(self):
-        title = httplib.responses[self._status_code]
-        title = "%d %s" % (self._status_code, title)
-        if self.status_message:
-            title = "%s: %s" % (title, self.status_message)
-        traceback_info  = "<br />".join(self.format_exc)
-
-        # is there has some way to custom template load path
-        # write more method in handler XXX
-        tmpl_path = os.path.join(os.path.dirname(__file__), 'templates')
-        tmpl  = tornado.template.Loader(tmpl_path).load("error.html")
-        args = dict(
-            handler=self,
-            request=self.request,
+    @classmethod
+    def template(cls):
+        if ErrorPage._template is None:
+            # is there has some way to custom template load path
+            # write more method in handler XXX
+            tmpl_path = os.path.join(os.path.dirname(__file__), 'templates')
+            ErrorPage._template = tornado.template.Loader(tmpl_path).load(
+                "error.html")
+        return ErrorPage._template
+
+    @classmethod
+    def render_page(cls, status_code, message=None, format_exc=(),
+                    debug=False, handler=None, request=None):
+        title = httplib.responses.get(status_code, "Unknown")
+        title = "%d %s" % (status_code, title)
+        if message:
+            title = "%s: %s" % (title, message)
+        return cls.template().generate(
+            handler=handler,
+            request=request,
             title=title,
-            traceback_info=traceback_info,
-            is_debug=self.is_debug,
+            traceback_info="<br />".join(format_exc),
+            is_debug=debug,
         )
-        self.finish(tmpl.generate(**args))
+
+    @classmethod
+    def prerender(cls, status_codes=PRERENDERED_STATUS_CODES):
+        """Renders the bodies served for errors when debug is off
+        """
+        for status_code in status_codes:
+            ErrorPage._static_bodies[status_code] = cls.render_page(
+                status_code)
+
+    def get(self):
+        if self.is_debug:
+            self.finish(self.render_page(self._status_code,
+                self.status_message, self.format_exc, self.is_debug, self,
+                self.request))
+            return
+        if self.status_message:
+            if self.public_message and self._status_code < 500:
+                self.finish(self.render_page(self._status_code,
+                                             self.status_message))
+                return
+            # may hold internals, it is not shown to the client
+            logging.debug("%d %s: %s", self._status_code, self.request.uri,
+                          self.status_message)
+        body = self._static_bodies.get(self._status_code)
+        if body is None:
+            body = self.render_page(self._status_code)
+            if self._status_code in httplib.responses:
+                ErrorPage._static_bodies[self._status_code] = body
+        self.finish(body)
 
 
 ### EOF ###
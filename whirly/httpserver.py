@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""HTTP server reading request bodies in chunks
+
+tornado reads the whole body into memory before the request is handled.
+Once the headers are read, HTTPConnection asks the application what to do
+with the body (Application.body_policy):
+
+* reject it with 413 when Content-Length is over the limit of the route,
+  before reading any of it
+* pass it chunk by chunk to handler.data_received() for handlers which set
+  stream_request_body, the handler method runs once the body is complete
+* parse multipart/form-data incrementally, file parts bigger than
+  upload_spool_size are written to temporary files
+* otherwise buffer it like tornado does
+
+Application settings:
+
+    max_body_size       largest request body accepted in bytes, handlers can
+                        set their own. Defaults to the 100MB buffer limit of
+                        tornado, streamed bodies have no default limit
+    upload_spool_size   file parts above this many bytes go to disk, 1MB
+    upload_tmp_dir      where they go, the system temporary directory
+"""
+
+
+__all__ = ['HTTPServer', 'HTTPConnection', 'BodyStream', 'MultipartParser',
+           'MultipartReceiver', 'UploadedFile', 'multipart_boundary',
+           'FakeConnection']
+
+
+import sys
+import errno
+import socket
+import logging
+import tempfile
+
+from tornado import httputil
+from tornado import iostream
+from tornado import httpserver
+from tornado.httpserver import HTTPRequest, _BadRequestException
+
+try:
+    import ssl # Python 2.6+
+except ImportError:
+    ssl = None
+
+
+# bytes read from the socket at a time for streamed bodies
+CHUNK_SIZE = 64 * 1024
+
+# a part whose headers are longer is malformed
+MAX_PART_HEADERS = 16 * 1024
+
+
+def multipart_boundary(content_type):
+    """The boundary of a multipart/form-data content type, or None
+    """
+    if not content_type.startswith("multipart/form-data"):
+        return None
+    for field in content_type.split(";"):
+        k, sep, v = field.strip().partition("=")
+        if k == "boundary" and v:
+            # the standard allows for the boundary to be quoted
+            if v.startswith('"') and v.endswith('"'):
+                v = v[1:-1]
+            return v
+    logging.warning("Invalid multipart/form-data")
+    return None
+
+
+class MultipartParser(object):
+    """Incremental multipart/form-data parser
+
+    feed() takes the body in chunks of any size and calls part_begin(headers)
+    at the start of every part, part_data(data) with its content, and
+    part_end() after it. At most one delimiter worth of data is buffered.
+    """
+    def __init__(self, boundary, part_begin, part_data, part_end):
+        self.part_begin = part_begin
+        self.part_data = part_data
+        self.part_end = part_end
+        self._delimiter = '--' + boundary
+        self._separator = '\r\n--' + boundary
+        self._buffer = ''
+        self._state = 'preamble'
+
+    def feed(self, data):
+        buf = self._buffer + data
+        while True:
+            if self._state == 'preamble':
+                i = buf.find(self._delimiter)
+                if i == -1:
+                    buf = buf[-len(self._delimiter):]
+                    break
+                buf = buf[i + len(self._delimiter):]
+                self._state = 'delimiter'
+            elif self._state == 'delimiter':
+                if len(buf) < 2:
+                    break
+                if buf.startswith('--'):
+                    self._state = 'done'
+                elif buf.startswith('\r\n'):
+                    buf = buf[2:]
+                    self._state = 'headers'
+                else:
+                    logging.warning("Invalid multipart/form-data")
+                    self._state = 'done'
+            elif self._state == 'headers':
+                i = buf.find('\r\n\r\n')
+                if i == -1:
+                    if len(buf) > MAX_PART_HEADERS:
+                        logging.warning("multipart/form-data part headers "
+                                        "too long")
+                        self._state = 'done'
+                    break
+                headers = httputil.HTTPHeaders.parse(buf[:i])
+                buf = buf[i + 4:]
+                self._state = 'body'
+                self.part_begin(headers)
+            elif self._state == 'body':
+                i = buf.find(self._separator)
+                if i == -1:
+                    # the tail may be the start of a separator
+                    keep = len(self._separator) - 1
+                    if len(buf) > keep:
+                        self.part_data(buf[:-keep])
+                        buf = buf[-keep:]
+                    break
+                if i:
+                    self.part_data(buf[:i])
+                buf = buf[i + len(self._separator):]
+                self._state = 'delimiter'
+                self.part_end()
+            else:
+                buf = ''
+                break
+        self._buffer = buf
+
+
+class UploadedFile(dict):
+    """An uploaded file spooled to disk
+
+    Has the keys of tornado's request.files entries plus file (open and at
+    its start), path and size. body is read from the file on first access.
+    """
+    def __missing__(self, key):
+        if key != 'body':
+            raise KeyError(key)
+        self['file'].seek(0)
+        body = self['body'] = self['file'].read()
+        self['file'].seek(0)
+        return body
+
+
+class MultipartReceiver(object):
+    """Fills request.arguments and request.files while the body comes in
+    """
+    # the request is handled once the body is complete
+    dispatch_first = False
+
+    def __init__(self, request, boundary, spool_size=1024 * 1024,
+                 tmp_dir=None):
+        self.request = request
+        self.spool_size = spool_size
+        self.tmp_dir = tmp_dir
+        self._parser = MultipartParser(boundary, self._part_begin,
+                                       self._part_data, self._part_end)
+        self.data_received = self._parser.feed
+        self._part = None
+
+    def _part_begin(self, headers):
+        name_values = {}
+        name_header = headers.get("Content-Disposition", "")
+        if name_header.startswith("form-data;"):
+            for name_part in name_header[10:].split(";"):
+                name, sep, name_value = name_part.strip().partition("=")
+                if sep:
+                    name_values[name] = name_value.strip('"').decode("utf-8")
+        else:
+            logging.warning("Invalid multipart/form-data")
+        ctype = headers.get("Content-Type", "application/unknown")
+        self._part = name_values, ctype
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def _part_data(self, data):
+        self._size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._chunks.append(data)
+        if self._size > self.spool_size and self._part[0].get("filename"):
+            self._file = tempfile.NamedTemporaryFile(prefix='whirly-upload-',
+                                                     dir=self.tmp_dir)
+            self._file.write(''.join(self._chunks))
+            self._chunks = []
+
+    def _part_end(self):
+        name_values, ctype = self._part
+        name = name_values.get("name")
+        if not name:
+            logging.warning("multipart/form-data value missing name")
+        elif name_values.get("filename"):
+            if self._file is not None:
+                self._file.flush()
+                self._file.seek(0)
+                entry = UploadedFile(filename=name_values["filename"],
+                                     content_type=ctype, file=self._file,
+                                     path=self._file.name, size=self._size)
+            else:
+                entry = dict(filename=name_values["filename"],
+                             body=''.join(self._chunks), content_type=ctype)
+            self.request.files.setdefault(name, []).append(entry)
+        else:
+            self.request.arguments.setdefault(name, []).append(
+                ''.join(self._chunks))
+        self._part = self._file = None
+        self._chunks = []
+
+    def finish(self):
+        pass
+
+
+class BodyStream(object):
+    """Passes the body to handler.data_received() chunk by chunk
+
+    The request is handled right after its headers, chunks read before the
+    handler is ready are kept until attach(). An exception raised by
+    data_received() is raised again by rethrow(), once the body is read.
+    """
+    dispatch_first = True
+
+    def __init__(self):
+        self.handler = None
+        self.finished = False
+        self._pending = []
+        self._on_complete = None
+        self._exc_info = None
+
+    def attach(self, handler, on_complete):
+        """Starts passing chunks to handler, on_complete() is called once
+        the body is complete
+        """
+        self.handler = handler
+        self._on_complete = on_complete
+        pending, self._pending = self._pending, []
+        for chunk in pending:
+            self._deliver(chunk)
+        if self.finished:
+            self._complete()
+
+    def data_received(self, chunk):
+        if self.handler is None:
+            self._pending.append(chunk)
+        else:
+            self._deliver(chunk)
+
+    def finish(self):
+        self.finished = True
+        if self.handler is not None:
+            self._complete()
+
+    def rethrow(self):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def _deliver(self, chunk):
+        if self._exc_info is not None:
+            return
+        try:
+            self.handler.data_received(chunk)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def _complete(self):
+        on_complete, self._on_complete = self._on_complete, None
+        if on_complete is not None:
+            on_complete()
+
+
+class HTTPConnection(httpserver.HTTPConnection):
+    """tornado's HTTPConnection asking the application what to do with the
+    body
+    """
+    _receiver = None
+    _remaining = 0
+
+    def _on_headers(self, data):
+        try:
+            eol = data.find("\r\n")
+            start_line = data[:eol]
+            try:
+                method, uri, version = start_line.split(" ")
+            except ValueError:
+                raise _BadRequestException("Malformed HTTP request line")
+            if not version.startswith("HTTP/"):
+                raise _BadRequestException("Malformed HTTP version in HTTP Request-Line")
+            headers = httputil.HTTPHeaders.parse(data[eol:])
+            self._request = HTTPRequest(
+                connection=self, method=method, uri=uri, version=version,
+                headers=headers, remote_ip=self.address[0])
+
+            content_length = headers.get("Content-Length")
+            if content_length:
+                content_length = int(content_length)
+                self._read_body(content_length)
+                return
+
+            self.request_callback(self._request)
+        except _BadRequestException, e:
+            logging.info("Malformed HTTP request from %s: %s",
+                         self.address[0], e)
+            self.stream.close()
+            return
+
+    def _read_body(self, content_length):
+        limit, receiver = None, None
+        body_policy = getattr(self.request_callback, 'body_policy', None)
+        if body_policy is not None:
+            limit, receiver = body_policy(self._request)
+        if limit is None and (receiver is None or
+                              not receiver.dispatch_first):
+            limit = self.stream.max_buffer_size
+        if limit is not None and content_length > limit:
+            logging.warning("Rejected %d bytes body of %s %s from %s",
+                            content_length, self._request.method,
+                            self._request.uri, self.address[0])
+            self._request = None
+            self.stream.write("HTTP/1.1 413 Request Entity Too Large\r\n"
+                              "Connection: close\r\n"
+                              "Content-Length: 0\r\n\r\n", self.stream.close)
+            return
+        if self._request.headers.get("Expect") == "100-continue":
+            self.stream.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+        if receiver is None:
+            self.stream.read_bytes(content_length, self._on_request_body)
+            return
+
+        self._receiver = receiver
+        self._remaining = content_length
+        if receiver.dispatch_first:
+            self.request_callback(self._request)
+        if self._receiver is not None:
+            self._read_chunk()
+
+    def _read_chunk(self):
+        self.stream.read_bytes(min(CHUNK_SIZE, self._remaining),
+                               self._on_chunk)
+
+    def _on_chunk(self, chunk):
+        self._remaining -= len(chunk)
+        self._receiver.data_received(chunk)
+        if self._remaining:
+            self._read_chunk()
+            return
+        receiver, self._receiver = self._receiver, None
+        receiver.finish()
+        if not receiver.dispatch_first:
+            self.request_callback(self._request)
+
+    def _finish_request(self):
+        if self._receiver is not None:
+            # answered before the body was read, the rest of it is still
+            # on the wire so the connection can not be reused
+            self._receiver = None
+            self.no_keep_alive = True
+        super(HTTPConnection, self)._finish_request()
+
+
+class _FakeStream(object):
+    socket = None
+
+    def set_close_callback(self, callback):
+        pass
+
+    def closed(self):
+        return False
+
+
+class FakeConnection(object):
+    """Stands in for HTTPConnection for requests run inside the process,
+    by whirly.bench and the cache refreshes: the response is counted, not
+    sent
+    """
+    xheaders = False
+
+    def __init__(self):
+        self.stream = _FakeStream()
+        self.no_keep_alive = False
+        self.bytes_written = 0
+        self.finished = False
+        self.on_finish = None
+
+    def write(self, chunk, callback=None):
+        self.bytes_written += len(chunk)
+        if callback is not None:
+            callback()
+
+    def finish(self):
+        self.finished = True
+        if self.on_finish is not None:
+            self.on_finish()
+
+
+class HTTPServer(httpserver.HTTPServer):
+    """tornado's HTTPServer with whirly's HTTPConnection
+    """
+    def _handle_events(self, fd, events):
+        while True:
+            try:
+                connection, address = self._socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            if self.ssl_options is not None:
+                assert ssl, "Python 2.6+ and OpenSSL required for SSL"
+                try:
+                    connection = ssl.wrap_socket(connection,
+                                                 server_side=True,
+                                                 do_handshake_on_connect=False,
+                                                 **self.ssl_options)
+                except ssl.SSLError, err:
+                    if err.args[0] == ssl.SSL_ERROR_EOF:
+                        return connection.close()
+                    else:
+                        raise
+                except socket.error, err:
+                    if err.args[0] == errno.ECONNABORTED:
+                        return connection.close()
+                    else:
+                        raise
+            try:
+                if self.ssl_options is not None:
+                    stream = iostream.SSLIOStream(connection,
+                                                  io_loop=self.io_loop)
+                else:
+                    stream = iostream.IOStream(connection, io_loop=self.io_loop)
+                HTTPConnection(stream, address, self.request_callback,
+                               self.no_keep_alive, self.xheaders)
+            except:
+                logging.error("Error in connection callback", exc_info=True)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
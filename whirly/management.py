@@ -14,6 +14,24 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+"""Running a project
+
+A project script calls run(settings_module) to serve the application, or
+execute(settings_module) to run the command named on the command line.
+WSGI servers get the application from wsgi_application(settings_module).
+The `whirly` script does the same for a settings module given by name:
+
+    whirly <command> <project>.settings [arguments]
+
+Commands:
+
+    serve           serve the application, the default
+    build_static    write the static bundles, the fingerprinted copies of
+                    the static files and their manifest, and the compressed
+                    variants
+    bench           measure the request pipeline in process, see
+                    whirly.bench
+"""
 
 
 import os
@@ -32,8 +50,24 @@ from whirly.options import enable_pretty_logging
 from whirly import project
 
 
-def run(settings_module):
+def load_settings(settings_module):
+    """Returns the settings of all the sections of settings_module merged
+    into one dict, the way the application gets them
+    """
+    d  = settings_module.__dict__
+    settings_data  = [d[s] for s in d if not (s.startswith('__') or
+                                              s=='extensions')]
+    logging.debug("Settings data: ")
+    logging.debug(settings_data)
+    settings = dict()
+    for setting in settings_data:
+        settings.update(setting)
+    return settings
+
 
+def _application_args(settings_module):
+    """Returns the handlers, extensions and settings of the application
+    """
     # Set project environment
     project.set_project_environment(settings_module)
 
@@ -42,15 +76,8 @@ def run(settings_module):
     __import__(urls_module_name)
     urls_module = sys.modules[urls_module_name]
 
-    d  = settings_module.__dict__
-    extensions_settings  = d.get('extensions')
-    settings_data  = [d[s] for s in d if not (s.startswith('__') or
-                                              s=='extensions')]
-    logging.debug("Settings data: ")
-    logging.debug(settings_data)
-    settings = dict()
-    for setting in settings_data:
-        settings.update(setting)
+    extensions_settings  = settings_module.__dict__.get('extensions')
+    settings = load_settings(settings_module)
 
     settings['error_page'] = urls_module.__dict__.get('error_page', None)
     handlers = urls_module.__dict__.get('routes', None)
@@ -66,37 +93,179 @@ def run(settings_module):
     log_level = settings.get('logging', 'info')
     # XXX
     logging.getLogger().setLevel(getattr(logging, log_level.upper()))
+    return handlers, extensions, settings
+
+
+def wsgi_application(settings_module):
+    """The application for a WSGI server, in the project's wsgi module:
+
+        import whirly.management
+        import myproject.settings
+        application = whirly.management.wsgi_application(myproject.settings)
+    """
+    from whirly.wsgi import WSGIApplication
+
+    handlers, extensions, settings = _application_args(settings_module)
+    settings['serve_type'] = 'wsgi'
+    return WSGIApplication(handlers=handlers, extensions=extensions,
+                           **settings)
+
+
+def run(settings_module):
+    handlers, extensions, settings = _application_args(settings_module)
 
     serve_type = settings.get('serve_type', 'tornado')
     if serve_type == 'wsgi':
         from whirly.wsgi import WSGIApplication
-        # import wsgiref.handlers
-        from google.appengine.ext.webapp.util import run_wsgi_app
 
         application = WSGIApplication(
             handlers=handlers,
             extensions=extensions,
             **settings
         )
-        # wsgiref.handlers.CGIHandler().run(application)
-        run_wsgi_app(application)
+        if os.environ.get('SERVER_SOFTWARE', '').startswith(
+                ('Google App Engine', 'Development')):
+            from google.appengine.ext.webapp.util import run_wsgi_app
+            run_wsgi_app(application)
+        elif 'GATEWAY_INTERFACE' in os.environ:
+            import wsgiref.handlers
+            wsgiref.handlers.CGIHandler().run(application)
+        else:
+            # for development, production servers import wsgi_application()
+            from wsgiref.simple_server import make_server
+            enable_pretty_logging()
+            port = settings.get('port', 8888)
+            logging.info("WSGI server served at port %d" % port)
+            make_server('', port, application).serve_forever()
     else:
-        import tornado.httpserver
         import tornado.ioloop
+        import whirly.httpserver
         from whirly.web import Application
+        from whirly.process import Supervisor, inherited_socket, \
+                install_graceful_stop, install_graceful_restart, \
+                stop_old_master
 
         enable_pretty_logging()
 
+        # 1 serves in this process, 0 forks one worker per core
+        processes = settings.get('processes', 1)
+        if processes != 1 and settings.get('debug'):
+            logging.warning("Multiple processes are not compatible with "
+                            "debug mode, serving in a single process")
+            processes = 1
+
         # Create application
         application = Application(
             handlers=handlers,
             extensions=extensions,
             **settings
         )
-        http_server = tornado.httpserver.HTTPServer(application)
-        http_server.listen(options.port)
+        http_server = whirly.httpserver.HTTPServer(application)
+        # seconds given to in-flight requests on SIGQUIT and restarts
+        graceful_timeout = settings.get('graceful_timeout', 30)
+        listen_socket = inherited_socket()
+        if listen_socket is not None:
+            # graceful restart, the old master keeps serving on it until
+            # we are up
+            http_server._socket = listen_socket
+        else:
+            http_server.bind(options.port)
         logging.info("Server served at port %d" % options.port)
-        tornado.ioloop.IOLoop.instance().start()
+        if processes == 1:
+            http_server.start(1)
+            io_loop = tornado.ioloop.IOLoop.instance()
+            install_graceful_stop(http_server, application, graceful_timeout,
+                                  io_loop)
+            install_graceful_restart(http_server._socket.fileno())
+            stop_old_master()
+            io_loop.start()
+            return
+
+        # compile templates before forking, workers share them copy-on-write
+        template_engine = getattr(application, 'template_engine', None)
+        if template_engine is not None:
+            template_engine.preload()
+
+        def worker(task_id):
+            http_server.start(1)
+            io_loop = tornado.ioloop.IOLoop.instance()
+            install_graceful_stop(http_server, application, graceful_timeout,
+                                  io_loop)
+            io_loop.start()
+
+        Supervisor(processes, worker, http_server._socket.fileno(),
+                   graceful_timeout).run()
+
+
+def build_static(settings_module, args):
+    from whirly.static import build_manifest, precompress, MANIFEST_NAME
+    from whirly.bundles import build_bundles
+
+    enable_pretty_logging()
+    project.set_project_environment(settings_module)
+    settings = load_settings(settings_module)
+    log_level = settings.get('logging', 'info')
+    logging.getLogger().setLevel(getattr(logging, log_level.upper()))
+    static_path = settings.get('static_path') or project.static_directory()
+    if not os.path.isdir(static_path):
+        logging.error("Static directory %s does not exist." % static_path)
+        sys.exit(1)
+    try:
+        build_bundles(static_path, settings.get('static_bundles', {}))
+    except (IOError, ValueError), e:
+        logging.error("Could not build the static bundles: %s" % e)
+        sys.exit(1)
+    manifest_path = settings.get('static_manifest',
+                                 os.path.join(static_path, MANIFEST_NAME))
+    manifest = build_manifest(static_path, manifest_path)
+    logging.info("%d static files in %s" % (len(manifest), manifest_path))
+    written = precompress(static_path)
+    logging.info("%d compressed static files written" % written)
+
+
+def _bench(settings_module, args):
+    from whirly.bench import benchmark
+    benchmark(settings_module, args)
+
+
+COMMANDS = {
+    'serve': lambda settings_module, args: run(settings_module),
+    'build_static': build_static,
+    'bench': lambda settings_module, args: _bench(settings_module, args),
+}
+
+
+def execute(settings_module, argv=None):
+    """Runs the command named by argv[1], serve by default
+    """
+    if argv is None:
+        argv = sys.argv
+    name = 'serve'
+    args = list(argv[1:])
+    if args and not args[0].startswith('-'):
+        name = args.pop(0)
+    command = COMMANDS.get(name)
+    if command is None:
+        logging.error("Unknown command %s, the commands are: %s" % (
+            name, ', '.join(sorted(COMMANDS))))
+        sys.exit(1)
+    command(settings_module, args)
+
+
+def main(argv=None):
+    """Entry point of the whirly script
+    """
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 3:
+        logging.error("Usage: whirly <command> <project>.settings "
+                      "[arguments]\nCommands: %s" % ', '.join(sorted(COMMANDS)))
+        sys.exit(1)
+    # the project is looked up from the current directory
+    sys.path.insert(0, os.getcwd())
+    settings_module_name = argv[2]
+    __import__(settings_module_name)
+    execute(sys.modules[settings_module_name], [argv[0], argv[1]] + argv[3:])
 
 
 ### EOF ###
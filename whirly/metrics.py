@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Request metrics in the prometheus text format
+
+Counters and histograms are updated without locks: they are updated from
+the IOLoop, but also from the storage threads and by threaded WSGI
+servers, so every thread adds to plain integers of its own, summed when
+the metrics are rendered. Histograms have fixed buckets, so recording a
+request is a bisect and two additions.
+
+Application settings:
+
+    metrics             True to collect metrics
+    metrics_url         where they are served, defaults to /_whirly/metrics
+    metrics_buckets     latency histogram upper bounds, in seconds
+"""
+
+
+__all__ = ['Counter', 'Histogram', 'Metrics', 'MetricsHandler']
+
+
+import time
+import bisect
+
+from thread import get_ident
+
+from whirly.handlers import BaseHandler
+
+
+# upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+SESSION_STORE_OPERATIONS = ('contains', 'get', 'set', 'delete', 'cleanup')
+
+_KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "DELETE", "PUT",
+                            "OPTIONS", "PATCH"))
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items()))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    __slots__ = ('_shards',)
+
+    def __init__(self):
+        # thread id -> [value], a thread only adds to its own
+        self._shards = {}
+
+    def inc(self, amount=1):
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            shard = self._shards.setdefault(get_ident(), [0])
+        shard[0] += amount
+
+    @property
+    def value(self):
+        return sum(shard[0] for shard in self._shards.values())
+
+
+class Histogram(object):
+    __slots__ = ('bounds', '_shards')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        # thread id -> [counts, sum], the last bucket is +Inf
+        self._shards = {}
+
+    def observe(self, value):
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            shard = self._shards.setdefault(
+                get_ident(), [[0] * (len(self.bounds) + 1), 0.0])
+        shard[0][bisect.bisect_left(self.bounds, value)] += 1
+        shard[1] += value
+
+    @property
+    def counts(self):
+        counts = [0] * (len(self.bounds) + 1)
+        for shard in self._shards.values():
+            for i, count in enumerate(shard[0]):
+                counts[i] += count
+        return counts
+
+    @property
+    def sum(self):
+        return sum(shard[1] for shard in self._shards.values())
+
+    def cumulative(self):
+        """Yields (upper bound, count) pairs, the way prometheus wants them
+        """
+        counts = self.counts
+        total = 0
+        for bound, count in zip(self.bounds, counts):
+            total += count
+            yield _number(bound), total
+        yield '+Inf', total + counts[-1]
+
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._latency = {}
+        self._requests = {}
+        self.cache = {'hit': Counter(), 'miss': Counter(),
+                      'coalesced': Counter(), 'stale': Counter()}
+        self.session_store = dict((op, Counter())
+                                  for op in SESSION_STORE_OPERATIONS)
+        # name -> whirly.concurrent pool, read when rendering
+        self.executors = {}
+        self._executor_wait = {}
+        # whirly.pagecache.PageCache, read when rendering
+        self.page_cache = None
+
+    def observe_executor_wait(self, name, seconds):
+        histogram = self._executor_wait.get(name)
+        if histogram is None:
+            histogram = self._executor_wait.setdefault(
+                name, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    def observe_request(self, route, method, status, seconds):
+        # setdefault keeps the first of two threads creating it
+        histogram = self._latency.get(route)
+        if histogram is None:
+            histogram = self._latency.setdefault(route,
+                                                 Histogram(self.buckets))
+        histogram.observe(seconds)
+
+        if method not in _KNOWN_METHODS:
+            # keep the label set bounded
+            method = 'OTHER'
+        key = (route, method, status)
+        counter = self._requests.get(key)
+        if counter is None:
+            counter = self._requests.setdefault(key, Counter())
+        counter.inc()
+
+    def render(self):
+        """Returns all metrics in the prometheus text exposition format
+        """
+        lines = []
+        lines.append('# HELP whirly_uptime_seconds Seconds since the '
+                     'application started.')
+        lines.append('# TYPE whirly_uptime_seconds gauge')
+        lines.append('whirly_uptime_seconds %s' %
+                     _number(time.time() - self.started))
+
+        lines.append('# HELP whirly_requests_total Requests handled, by '
+                     'route pattern, method and status code.')
+        lines.append('# TYPE whirly_requests_total counter')
+        for (route, method, status), counter in sorted(self._requests.items()):
+            lines.append('whirly_requests_total{%s} %d' % (_labels(
+                route=route, method=method, status=status), counter.value))
+
+        lines.append('# HELP whirly_request_duration_seconds Request '
+                     'latency, by route pattern.')
+        lines.append('# TYPE whirly_request_duration_seconds histogram')
+        for route, histogram in sorted(self._latency.items()):
+            count = 0
+            for le, count in histogram.cumulative():
+                lines.append('whirly_request_duration_seconds_bucket{%s} %d' %
+                             (_labels(route=route, le=le), count))
+            lines.append('whirly_request_duration_seconds_sum{%s} %s' %
+                         (_labels(route=route), _number(histogram.sum)))
+            lines.append('whirly_request_duration_seconds_count{%s} %d' %
+                         (_labels(route=route), count))
+
+        lines.append('# HELP whirly_cache_requests_total Cache decorator '
+                     'lookups, by result.')
+        lines.append('# TYPE whirly_cache_requests_total counter')
+        for result, counter in sorted(self.cache.items()):
+            lines.append('whirly_cache_requests_total{%s} %d' % (
+                _labels(result=result), counter.value))
+
+        if self.page_cache is not None:
+            lines.append('# HELP whirly_page_cache_requests_total Page cache '
+                         'lookups, by result.')
+            lines.append('# TYPE whirly_page_cache_requests_total counter')
+            lines.append('whirly_page_cache_requests_total{%s} %d' % (
+                _labels(result='hit'), self.page_cache.hits))
+            lines.append('whirly_page_cache_requests_total{%s} %d' % (
+                _labels(result='miss'), self.page_cache.misses))
+
+        lines.append('# HELP whirly_session_store_operations_total Session '
+                     'store operations, by operation.')
+        lines.append('# TYPE whirly_session_store_operations_total counter')
+        for op, counter in sorted(self.session_store.items()):
+            lines.append('whirly_session_store_operations_total{%s} %d' % (
+                _labels(operation=op), counter.value))
+
+        lines.append('# HELP whirly_executor_queue_depth Calls waiting for '
+                     'a worker, by executor.')
+        lines.append('# TYPE whirly_executor_queue_depth gauge')
+        for name, pool in sorted(self.executors.items()):
+            lines.append('whirly_executor_queue_depth{%s} %d' % (
+                _labels(executor=name), pool.queue_depth()))
+
+        lines.append('# HELP whirly_executor_workers Threads or processes, '
+                     'by executor.')
+        lines.append('# TYPE whirly_executor_workers gauge')
+        for name, pool in sorted(self.executors.items()):
+            lines.append('whirly_executor_workers{%s} %d' % (
+                _labels(executor=name), pool.workers()))
+
+        lines.append('# HELP whirly_executor_rejected_total Calls refused '
+                     'because the queue was full, by executor.')
+        lines.append('# TYPE whirly_executor_rejected_total counter')
+        for name, pool in sorted(self.executors.items()):
+            lines.append('whirly_executor_rejected_total{%s} %d' % (
+                _labels(executor=name), pool.rejected))
+
+        lines.append('# HELP whirly_executor_wait_seconds Time calls waited '
+                     'in the queue, by executor.')
+        lines.append('# TYPE whirly_executor_wait_seconds histogram')
+        for name, histogram in sorted(self._executor_wait.items()):
+            count = 0
+            for le, count in histogram.cumulative():
+                lines.append('whirly_executor_wait_seconds_bucket{%s} %d' %
+                             (_labels(executor=name, le=le), count))
+            lines.append('whirly_executor_wait_seconds_sum{%s} %s' %
+                         (_labels(executor=name), _number(histogram.sum)))
+            lines.append('whirly_executor_wait_seconds_count{%s} %d' %
+                         (_labels(executor=name), count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHandler):
+    extensions = ()
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(self.application.metrics.render())
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
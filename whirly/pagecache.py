@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Full page cache checked before the handler is built
+
+A hit is answered by the application with the stored status, headers and
+body, no handler is created and no extension runs. Handlers opt in with
+their page_cache attribute, seconds or a dict:
+
+    class Home(BaseHandler):
+        page_cache = {
+            'timeout': 60,
+            # request headers the page depends on
+            'vary': ['Accept-Language'],
+            # query arguments the page depends on, None for all of them
+            'query': ['page'],
+            # False caches the pages of logged in users too
+            'anonymous_only': True,
+        }
+
+Pages are keyed on the host, the path, the sorted query arguments and the
+vary headers. Only complete 200 responses to GET without cookies are
+stored. A request carrying one of the private cookies, or an
+Authorization header, is private: it is neither served from nor stored in
+the cache when the page is anonymous only.
+
+Application settings:
+
+    page_cache_size             bytes of pages kept in memory by every
+                                process, 16MB default
+    page_cache_vary             request headers every cached page depends on
+    page_cache_private_cookies  cookies of the requests which are not
+                                anonymous, the session and flash cookies by
+                                default
+    page_cache_store            'memory', or 'cache' to share the pages
+                                through the backend of
+                                whirly.extensions.cache
+"""
+
+
+__all__ = ['PageCache', 'PagePolicy', 'MemoryStore', 'PageCapture',
+           'CachedPage', 'render_page', 'page_size']
+
+
+import time
+import Cookie
+import hashlib
+import httplib
+import logging
+import threading
+
+from tornado.web import OutputTransform
+
+from whirly.utils import etag_matches
+
+
+# response headers which describe the connection, not the page
+_HOP_BY_HOP = frozenset(['Connection', 'Keep-Alive', 'Transfer-Encoding'])
+
+
+class PagePolicy(object):
+    __slots__ = ('timeout', 'vary', 'query', 'anonymous_only')
+
+    def __init__(self, timeout=60, vary=(), query=None, anonymous_only=True):
+        self.timeout = timeout
+        self.vary = tuple(vary)
+        if query is not None:
+            query = frozenset(query)
+        self.query = query
+        self.anonymous_only = anonymous_only
+
+
+class MemoryStore(object):
+    """Values by key in this process, least recently used first out
+
+    sizeof(value) gives the bytes a value takes, the store holds up to
+    max_bytes of them, and up to max_entries values when it is set.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, sizeof=len,
+                 max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.bytes = 0
+        # key -> [expires, size, value, sequence of the last use]
+        self._entries = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self._sequence += 1
+            entry[3] = self._sequence
+            return entry[2]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout):
+        size = self.sizeof(value)
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._sequence += 1
+            self._entries[key] = [time.time() + timeout, size, value,
+                                  self._sequence]
+            self.bytes += size
+            if self.bytes > self.max_bytes or self._too_many():
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.bytes = 0
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key)[1]
+
+    def _too_many(self, fraction=1):
+        return self.max_entries is not None and \
+            len(self._entries) > self.max_entries * fraction
+
+    def _evict(self):
+        # one sort for a batch of evictions, down to 3/4 of the limits
+        now = time.time()
+        for key in [k for k, e in self._entries.iteritems() if e[0] < now]:
+            self._remove(key)
+        if self.bytes <= self.max_bytes and not self._too_many():
+            return
+        by_use = sorted(self._entries.iteritems(), key=lambda item: item[1][3])
+        for key, entry in by_use:
+            if self.bytes <= self.max_bytes * 3 / 4 and \
+               not self._too_many(0.75):
+                break
+            self._remove(key)
+
+
+class PageCapture(OutputTransform):
+    """Output transform keeping the headers and body of a response written
+    at once, the last transform of a request which may be stored
+    """
+    def __init__(self, request):
+        self.headers = None
+        self.body = None
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        if finishing:
+            self.headers = dict((name, value) for name, value
+                                in headers.iteritems()
+                                if name not in _HOP_BY_HOP)
+            self.body = chunk
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        # flushed in several parts, not stored
+        self.headers = self.body = None
+        return chunk
+
+
+class CachedPage(object):
+    """Stands in for the handler of a request answered from the cache, in
+    the request log, the metrics and the trace
+    """
+    def __init__(self, request, status_code):
+        self.request = request
+        self._status_code = status_code
+
+    def get_status(self):
+        return self._status_code
+
+    def _request_summary(self):
+        return self.request.method + " " + self.request.uri + " (" + \
+            self.request.remote_ip + ")"
+
+
+class PageCache(object):
+    def __init__(self, store, vary=(), private_cookies=('session_id',
+                 'flash_message'), encoding=None):
+        self.store = store
+        self.vary = tuple(vary)
+        self.private_cookies = tuple(private_cookies)
+        # encoding(request) -> the Content-Encoding the response will have
+        self.encoding = encoding
+        self.hits = 0
+        self.misses = 0
+        self._policies = {}
+
+    def policy(self, handler_class):
+        """The PagePolicy of handler_class, None if it is not cached
+        """
+        try:
+            return self._policies[handler_class]
+        except KeyError:
+            pass
+        config = getattr(handler_class, 'page_cache', None)
+        if config is None or config is False:
+            policy = None
+        elif isinstance(config, dict):
+            policy = PagePolicy(**config)
+        else:
+            policy = PagePolicy(timeout=config)
+        self._policies[handler_class] = policy
+        return policy
+
+    def key(self, request, policy):
+        """The key of the page requested, None when the request must not
+        be answered from the cache
+        """
+        if request.method not in ("GET", "HEAD"):
+            return None
+        headers = request.headers
+        if policy.anonymous_only and self._is_private(headers):
+            return None
+        parts = [request.host.lower(), request.path]
+        for name, values in sorted(request.arguments.iteritems()):
+            if policy.query is None or name in policy.query:
+                parts.append('%s=%s' % (name, '&'.join(values)))
+        for name in self.vary + policy.vary:
+            parts.append('%s:%s' % (name, headers.get(name, '')))
+        if self.encoding is not None:
+            parts.append(self.encoding(request))
+        return 'page:' + hashlib.md5('\n'.join(parts)).hexdigest()
+
+    def get(self, key):
+        page = self.store.get(key)
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    def store_response(self, key, policy, handler, capture):
+        """Stores the response of handler when it can be shared
+        """
+        request = handler.request
+        if capture.body is None or request.method != "GET" or \
+           handler.get_status() != 200 or getattr(handler, '_new_cookies',
+                                                  None):
+            return False
+        cache_control = capture.headers.get('Cache-Control', '')
+        if 'private' in cache_control or 'no-store' in cache_control:
+            return False
+        self.store.set(key, (200, capture.headers, capture.body),
+                       policy.timeout)
+        return True
+
+    def _is_private(self, headers):
+        if "Authorization" in headers:
+            return True
+        header = headers.get("Cookie")
+        if not header:
+            return False
+        cookies = Cookie.BaseCookie()
+        try:
+            cookies.load(header)
+        except Cookie.CookieError:
+            return True
+        for name in self.private_cookies:
+            if name in cookies:
+                return True
+        return False
+
+
+def page_size(page):
+    """The bytes a stored page takes, for MemoryStore
+    """
+    status_code, headers, body = page
+    return len(body) + sum(len(name) + len(str(value))
+                           for name, value in headers.iteritems())
+
+
+def render_page(request, page, extra_headers=()):
+    """The raw response to request for the stored page
+    """
+    status_code, headers, body = page
+    if_none_match = request.headers.get("If-None-Match")
+    etag = headers.get("Etag")
+    if if_none_match is not None and etag is not None:
+        if etag_matches(if_none_match, etag):
+            status_code, body = 304, ''
+    lines = ["%s %d %s" % (request.version, status_code,
+                           httplib.responses[status_code])]
+    lines.extend(["%s: %s" % item for item in headers.iteritems()])
+    lines.extend(["%s: %s" % item for item in extra_headers])
+    data = "\r\n".join(lines) + "\r\n\r\n"
+    if request.method != "HEAD" and status_code != 304:
+        data += body
+    return status_code, data
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Pre-fork worker processes
+
+The master process loads the application and binds the listening socket,
+then forks the workers and restarts any of them which dies. Everything
+loaded before the fork is shared copy-on-write by the workers. No IOLoop
+may be created in the master, each worker creates its own.
+
+Signals understood by the master:
+
+    TERM, INT   stop the workers right away and exit
+    QUIT        let the workers finish their requests, then exit
+    HUP         graceful restart: exec a new master sharing the listening
+                socket, it starts new workers and then sends QUIT to the
+                old master
+
+A server running in a single process understands QUIT and HUP the same
+way, see install_graceful_stop() and install_graceful_restart().
+"""
+
+
+__all__ = ['cpu_count', 'Supervisor', 'inherited_socket',
+           'install_graceful_stop', 'install_graceful_restart',
+           'stop_old_master']
+
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import signal
+import socket
+import random
+import logging
+
+
+LISTEN_FD_ENV = 'WHIRLY_LISTEN_FD'
+OLD_MASTER_ENV = 'WHIRLY_OLD_MASTER'
+
+
+def _set_cloexec(fd, on=True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if on:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def inherited_socket():
+    """Returns the listening socket handed over by a restarting master
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    fd = int(fd)
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    _set_cloexec(sock.fileno())
+    sock.setblocking(0)
+    logging.info("Listening socket inherited from the previous master")
+    return sock
+
+
+def exec_new_master(listen_fd):
+    """Forks and execs this program again, handing it listen_fd, returns
+    the pid of the new process
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _set_cloexec(listen_fd, False)
+            os.environ[LISTEN_FD_ENV] = str(listen_fd)
+            os.environ[OLD_MASTER_ENV] = str(os.getppid())
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def stop_old_master():
+    """Sends QUIT to the process which started this one on a graceful
+    restart, once this one serves
+    """
+    old_master = os.environ.pop(OLD_MASTER_ENV, None)
+    if not old_master:
+        return
+    logging.info("Graceful restart: stopping the previous master, pid %s" %
+                 old_master)
+    try:
+        os.kill(int(old_master), signal.SIGQUIT)
+    except OSError:
+        pass
+
+
+def install_graceful_restart(listen_fd):
+    """On SIGHUP exec a new server sharing listen_fd, for a server running
+    in a single process. The new one sends QUIT to this one when it
+    serves, see install_graceful_stop()
+    """
+    state = {'pid': None}
+
+    def on_hup(signum, frame):
+        pid = state['pid']
+        if pid is not None:
+            try:
+                done = os.waitpid(pid, os.WNOHANG)[0]
+            except OSError:
+                done = pid
+            if not done:
+                logging.warning("Graceful restart in progress, ignored")
+                return
+            logging.error("New server (pid %d) exited, graceful restart "
+                          "aborted" % pid)
+        state['pid'] = exec_new_master(listen_fd)
+        logging.info("Graceful restart: new server started, pid %d" %
+                     state['pid'])
+
+    signal.signal(signal.SIGHUP, on_hup)
+
+
+def install_graceful_stop(http_server, application, timeout, io_loop):
+    """On SIGQUIT stop accepting, let in-flight requests finish for up to
+    timeout seconds, then stop io_loop
+    """
+    def drain():
+        logging.info("Process %d stops accepting, %d requests in flight" %
+                     (os.getpid(), application.in_flight()))
+        http_server.stop()
+        application.drain()
+        deadline = time.time() + timeout
+
+        def check():
+            left = application.in_flight()
+            if left and time.time() < deadline:
+                io_loop.add_timeout(time.time() + 0.1, check)
+                return
+            if left:
+                logging.warning("Process %d gave up on %d requests" %
+                                (os.getpid(), left))
+            else:
+                logging.info("Process %d drained" % os.getpid())
+            io_loop.stop()
+        check()
+
+    def on_quit(signum, frame):
+        io_loop.add_callback(drain)
+
+    signal.signal(signal.SIGQUIT, on_quit)
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        return os.sysconf("SC_NPROCESSORS_CONF")
+    except (AttributeError, ValueError):
+        pass
+    logging.error("Could not detect number of processors; assuming 1")
+    return 1
+
+
+class Supervisor(object):
+    """Runs worker(task_id) in num_processes forked processes
+
+    A worker which exits or crashes is forked again with the same task id,
+    unless the supervisor is stopping. listen_fd is the listening socket
+    handed to the next master on a graceful restart.
+    """
+    # a worker dying sooner than this after its start is crash looping
+    min_uptime = 1.0
+
+    def __init__(self, num_processes, worker, listen_fd=None,
+                 graceful_timeout=30):
+        if not num_processes or num_processes <= 0:
+            num_processes = cpu_count()
+        self.num_processes = num_processes
+        self.worker = worker
+        self.listen_fd = listen_fd
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+        self.new_master = None
+
+    def run(self):
+        logging.info("Pre-forking %d server processes" % self.num_processes)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGQUIT, self._handle_graceful_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+        for task_id in range(self.num_processes):
+            self.spawn(task_id)
+
+        # the workers are started
+        stop_old_master()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._reap(pid, status)
+
+    def spawn(self, task_id):
+        """Forks a worker, the child process exits when the worker returns
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            # workers must not share the random state of the master
+            random.seed(long(os.urandom(16).encode('hex'), 16))
+            try:
+                self.worker(task_id)
+            except Exception:
+                logging.exception("Worker %d crashed" % task_id)
+                os._exit(1)
+            os._exit(0)
+        self.children[pid] = task_id
+        self.started[task_id] = time.time()
+        logging.info("Worker %d started, pid %d" % (task_id, pid))
+
+    def stop(self, sig=signal.SIGTERM):
+        self.stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def _handle_stop(self, signum, frame):
+        logging.info("Got signal %d, stopping workers" % signum)
+        self.stop(signal.SIGTERM)
+
+    def _handle_graceful_stop(self, signum, frame):
+        if self.stopping:
+            return
+        logging.info("Graceful stop, workers finish their requests within "
+                     "%s seconds" % self.graceful_timeout)
+        self.stop(signal.SIGQUIT)
+        signal.signal(signal.SIGALRM, self._handle_graceful_timeout)
+        signal.alarm(int(self.graceful_timeout) + 5)
+
+    def _handle_graceful_timeout(self, signum, frame):
+        if self.children:
+            logging.warning("Killing %d workers which did not stop in time" %
+                            len(self.children))
+            self.stop(signal.SIGKILL)
+
+    def _handle_restart(self, signum, frame):
+        if self.listen_fd is None or self.stopping or self.new_master:
+            logging.warning("Graceful restart not possible now, ignored")
+            return
+        pid = exec_new_master(self.listen_fd)
+        self.new_master = pid
+        logging.info("Graceful restart: new master started, pid %d" % pid)
+
+    def _reap(self, pid, status):
+        if os.WIFSIGNALED(status):
+            how = "killed by signal %d" % os.WTERMSIG(status)
+        else:
+            how = "exited with status %d" % os.WEXITSTATUS(status)
+        if pid == self.new_master:
+            logging.error("New master (pid %d) %s, graceful restart "
+                          "aborted" % (pid, how))
+            self.new_master = None
+            return
+        task_id = self.children.pop(pid, None)
+        if task_id is None:
+            return
+        if self.stopping:
+            logging.info("Worker %d (pid %d) %s" % (task_id, pid, how))
+            return
+
+        logging.warning("Worker %d (pid %d) %s, restarting" %
+                        (task_id, pid, how))
+        uptime = time.time() - self.started.get(task_id, 0)
+        if uptime < self.min_uptime:
+            time.sleep(self.min_uptime - uptime)
+        self.spawn(task_id)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -65,6 +65,12 @@ def project_name():
     return options.project_name
 
 
+def static_directory():
+    """The default static_path, the static directory of the project
+    """
+    return os.path.join(project_directory(), project_name(), 'static')
+
+
 def set_project_environment(settings_mod):
     if '__init__.py' in settings_mod.__file__:
         path = os.path.dirname(settings_mod.__file__)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Compiled route indexes used by whirly.web.Application.
+
+Literal url patterns are looked up in a dict. Parameterized patterns are
+grouped into a trie keyed on the path segments of their literal prefix, and
+the patterns sharing a trie node are tried with one combined regex. Every
+spec keeps its position in the handler list, so the first matching spec
+wins just like the linear scan in tornado.
+"""
+
+
+__all__ = ['RouteIndex', 'HostIndex']
+
+
+import re
+
+
+_META_CHARS = '.^$*+?{}[]\\|()'
+
+# python 2 re refuses patterns with more than 100 groups
+_MAX_GROUPS = 99
+
+# backreferences, conditionals and inline flags change meaning once a
+# pattern is embedded into a bigger one
+_UNSAFE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]')
+
+
+def _strip_anchors(pattern):
+    """Returns pattern without its anchors and whether it was anchored at
+    the end
+    """
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    if pattern.endswith('$') and not pattern.endswith('\\$'):
+        return pattern[:-1], True
+    return pattern, False
+
+
+def _has_toplevel_alternation(pattern):
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(pattern):
+    """Returns (prefix, is_literal) for the given url pattern
+
+    prefix is the text every matching path starts with, is_literal tells
+    whether the pattern matches nothing but that text.
+
+        >>> literal_prefix(r'/users/(\d+)$')
+        ('/users/', False)
+        >>> literal_prefix(r'/about\.html$')
+        ('/about.html', True)
+        >>> literal_prefix(r'/posts?/(.*)$')
+        ('/post', False)
+        >>> literal_prefix(r'/a|/b$')
+        ('', False)
+
+    """
+    pattern, anchored = _strip_anchors(pattern)
+    if _has_toplevel_alternation(pattern):
+        return '', False
+
+    chars = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        step = 1
+        if c == '\\':
+            if i + 1 < n and not pattern[i + 1].isalnum():
+                c = pattern[i + 1]
+                step = 2
+            else:
+                break
+        elif c in _META_CHARS:
+            break
+        quantifier = pattern[i + step:i + step + 1]
+        if quantifier and quantifier in '*?{':
+            # the character is optional, stop before it
+            return ''.join(chars), False
+        chars.append(c)
+        i += step
+        if quantifier == '+':
+            return ''.join(chars), False
+    return ''.join(chars), anchored and i == n
+
+
+def _strip_groups(pattern):
+    """Turns every capturing group of pattern into a non-capturing one
+    """
+    out = []
+    in_class = False
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            if pattern.startswith('(?P<', i):
+                out.append('(?:')
+                i = pattern.index('>', i) + 1
+                continue
+            elif not pattern.startswith('(?', i):
+                out.append('(?:')
+                i += 1
+                continue
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def _segments(prefix):
+    """Complete path segments of a literal prefix, the trie key
+    """
+    return prefix[:prefix.rfind('/') + 1].split('/')[:-1]
+
+
+class _Chunk(object):
+    """Up to _MAX_GROUPS specs matched with one combined regex
+
+    Every alternative is followed by an empty marker group, the marker
+    group closes last so match.lastindex tells which spec matched.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.first_index = entries[0][0]
+        if len(entries) == 1:
+            self.regex = entries[0][1].regex
+            self.combined = False
+        else:
+            alternatives = ['(?:%s)()' % _strip_groups(spec.regex.pattern)
+                            for index, spec in entries]
+            self.regex = re.compile('|'.join(alternatives))
+            self.combined = True
+
+    def match(self, path):
+        m = self.regex.match(path)
+        if not m:
+            return None
+        if self.combined:
+            return self.entries[m.lastindex - 1]
+        return self.entries[0]
+
+
+class _Node(object):
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+        self.chunks = []
+        self.first_index = None
+
+    def compile(self):
+        self.chunks = []
+        if self.entries:
+            self.first_index = self.entries[0][0]
+            chunk = []
+            for entry in self.entries:
+                if _UNSAFE_RE.search(entry[1].regex.pattern):
+                    # keep it on its own, still in order
+                    if chunk:
+                        self.chunks.append(_Chunk(chunk))
+                        chunk = []
+                    self.chunks.append(_Chunk([entry]))
+                    continue
+                chunk.append(entry)
+                if len(chunk) == _MAX_GROUPS:
+                    self.chunks.append(_Chunk(chunk))
+                    chunk = []
+            if chunk:
+                self.chunks.append(_Chunk(chunk))
+        for child in self.children.values():
+            child.compile()
+
+    def first_match(self, path, before):
+        """First entry of this node matching path with index < before
+        """
+        for chunk in self.chunks:
+            if chunk.first_index >= before:
+                break
+            entry = chunk.match(path)
+            if entry:
+                if entry[0] < before:
+                    return entry
+                # alternatives are tried in order, nothing earlier matched
+                break
+        return None
+
+
+class RouteIndex(object):
+    """Index over the URLSpec list of one host
+    """
+    def __init__(self, specs):
+        self.specs = list(specs)
+        self._literals = {}
+        self._root = _Node()
+        for index, spec in enumerate(self.specs):
+            prefix, is_literal = literal_prefix(spec.regex.pattern)
+            if is_literal:
+                # first spec wins on duplicated literal routes
+                self._literals.setdefault(prefix, (index, spec))
+                continue
+            node = self._root
+            for segment in _segments(prefix):
+                node = node.children.setdefault(segment, _Node())
+            node.entries.append((index, spec))
+        self._root.compile()
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def match(self, path):
+        """Returns (spec, match) of the first spec matching path
+
+        (None, None) is returned if no spec matches.
+        """
+        best = self._literals.get(path)
+        if best:
+            before = best[0]
+        else:
+            before = len(self.specs)
+
+        node = self._root
+        nodes = [node]
+        for segment in path.split('/')[:-1]:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            nodes.append(node)
+
+        for node in nodes:
+            if node.first_index is None or node.first_index >= before:
+                continue
+            entry = node.first_match(path, before)
+            if entry:
+                best = entry
+                before = entry[0]
+
+        if not best:
+            return None, None
+        spec = best[1]
+        return spec, spec.regex.match(path)
+
+
+class HostIndex(object):
+    """Index over the (host_regex, specs) list of tornado's Application
+    """
+    def __init__(self, handlers):
+        self._literals = {}
+        self._patterns = []
+        self._routes = []
+        for index, (host_regex, specs) in enumerate(handlers):
+            self._routes.append(RouteIndex(specs))
+            host, is_literal = literal_prefix(host_regex.pattern)
+            if is_literal:
+                self._literals.setdefault(host, index)
+            else:
+                self._patterns.append((index, host_regex))
+
+    def lookup(self, host):
+        """Returns the RouteIndex of the first host pattern matching host
+        """
+        before = self._literals.get(host, len(self._routes))
+        for index, host_regex in self._patterns:
+            if index >= before:
+                break
+            if host_regex.match(host):
+                before = index
+                break
+        if before < len(self._routes):
+            return self._routes[before]
+        return None
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
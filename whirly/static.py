@@ -0,0 +1,701 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Static files served from memory
+
+The application serves static_path with StaticFileHandler. Small files are
+kept in a least recently used cache bounded in bytes, a request for one of
+them costs a stat(), which notices a changed file. Text files get .gz, and
+.br when the brotli module is installed, variants written next to them at
+startup, they are sent to the clients accepting them. The files which do
+not shrink are recorded, a restart only compresses the files changed
+since. Files too large for the cache are sent with sendfile() where the
+platform has it, in chunks otherwise. Single byte ranges are supported.
+
+`whirly build_static` copies every file to a name carrying the hash of its
+content and writes a manifest of them, static_url() is then a dict lookup
+and the copies are cached by browsers for good.
+
+Application settings:
+
+    static_cache_size       bytes of static files kept in memory by every
+                            process, 32MB default
+    static_cache_max_file   larger files are not cached, 1MB default
+    static_precompress      write the compressed variants at startup,
+                            defaults to True unless in debug mode
+    static_manifest         the manifest written by build_static, defaults
+                            to manifest.json in static_path, not used in
+                            debug mode
+"""
+
+
+__all__ = ['StaticCache', 'StaticFileHandler', 'precompress',
+           'build_manifest', 'load_manifest', 'FileRange']
+
+
+import os
+import re
+import sys
+import stat
+import gzip
+import errno
+import hashlib
+import logging
+import datetime
+import mimetypes
+import threading
+import cStringIO
+import email.utils
+
+from tornado import web
+from tornado import stack_context
+from tornado.escape import json_encode, json_decode
+from tornado.iostream import SSLIOStream
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# content types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = frozenset([
+    "application/javascript", "application/x-javascript", "application/json",
+    "application/xml", "application/atom+xml", "application/rss+xml",
+    "application/xhtml+xml", "image/svg+xml", "image/x-icon",
+    "application/vnd.ms-fontobject", "application/x-font-ttf",
+    "font/ttf", "font/otf"])
+
+# smaller files do not shrink enough to pay for the variant
+MIN_COMPRESS_SIZE = 256
+
+# (suffix, Content-Encoding), in order of preference
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+# bytes read or sent at once for the files which are not cached
+CHUNK_SIZE = 256 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+MANIFEST_NAME = 'manifest.json'
+
+# the variants precompress() did not write, for files too small or which
+# do not shrink, so a restart does not read them again
+SKIPPED_NAME = '.precompress-skipped.json'
+
+# hex digits of the md5 put into fingerprinted names
+FINGERPRINT_LENGTH = 12
+
+# name.0123456789ab.ext, written by build_manifest()
+_FINGERPRINTED_RE = re.compile(r'\.[0-9a-f]{%d}(\.[^./]*)?$' %
+                               FINGERPRINT_LENGTH)
+
+
+def _load_sendfile():
+    """Returns sendfile(out_fd, in_fd, offset, count) from the C library
+
+    Only on linux, the signature differs elsewhere, the files are then
+    streamed in chunks.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_long), ctypes.c_size_t)
+    sendfile.restype = ctypes.c_ssize_t
+
+    def call(out_fd, in_fd, offset, count):
+        position = ctypes.c_long(offset)
+        sent = sendfile(out_fd, in_fd, ctypes.byref(position), count)
+        if sent < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return sent
+    return call
+
+sendfile = _load_sendfile()
+
+
+def _when_writable(stream, callback):
+    """Calls callback once the socket of stream takes data again
+
+    IOStream calls its write callback on a write event when its buffer is
+    empty, sendfile() writes to the socket behind its back. The IOLoop
+    callback lets a running _handle_events() reset the events first.
+    """
+    callback = stack_context.wrap(callback)
+
+    def wait():
+        if not stream.closed():
+            stream._write_callback = callback
+            stream._add_io_state(stream.io_loop.WRITE)
+    stream.io_loop.add_callback(wait)
+
+
+def is_compressible(path):
+    mime_type, encoding = mimetypes.guess_type(path)
+    if mime_type is None or encoding is not None:
+        return False
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES
+
+
+def _write_file(path, data):
+    # write aside and rename, other processes may be serving the old one
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def _load_skipped(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            skipped = json_decode(f.read())
+        except ValueError:
+            # rebuilt below
+            return {}
+    finally:
+        f.close()
+    return isinstance(skipped, dict) and skipped or {}
+
+
+def precompress(root):
+    """Writes the missing or outdated compressed variants of the text files
+    under root, returns how many were written
+
+    The variants not worth writing are recorded in SKIPPED_NAME with the
+    mtime of their file, they are not tried again until it changes.
+    """
+    written = 0
+    suffixes = [suffix for suffix, encoding in ENCODINGS
+                if encoding != 'br' or brotli is not None]
+    skipped_path = os.path.join(root, SKIPPED_NAME)
+    # path of the variant, relative to root -> mtime of its file
+    recorded = _load_skipped(skipped_path)
+    skipped = {}
+    for directory, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if path == skipped_path or not is_compressible(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            relative = os.path.relpath(path, root).replace(os.path.sep, '/')
+            data = None
+            for suffix in suffixes:
+                variant = path + suffix
+                if recorded.get(relative + suffix) == mtime:
+                    skipped[relative + suffix] = mtime
+                    continue
+                try:
+                    if os.stat(variant).st_mtime >= mtime:
+                        continue
+                except OSError:
+                    pass
+                if data is None:
+                    f = open(path, 'rb')
+                    try:
+                        data = f.read()
+                    finally:
+                        f.close()
+                if len(data) < MIN_COMPRESS_SIZE:
+                    skipped[relative + suffix] = mtime
+                    continue
+                if suffix == '.br':
+                    compressed = brotli.compress(data)
+                else:
+                    compressed = _gzip(data)
+                if len(compressed) >= len(data):
+                    skipped[relative + suffix] = mtime
+                    continue
+                _write_file(variant, compressed)
+                written += 1
+    if skipped != recorded:
+        _write_file(skipped_path, json_encode(skipped))
+    return written
+
+
+def _is_variant(path):
+    for suffix, encoding in ENCODINGS:
+        if path.endswith(suffix) and os.path.isfile(path[:-len(suffix)]):
+            return True
+    return False
+
+
+def build_manifest(root, manifest_path=None):
+    """Copies every file under root to a name carrying the md5 of its
+    content, writes the manifest and returns it
+
+    The manifest maps the names given to static_url(), relative to root
+    with / separators, to the names of the copies. The copies of previous
+    builds are left alone, pages rendered before a deploy still use them.
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = {}
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if path == manifest_path or name == SKIPPED_NAME or \
+               name.endswith('.tmp') or \
+               _FINGERPRINTED_RE.search(name) or _is_variant(path):
+                continue
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            digest = hashlib.md5(data).hexdigest()[:FINGERPRINT_LENGTH]
+            base, ext = os.path.splitext(name)
+            copy = os.path.join(directory, '%s.%s%s' % (base, digest, ext))
+            if not os.path.exists(copy):
+                _write_file(copy, data)
+            relative = os.path.relpath(path, root).replace(os.path.sep, '/')
+            manifest[relative] = os.path.relpath(copy, root).replace(
+                os.path.sep, '/')
+    _write_file(manifest_path, json_encode(manifest))
+    return manifest
+
+
+def load_manifest(path):
+    """Returns the manifest written by build_manifest(), None without one
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return json_decode(f.read())
+        except ValueError, e:
+            logging.error("Invalid static manifest %s: %s" % (path, e))
+            sys.exit(1)
+    finally:
+        f.close()
+
+
+def _gzip(data):
+    buf = cStringIO.StringIO()
+    f = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=9)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+class StaticFile(object):
+    """One file of the static directory, body is None for large files
+    """
+    __slots__ = ('path', 'mtime', 'size', 'body', 'etag', 'last_modified',
+                 'variants', 'prev', 'next')
+
+    def __init__(self, path, stat_result):
+        self.path = path
+        self.mtime = stat_result[stat.ST_MTIME]
+        self.size = stat_result[stat.ST_SIZE]
+        self.body = None
+        self.etag = '"%x-%x"' % (self.mtime, self.size)
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        # Content-Encoding -> StaticFile
+        self.variants = {}
+        self.prev = self.next = None
+
+    def cost(self):
+        # a few hundred bytes for the entry itself
+        total = 256 + len(self.body or '')
+        for variant in self.variants.itervalues():
+            total += len(variant.body or '')
+        return total
+
+
+class StaticCache(object):
+    """Static files by absolute path, least recently used first out
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = {}
+        # circular list, _head.next is the most recently used
+        self._head = StaticFile.__new__(StaticFile)
+        self._head.prev = self._head.next = self._head
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, path, stat_result):
+        """Returns the StaticFile of path, loaded when it is not cached or
+        has changed since
+        """
+        mtime = stat_result[stat.ST_MTIME]
+        size = stat_result[stat.ST_SIZE]
+        self._lock.acquire()
+        try:
+            entry = self._files.get(path)
+            if entry is not None:
+                self._unlink(entry)
+                if entry.mtime == mtime and entry.size == size:
+                    self.hits += 1
+                    self._link(entry)
+                    return entry
+                del self._files[path]
+                self.bytes -= entry.cost()
+        finally:
+            self._lock.release()
+
+        self.misses += 1
+        entry = self._load(path, stat_result)
+        self._lock.acquire()
+        try:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self._unlink(old)
+                self.bytes -= old.cost()
+            self._files[path] = entry
+            self._link(entry)
+            self.bytes += entry.cost()
+            while self.bytes > self.max_bytes and self._head.prev is not entry:
+                oldest = self._head.prev
+                self._unlink(oldest)
+                del self._files[oldest.path]
+                self.bytes -= oldest.cost()
+        finally:
+            self._lock.release()
+        return entry
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._files.clear()
+            self._head.prev = self._head.next = self._head
+            self.bytes = 0
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+    def _load(self, path, stat_result):
+        entry = self._read(path, stat_result)
+        for suffix, encoding in ENCODINGS:
+            try:
+                variant_stat = os.stat(path + suffix)
+            except OSError:
+                continue
+            # an older variant was written for a previous version
+            if variant_stat[stat.ST_MTIME] >= entry.mtime:
+                variant = self._read(path + suffix, variant_stat)
+                variant.etag = '"%x-%x-%s"' % (entry.mtime, entry.size,
+                                               encoding)
+                entry.variants[encoding] = variant
+        return entry
+
+    def _read(self, path, stat_result):
+        entry = StaticFile(path, stat_result)
+        if entry.size <= self.max_file:
+            f = open(path, 'rb')
+            try:
+                entry.body = f.read()
+            finally:
+                f.close()
+            if len(entry.body) != entry.size:
+                # changed while being read, do not cache a torn copy
+                entry.mtime = -1
+        return entry
+
+
+def _parse_range(value, size):
+    """Returns (start, end) of the byte range header value, end excluded
+
+    None means the header is ignored and the whole file is sent, ranges
+    which can not be satisfied give (size, size).
+    """
+    match = _RANGE_RE.match(value.strip())
+    if match is None:
+        # several ranges are allowed to be answered with the whole file
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if not length:
+            return size, size
+        return max(0, size - length), size
+    start = int(first)
+    end = size
+    if last:
+        end = int(last) + 1
+        if end <= start:
+            return None
+    if start >= size:
+        return size, size
+    return start, min(end, size)
+
+
+class FileRange(object):
+    """Iterates over the bytes from start to end of an open file, closed by
+    the server once it is sent
+    """
+    def __init__(self, f, start, end, chunk_size=CHUNK_SIZE):
+        self.file = f
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        self.file.seek(self.start)
+        remaining = self.end - self.start
+        while remaining > 0:
+            chunk = self.file.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class StaticFileHandler(web.StaticFileHandler):
+    """Serves the files under path from the cache of the application
+    """
+    def initialize(self, path, default_filename=None):
+        super(StaticFileHandler, self).initialize(path, default_filename)
+        self._file = None
+
+    def get(self, path, include_body=True):
+        # fingerprinted by build_static, the name changes with the content
+        immutable = path in self.application.static_fingerprinted
+        if os.path.sep != "/":
+            path = path.replace("/", os.path.sep)
+        abspath = os.path.abspath(os.path.join(self.root, path))
+        if not (abspath + os.path.sep).startswith(self.root):
+            raise web.HTTPError(403, "%s is not in root static directory",
+                                path)
+        try:
+            stat_result = os.stat(abspath)
+        except OSError:
+            raise web.HTTPError(404)
+        if stat.S_ISDIR(stat_result[stat.ST_MODE]) and \
+           self.default_filename is not None:
+            if not self.request.path.endswith("/"):
+                self.redirect(self.request.path + "/")
+                return
+            abspath = os.path.join(abspath, self.default_filename)
+            try:
+                stat_result = os.stat(abspath)
+            except OSError:
+                raise web.HTTPError(404)
+        if not stat.S_ISREG(stat_result[stat.ST_MODE]):
+            raise web.HTTPError(403, "%s is not a file", path)
+
+        entry = self.application.static_cache.get(abspath, stat_result)
+
+        self.set_header("Last-Modified", entry.last_modified)
+        self.set_header("Accept-Ranges", "bytes")
+        if immutable or "v" in self.request.arguments:
+            self.set_header("Expires", datetime.datetime.utcnow() + \
+                                       datetime.timedelta(days=365*10))
+            self.set_header("Cache-Control", "max-age=" + str(86400*365*10))
+        else:
+            self.set_header("Cache-Control", "public")
+        mime_type, encoding = mimetypes.guess_type(abspath)
+        if mime_type:
+            self.set_header("Content-Type", mime_type)
+
+        self.set_extra_headers(path)
+
+        range_header = self.request.headers.get("Range")
+        if range_header is not None and not self._range_applies(entry):
+            range_header = None
+        selected = entry
+        if entry.variants:
+            self.set_header("Vary", "Accept-Encoding")
+            if range_header is None:
+                selected = self._select_variant(entry)
+        self.set_header("Etag", selected.etag)
+
+        if self._not_modified(entry, selected):
+            self.set_status(304)
+            return
+
+        start, end = 0, selected.size
+        if range_header is not None:
+            byte_range = _parse_range(range_header, selected.size)
+            if byte_range is not None:
+                start, end = byte_range
+                if start >= end:
+                    self.set_status(416)
+                    self.set_header("Content-Range",
+                                    "bytes */%d" % selected.size)
+                    self.set_header("Content-Length", 0)
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, end - 1, selected.size))
+        self.set_header("Content-Length", end - start)
+
+        if not include_body:
+            return
+        if selected.body is not None:
+            if start or end != selected.size:
+                self.write(selected.body[start:end])
+            else:
+                self.write(selected.body)
+            return
+        if self.application._wsgi:
+            # the WSGI server reads it as it sends it
+            try:
+                self.wsgi_body = FileRange(open(selected.path, 'rb'), start,
+                                           end)
+            except IOError:
+                raise web.HTTPError(404)
+            return
+        self._send_file(selected.path, start, end)
+
+    def _select_variant(self, entry):
+        accepted = self.request.headers.get("Accept-Encoding", "")
+        if not accepted:
+            return entry
+        for suffix, encoding in ENCODINGS:
+            if encoding in entry.variants and encoding in accepted:
+                self.set_header("Content-Encoding", encoding)
+                return entry.variants[encoding]
+        return entry
+
+    def _range_applies(self, entry):
+        # a resumed download must not mix two versions of the file
+        if_range = self.request.headers.get("If-Range")
+        return if_range is None or if_range in (entry.etag,
+                                                entry.last_modified)
+
+    def _not_modified(self, entry, selected):
+        none_match = self.request.headers.get("If-None-Match")
+        if none_match is not None:
+            return none_match.strip() == '*' or \
+                selected.etag in none_match
+        since = self.request.headers.get("If-Modified-Since")
+        if since is not None:
+            date_tuple = email.utils.parsedate_tz(since)
+            if date_tuple is not None:
+                return email.utils.mktime_tz(date_tuple) >= entry.mtime
+        return False
+
+    def _send_file(self, path, start, end):
+        """Sends the range of a file which is not cached, asynchronously
+        """
+        try:
+            self._file = open(path, 'rb')
+        except IOError:
+            raise web.HTTPError(404)
+        self._offset = start
+        self._end = end
+        stream = self.request.connection.stream
+        self._use_sendfile = sendfile is not None and \
+            not isinstance(stream, SSLIOStream)
+        if not self._use_sendfile:
+            self._file.seek(start)
+        self._auto_finish = False
+        stream.set_close_callback(self._on_close)
+        # the headers go first, the body follows once they are out
+        self.flush()
+        _when_writable(stream, self._send_next)
+
+    def _send_next(self):
+        stream = self.request.connection.stream
+        if stream.closed():
+            return
+        if self._offset >= self._end:
+            self._close_file()
+            self.finish()
+            return
+        count = min(CHUNK_SIZE, self._end - self._offset)
+        if not self._use_sendfile:
+            chunk = self._file.read(count)
+            if not chunk:
+                # truncated under our feet, the length is already sent
+                self._abort("%s is shorter than announced" % self._file.name)
+                return
+            self._offset += len(chunk)
+            stream.write(chunk, self._send_next)
+            return
+        try:
+            sent = sendfile(stream.socket.fileno(), self._file.fileno(),
+                            self._offset, count)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                sent = None
+            else:
+                self._abort("sendfile of %s failed: %s" % (self._file.name,
+                                                           e))
+                return
+        if sent == 0:
+            self._abort("%s is shorter than announced" % self._file.name)
+            return
+        if sent:
+            self._offset += sent
+        _when_writable(stream, self._send_next)
+
+    def _abort(self, message):
+        logging.warning(message)
+        self.request.connection.stream.close()
+
+    def _on_close(self):
+        if self._file is None:
+            return
+        # the connection went away before the whole file was sent
+        self._close_file()
+        self._finished = True
+        self._log()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -28,6 +28,35 @@ import tornado.template
 # try to load jinja2 template
 try:
     import jinja2
+
+    class WatchedFileSystemLoader(jinja2.FileSystemLoader):
+        """Evicts a template from the environment cache when its file
+        changes, extends and includes are looked up again at render time
+        """
+        def __init__(self, searchpath, watcher):
+            jinja2.FileSystemLoader.__init__(self, searchpath)
+            self.watcher = watcher
+            self.environment = None
+            self._names = {}
+
+        def get_source(self, environment, template):
+            source, filename, uptodate = jinja2.FileSystemLoader.get_source(
+                self, environment, template)
+            self.environment = environment
+            self._names[filename] = template
+            self.watcher.watch(filename, self._changed)
+            return source, filename, uptodate
+
+        def _changed(self, path):
+            name = self._names.pop(path, None)
+            cache = self.environment.cache
+            if name is None or cache is None:
+                return
+            for key in list(cache.keys()):
+                # the key is the name or (loader reference, name)
+                if key == name or (isinstance(key, tuple) and
+                                   key[-1] == name):
+                    del cache[key]
 except ImportError:
     pass
 
@@ -35,6 +64,26 @@ except ImportError:
 try:
     from mako.template import Template
     from mako.lookup import TemplateLookup
+
+    class WatchedTemplateLookup(TemplateLookup):
+        """Drops a template from the lookup when its file changes, mako
+        resolves inherits and includes at render time
+        """
+        def __init__(self, watcher, **kwargs):
+            TemplateLookup.__init__(self, **kwargs)
+            self.watcher = watcher
+            self._uris = {}
+
+        def _load(self, filename, uri):
+            template = TemplateLookup._load(self, filename, uri)
+            self._uris[filename] = uri
+            self.watcher.watch(filename, self._changed)
+            return template
+
+        def _changed(self, path):
+            uri = self._uris.pop(path, None)
+            if uri is not None:
+                self._collection.pop(uri, None)
 except ImportError:
     pass
 
@@ -43,6 +92,42 @@ from whirly.web import RequestHandler
 from whirly import helpers
 
 
+class WatchedLoader(tornado.template.Loader):
+    """Invalidates a template when its file changes
+
+    tornado compiles extended and included templates into the template
+    using them, so the templates depending on a changed file go too.
+    """
+    def __init__(self, root_directory, watcher):
+        tornado.template.Loader.__init__(self, root_directory)
+        self.watcher = watcher
+        self._loading = []
+        # name -> names of the templates which extend or include it
+        self._dependents = {}
+
+    def load(self, name, parent_path=None):
+        name = self.resolve_path(name, parent_path=parent_path)
+        if self._loading:
+            self._dependents.setdefault(name, set()).add(self._loading[-1])
+        if name in self.templates:
+            return self.templates[name]
+        self._loading.append(name)
+        try:
+            template = tornado.template.Loader.load(self, name)
+        finally:
+            self._loading.pop()
+        self.watcher.watch(os.path.join(self.root, name), self._changed)
+        return template
+
+    def invalidate(self, name):
+        self.templates.pop(name, None)
+        for dependent in self._dependents.pop(name, ()):
+            self.invalidate(dependent)
+
+    def _changed(self, path):
+        self.invalidate(path[len(self.root) + 1:])
+
+
 class TemplateEngineError(Exception):
     def __init__(self, message):
         self.message = message
@@ -52,6 +137,9 @@ class TemplateEngineError(Exception):
 
 
 class TemplateEngine(object):
+    # a whirly.watcher.FileWatcher in debug mode, set before the first load
+    watcher = None
+
     def __init__(self, template_path=None):
         if not template_path:
             frame = sys._getframe(0)
@@ -65,18 +153,59 @@ class TemplateEngine(object):
     def render_string(self, template_name, handler, **kw):
         not NotImplementedError
 
+    def loader(self):
+        """Returns the template loader shared by all handlers
+        """
+        raise NotImplementedError
+
+    def load(self, template_name):
+        raise NotImplementedError
+
+    def preload(self):
+        """Compiles every template under template_path
+
+        Called before forking workers so they share the compiled templates.
+        """
+        count = 0
+        for root, dirs, files in os.walk(self.template_path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for f in files:
+                if f.startswith('.'):
+                    continue
+                path = os.path.join(root, f)
+                name = os.path.relpath(path, self.template_path)
+                name = name.replace(os.path.sep, '/')
+                try:
+                    self.load(name)
+                    count += 1
+                except Exception, e:
+                    logging.warning("Could not preload template %s: %s" %
+                                    (name, e))
+        logging.info("%d templates preloaded from %s" % (count,
+                                                         self.template_path))
+
 
 
 class TemplateEngineJinja2(TemplateEngine):
-    def render_string(self, template_name, handler, **kwargs):
-        logging.debug(self.template_path)
+    def loader(self):
         if not getattr(RequestHandler, "_templates", None):
             RequestHandler._templates = {}
         if self.template_path not in RequestHandler._templates:
+            if self.watcher is not None:
+                loader = WatchedFileSystemLoader(self.template_path,
+                                                 self.watcher)
+            else:
+                loader = jinja2.FileSystemLoader(self.template_path)
             RequestHandler._templates[self.template_path] = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(self.template_path))
-        t = RequestHandler._templates[self.template_path].get_template(
-            template_name)
+                loader=loader, auto_reload=self.watcher is None)
+        return RequestHandler._templates[self.template_path]
+
+    def load(self, template_name):
+        return self.loader().get_template(template_name)
+
+    def render_string(self, template_name, handler, **kwargs):
+        logging.debug(self.template_path)
+        t = self.load(template_name)
 
         args = dict(
             handler=handler,
@@ -85,6 +214,7 @@ class TemplateEngineJinja2(TemplateEngine):
             locale=handler.locale,
             _=handler.locale.translate,
             static_url=handler.static_url,
+            static_bundle=handler.static_bundle,
             xsrf_form_html=handler.xsrf_form_html,
             reverse_url=handler.application.reverse_url,
             helpers=helpers
@@ -95,8 +225,7 @@ class TemplateEngineJinja2(TemplateEngine):
 
 
 class TemplateEngineMako(TemplateEngine):
-    def render_string(self, template_name, handler, **kwargs):
-        logging.debug(self.template_path)
+    def loader(self):
         project_path = whirly.project.project_directory()
         mako_module_directory = whirly.project.setting('template',
                                 'mako_module_directory', '')
@@ -109,7 +238,7 @@ class TemplateEngineMako(TemplateEngine):
             RequestHandler._templates = {}
 
         if self.template_path not in RequestHandler._templates:
-            RequestHandler._templates[self.template_path] = TemplateLookup(
+            kwargs = dict(
                 directories=[self.template_path],
                 module_directory=mako_module_directory,
                 input_encoding='utf-8',
@@ -117,8 +246,21 @@ class TemplateEngineMako(TemplateEngine):
                 filesystem_checks=whirly.project.setting('application',
                     'debug', False)
             )
+            if self.watcher is not None:
+                # the watcher replaces the stat on every lookup
+                kwargs['filesystem_checks'] = False
+                lookup = WatchedTemplateLookup(self.watcher, **kwargs)
+            else:
+                lookup = TemplateLookup(**kwargs)
+            RequestHandler._templates[self.template_path] = lookup
+        return RequestHandler._templates[self.template_path]
+
+    def load(self, template_name):
+        return self.loader().get_template(template_name)
 
-        t = RequestHandler._templates[self.template_path].get_template(template_name)
+    def render_string(self, template_name, handler, **kwargs):
+        logging.debug(self.template_path)
+        t = self.load(template_name)
         args = dict(
             handler=handler,
             request=handler.request,
@@ -126,10 +268,11 @@ class TemplateEngineMako(TemplateEngine):
             locale=handler.locale,
             _=handler.locale.translate,
             static_url=handler.static_url,
+            static_bundle=handler.static_bundle,
             xsrf_form_html=handler.xsrf_form_html,
             reverse_url=handler.application.reverse_url,
             helpers=helpers,
-            lookup=RequestHandler._templates[self.template_path]
+            lookup=self.loader()
         )
         args.update(handler.ui)
         args.update(kwargs)
@@ -137,16 +280,24 @@ class TemplateEngineMako(TemplateEngine):
 
 
 class TemplateEngineTornado(TemplateEngine):
-    def render_string(self, template_name, handler, **kwargs):
-        logging.debug(self.template_path)
+    def loader(self):
         if not getattr(RequestHandler, "_templates", None):
             RequestHandler._templates = {}
 
         if self.template_path not in RequestHandler._templates:
-            RequestHandler._templates[self.template_path] = tornado.template.Loader(
-                self.template_path)
+            if self.watcher is not None:
+                loader = WatchedLoader(self.template_path, self.watcher)
+            else:
+                loader = tornado.template.Loader(self.template_path)
+            RequestHandler._templates[self.template_path] = loader
+        return RequestHandler._templates[self.template_path]
 
-        t = RequestHandler._templates[self.template_path].load(template_name)
+    def load(self, template_name):
+        return self.loader().load(template_name)
+
+    def render_string(self, template_name, handler, **kwargs):
+        logging.debug(self.template_path)
+        t = self.load(template_name)
 
         args = dict(
             handler=handler,
@@ -155,6 +306,7 @@ class TemplateEngineTornado(TemplateEngine):
             locale=handler.locale,
             _=handler.locale.translate,
             static_url=handler.static_url,
+            static_bundle=handler.static_bundle,
             xsrf_form_html=handler.xsrf_form_html,
             reverse_url=handler.application.reverse_url,
             helpers=helpers
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Request tracing
+
+A sampled request gets a Trace, and every span() opened while it is being
+handled is recorded into it. For requests which are not sampled span()
+returns a shared no-op object, so instrumented code costs one attribute
+lookup. Finished traces are written by ChromeTraceExporter in the trace
+event format, the file can be loaded in chrome://tracing.
+
+A trace is identified by the X-Request-Id of its request, when it is at
+most 128 letters, digits, '.', '_' or '-', otherwise by a random id.
+
+Application settings:
+
+    trace_sample_rate   fraction of requests traced, 0 disables tracing
+    trace_file          where trace events are written, defaults to
+                        <project>/data/trace/trace.json
+"""
+
+
+from __future__ import with_statement
+
+
+__all__ = ['Tracer', 'Trace', 'ChromeTraceExporter', 'span',
+           'current_trace', 'resume']
+
+
+import os
+import re
+import time
+import atexit
+import random
+import logging
+import threading
+
+from tornado.escape import json_encode
+
+
+# tornado handles a request in one thread, wsgi servers may use many
+_local = threading.local()
+
+
+class _NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span(object):
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.trace.spans.append(self)
+        return False
+
+    def set(self, **args):
+        """Attach more arguments to the span
+        """
+        self.args.update(args)
+
+
+class Trace(object):
+    def __init__(self, request_id, sequence, request):
+        self.request_id = request_id
+        self.sequence = sequence
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self.args = dict(method=request.method, uri=request.uri,
+                         request_id=request_id)
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def finish(self, **args):
+        self.duration = time.time() - self.start
+        self.args.update(args)
+
+    def events(self, pid):
+        """Yields the trace as complete ("X") trace events
+        """
+        yield dict(name='request', cat='request', ph='X', pid=pid,
+                   tid=self.sequence, ts=int(self.start * 1e6),
+                   dur=int(self.duration * 1e6), args=self.args)
+        for s in self.spans:
+            yield dict(name=s.name, cat=s.category, ph='X', pid=pid,
+                       tid=self.sequence, ts=int(s.start * 1e6),
+                       dur=int(s.duration * 1e6), args=s.args)
+
+
+class ChromeTraceExporter(object):
+    """Appends trace events to path in the chrome trace event format
+
+    The file is a JSON array whose closing bracket is left out, which the
+    trace viewers accept, so events can be appended to it.
+    """
+    def __init__(self, path, buffer_size=20):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._buffer = []
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        atexit.register(self.flush)
+
+    def export(self, trace):
+        pid = os.getpid()
+        self._buffer.extend(json_encode(e) for e in trace.events(pid))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            new = not os.path.exists(self.path)
+            f = open(self.path, 'a')
+            try:
+                if new:
+                    f.write('[\n')
+                f.write(',\n'.join(lines) + ',\n')
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.warning("Could not write trace events to %s: %s" %
+                            (self.path, e))
+
+
+# longest X-Request-Id of a request which is kept
+MAX_REQUEST_ID = 128
+_REQUEST_ID_RE = re.compile(r'[A-Za-z0-9._-]+$')
+
+
+class Tracer(object):
+    def __init__(self, sample_rate=0.0, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self._sequence = 0
+
+    def start(self, request):
+        """Returns a Trace for request if it is sampled, otherwise None
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            _local.trace = None
+            return None
+        self._sequence += 1
+        request_id = request.headers.get('X-Request-Id')
+        if not request_id or len(request_id) > MAX_REQUEST_ID or \
+           not _REQUEST_ID_RE.match(request_id):
+            # sent by the client, echoed in the response and the traces
+            request_id = os.urandom(8).encode('hex')
+        request.request_id = request_id
+        trace = Trace(request_id, self._sequence, request)
+        _local.trace = trace
+        return trace
+
+    def finish(self, trace, handler=None):
+        _local.trace = None
+        if handler is not None:
+            trace.finish(status=handler.get_status(),
+                         handler=handler.__class__.__name__)
+        else:
+            trace.finish()
+        if self.exporter is not None:
+            self.exporter.export(trace)
+
+
+def current_trace():
+    """The Trace of the request being handled, None if it is not sampled
+    """
+    return getattr(_local, 'trace', None)
+
+
+def resume(trace):
+    """Makes trace current again when a request continues asynchronously
+    """
+    _local.trace = trace
+
+
+def span(name, category='whirly', **args):
+    """Records the enclosed block as a span of the current trace
+
+        with tracing.span('session.load', 'storage', key=key):
+            ...
+
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NOOP_SPAN
+    return Span(trace, name, category, args)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -19,12 +19,15 @@
 import re
 import sys
 import time
+import zlib
 import datetime
+import email.utils
 import threading
 from UserDict import DictMixin
 
 
-__all__ = ['odict', 'AttrDict', 'ThreadedDict', 'timedelta', 'MultiDict']
+__all__ = ['odict', 'AttrDict', 'ThreadedDict', 'timedelta', 'MultiDict',
+           'weak_etag', 'etag_matches', 'not_modified_since']
 
 
 class MultiDict(dict):
@@ -285,6 +288,54 @@ def no_cache_headers():
     }
 
 
+def weak_etag(chunks):
+    """A weak ETag of the response body made of chunks
+
+    >>> weak_etag(['hello ', 'world'])
+    'W/"b-0d4a1185"'
+
+    """
+    crc = 0
+    length = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        length += len(chunk)
+    return 'W/"%x-%08x"' % (length, crc & 0xffffffff)
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of etag with the value of an If-None-Match header
+
+    >>> etag_matches('"a", W/"b"', '"b"')
+    True
+    >>> etag_matches('"a"', 'W/"ab"')
+    False
+
+    """
+    if if_none_match.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def not_modified_since(if_modified_since, last_modified):
+    """Whether the Last-Modified date is not after If-Modified-Since, both
+    as http dates
+    """
+    since = email.utils.parsedate_tz(if_modified_since)
+    modified = email.utils.parsedate_tz(last_modified)
+    if since is None or modified is None:
+        return False
+    return email.utils.mktime_tz(modified) <= email.utils.mktime_tz(since)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Yuanhao Li
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""File change detection for debug mode
+
+Only the files which were actually loaded are watched, a template or a
+static file is registered when it is compiled or hashed. Their mtimes are
+polled at most once per interval, and the callbacks of a changed file are
+called once, the file has to be registered again after it is reloaded.
+
+Application settings:
+
+    watch_interval      seconds between two polls in debug mode, 0.5 default
+"""
+
+
+__all__ = ['FileWatcher']
+
+
+import os
+import time
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class FileWatcher(object):
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        # path -> [mtime, callbacks]
+        self._files = {}
+        self._next_check = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def watch(self, path, callback):
+        """Calls callback(path) the next time path changes or disappears
+        """
+        entry = self._files.get(path)
+        if entry is None:
+            entry = self._files[path] = [_mtime(path), []]
+        if callback not in entry[1]:
+            entry[1].append(callback)
+
+    def due(self):
+        return time.time() >= self._next_check
+
+    def check(self, force=False):
+        """Polls the watched files, returns the paths which changed
+        """
+        now = time.time()
+        if not force and now < self._next_check:
+            return []
+        self._next_check = now + self.interval
+        changed = []
+        for path, (mtime, callbacks) in self._files.items():
+            if _mtime(path) == mtime:
+                continue
+            del self._files[path]
+            changed.append(path)
+            for callback in callbacks:
+                callback(path)
+        return changed
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -15,15 +15,18 @@
 # under the License.
 
 
+from __future__ import with_statement
+
 import os
 import sys
 import logging
-import traceback
 import urllib
+import functools
 
 from tornado.web import RequestHandler, ErrorHandler
 from tornado.web import RedirectHandler, StaticFileHandler
 from tornado.web import FallbackHandler
+from tornado.web import GZipContentEncoding, ChunkedTransferEncoding
 from tornado.web import HTTPError, OutputTransform
 from tornado.web import UIModule, URLSpec
 from tornado.web import Application as TornadoApplication
@@ -32,10 +35,25 @@ from tornado.web import url
 
 import whirly.project
 from whirly import helpers as h
+from whirly import tracing
+from whirly import concurrent
+from whirly.concurrent import ThreadPool, ProcessPool, is_future, resolved
+from whirly.compression import Compressor, CONTENT_TYPES
+from whirly.httpserver import BodyStream, MultipartReceiver
+from whirly.httpserver import multipart_boundary
+from whirly.metrics import Metrics, MetricsHandler, DEFAULT_BUCKETS
 from whirly.options import define, options
+from whirly.pagecache import PageCache, PageCapture, CachedPage, MemoryStore
+from whirly.pagecache import render_page, page_size
 from whirly.utils import ThreadedDict
 from whirly.template import TemplateEngineDelegate
+from whirly.routing import HostIndex
+from whirly.static import StaticCache, precompress, load_manifest
+from whirly.static import MANIFEST_NAME
+from whirly.static import StaticFileHandler as WhirlyStaticFileHandler
+from whirly.watcher import FileWatcher
 from whirly.handlers import BaseHandler, ErrorPage, HTTPErrorWrapper
+from whirly.handlers import capture_traceback, is_debug
 
 
 class Application(TornadoApplication):
@@ -47,69 +65,187 @@ class Application(TornadoApplication):
 
         settings = self._adjust_settings(settings)
         default_host = settings.pop('default_host')
+        if wsgi and settings.get('async_extensions'):
+            logging.warning("Asynchronous extensions need the IOLoop, they "
+                            "are disabled in wsgi mode")
+            settings['async_extensions'] = False
+        # name -> pool, created on first use in every worker process
+        self._executors = {}
+        self._host_index = HostIndex([])
+        # requests not finished yet, a draining process waits for them
+        self._active_requests = set()
+        self.draining = False
+        self.metrics = None
+        if settings.get('metrics'):
+            self.metrics = Metrics(settings.get('metrics_buckets',
+                                                DEFAULT_BUCKETS))
+            metrics_url = settings.get('metrics_url', '/_whirly/metrics')
+            handlers = [(metrics_url, MetricsHandler)] + list(handlers)
         super(Application, self).__init__(handlers, default_host, transforms,
                                           wsgi, **settings)
         self._load_extensions(extensions)
+        self._load_tracer()
+        self._load_static_handler()
+        self._load_compressor()
+        self._load_page_cache()
+        self.file_watcher = None
+        if self.settings.get('debug'):
+            self.file_watcher = FileWatcher(
+                self.settings.get('watch_interval', 0.5))
 
         if not settings.get('test'):
             self._load_template_engine()
         else:
             logging.info("Application running for test")
 
+        error_page = self.settings['error_page']
+        if not is_debug() and hasattr(error_page, 'prerender'):
+            error_page.prerender()
+
     def __call__(self, request):
         """Called by HTTPServer to execute the request."""
-        logging.debug("\n\nAPPLICAION\n\n")
-        logging.debug(h.escape.url_unescape(request.path))
+        self._active_requests.add(request)
+        if self.draining and request.connection is not None:
+            request.connection.no_keep_alive = True
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.start(request)
+
         # maybe bug 
         request.path = h.escape.url_unescape(request.path)
+        logging.debug("Request path: %s", request.path)
 
         transforms = [t(request) for t in self.transforms]
         handler = None
         args = []
         kwargs = {}
-        handlers = self._get_host_handlers(request)
+        with tracing.span('dispatch', 'route', path=request.path):
+            handlers = self._get_host_handlers(request)
+            if handlers:
+                spec, match = handlers.match(request.path)
         if not handlers:
             handler = RedirectHandler(request, "http://%s/" % self.default_host)
         else:
-            for spec in handlers:
-                match = spec.regex.match(request.path)
-                if match:
-                    def unquote(s):
-                        if s is None: return s
-                        return urllib.unquote(s)
-                    handler = spec.handler_class(self, request, **spec.kwargs)
-
-                    kwargs = dict((k, unquote(v))
-                                  for (k, v) in match.groupdict().iteritems())
-                    if kwargs:
-                        args = []
-                    else:
-                        args = [unquote(s) for s in match.groups()]
-                    break
-            if not handler:
+            if match:
+                request.route_pattern = spec.regex.pattern
+                if self.page_cache is not None:
+                    response = self._serve_cached_page(request, spec,
+                                                       transforms, trace)
+                    if response is not None:
+                        return response
+                def unquote(s):
+                    if s is None: return s
+                    return urllib.unquote(s)
+                handler = spec.handler_class(self, request, **spec.kwargs)
+                # extensions add their transforms to it, _execute keeps it
+                handler._transforms = transforms
+
+                kwargs = dict((k, unquote(v))
+                              for (k, v) in match.groupdict().iteritems())
+                if kwargs:
+                    args = []
+                else:
+                    args = [unquote(s) for s in match.groups()]
+            else:
                 #handler = ErrorHandler(self, request, 404)
                 handler = self.settings.get('error_page')(self, request, 404)
 
-        logging.debug("URL MATCH: ")
-        logging.debug(handler.__class__)
+        logging.debug("URL match: %s", handler.__class__)
+        if trace is not None:
+            handler.set_header('X-Request-Id', trace.request_id)
+        if self.draining:
+            handler.set_header('Connection', 'close')
+        connection = getattr(request, 'connection', None)
+        if connection is not None:
+            connection.stream.set_close_callback(
+                functools.partial(self.connection_closed, handler))
+
+        return self._execute_handler(handler, transforms, args, kwargs, trace)
+
+    def _serve_cached_page(self, request, spec, transforms, trace):
+        """Answers request from the page cache, before any handler is built
 
+        Returns the stand-in of the handler on a hit. On a miss a request
+        which may be cached gets a PageCapture and its response is stored by
+        log_request.
+        """
+        if getattr(request, 'cache_refresh', None) is not None:
+            # regenerating an entry of the cache decorator, see
+            # whirly.extensions.cache
+            return None
+        policy = self.page_cache.policy(spec.handler_class)
+        if policy is None:
+            return None
+        key = self.page_cache.key(request, policy)
+        if key is None:
+            return None
+        page = self.page_cache.get(key)
+        if page is None:
+            capture = PageCapture(request)
+            transforms.append(capture)
+            request.page_cache_entry = (key, policy, capture)
+            return None
+        extra_headers = []
+        if trace is not None:
+            extra_headers.append(('X-Request-Id', trace.request_id))
+        if self.draining:
+            extra_headers.append(('Connection', 'close'))
+        elif not request.supports_http_1_1() and \
+             request.headers.get("Connection") == "Keep-Alive":
+            extra_headers.append(('Connection', 'Keep-Alive'))
+        status_code, data = render_page(request, page, extra_headers)
+        response = CachedPage(request, status_code)
+        request.write(data)
+        request.finish()
+        self.log_request(response)
+        if trace is not None:
+            self.tracer.finish(trace, response)
+        return response
+
+    def _execute_handler(self, handler, transforms, args, kwargs, trace,
+                         future=None):
+        """Applies the extensions and executes handler
+
+        When an extension returns a Future this is called again with it once
+        it resolves, the request then finishes asynchronously.
+        """
+        request = handler.request
         try:
-            # apply extensions
-            if (not isinstance(handler, ErrorHandler) and
-                not isinstance(handler, StaticFileHandler)):
-               handler = self._apply_extensions(handler)
-            # In debug mode, re-compile templates and reload static files on every
-            # request so you don't need to restart to see changes
-            if self.settings.get("debug"):
-                if getattr(RequestHandler, "_templates", None):
-                    try:
-                        map(lambda loader: loader.reset(),
-                            RequestHandler._templates.values())
-                    except AttributeError:
-                        # jinja2 & mako template  has already a autoreload func
-                        pass
-                RequestHandler._static_hashes = {}
-            handler._execute(transforms, *args, **kwargs)
+            if future is None:
+                result = self._apply_extensions(handler, trace)
+                if is_future(result):
+                    result.add_done_callback(functools.partial(
+                        self._execute_handler, handler, transforms, args,
+                        kwargs, trace))
+                    return handler
+                handler = result
+            else:
+                tracing.resume(trace)
+                if request.connection is not None and \
+                   request.connection.stream.closed():
+                    # the client went away while the extensions waited
+                    self._active_requests.discard(request)
+                    if trace is not None:
+                        self.tracer.finish(trace, handler)
+                    return handler
+                handler = future.result()
+            body_stream = getattr(request, 'body_stream', None)
+            if body_stream is not None:
+                if body_stream.handler is None:
+                    # the body is still coming, data_received() gets it and
+                    # the handler runs once it is complete
+                    body_stream.attach(handler, functools.partial(
+                        self._execute_handler, handler, transforms, args,
+                        kwargs, trace, resolved(handler)))
+                    return handler
+                body_stream.rethrow()
+            # In debug mode, drop the templates and static hashes whose files
+            # changed so you don't need to restart to see changes
+            if self.file_watcher is not None and self.file_watcher.due():
+                self._check_files()
+            with tracing.span('handler', 'handler', method=request.method,
+                              handler=handler.__class__.__name__):
+                handler._execute(transforms, *args, **kwargs)
         except HTTPErrorWrapper, e:
             if hasattr(handler, '_new_cookies'):
                 cookies = handler._new_cookies
@@ -123,6 +259,8 @@ class Application(TornadoApplication):
                 logging.debug('HTTPErrorWrapper with cookies. ')
                 logging.debug(cookies)
                 handler._new_cookies = cookies
+            # get() is called without _execute, which sets the transforms
+            handler._transforms = transforms
             handler.get()
         except HTTPError, e:
             if hasattr(handler, '_new_cookies'):
@@ -130,14 +268,17 @@ class Application(TornadoApplication):
             else:
                 cookies = None
 
-            tb = traceback.format_exc().splitlines()
+            tb = capture_traceback()
             handler = self.settings.get('error_page')(self, request,
                 e.status_code, e.log_message, tb)
+            handler.public_message = True
 
             if cookies:
                 logging.debug('HTTPError with cookies. ')
                 logging.debug(cookies)
                 handler._new_cookies = cookies
+            # get() is called without _execute, which sets the transforms
+            handler._transforms = transforms
             handler.get()
         except Exception, e:
             if hasattr(handler, '_new_cookies'):
@@ -145,7 +286,7 @@ class Application(TornadoApplication):
             else:
                 cookies = None
 
-            tb = traceback.format_exc().splitlines()
+            tb = capture_traceback()
             handler = self.settings.get('error_page')(self, request,
                 500, e.message, tb)
 
@@ -153,26 +294,336 @@ class Application(TornadoApplication):
                 logging.debug('Unknown exception with cookies. ')
                 logging.debug(cookies)
                 handler._new_cookies = cookies
+            # get() is called without _execute, which sets the transforms
+            handler._transforms = transforms
             handler.get()
-        logging.debug("Response headers: %s" % handler._headers)
+        logging.debug("Response headers: %s", handler._headers)
+        if trace is not None:
+            self.tracer.finish(trace, handler)
         return handler
 
+    def log_request(self, handler):
+        """Called by tornado when handler finished the request
+        """
+        request = handler.request
+        self._active_requests.discard(request)
+        if getattr(request, 'cache_refresh', None) is not None:
+            # run in the background by whirly.extensions.cache, nobody
+            # requested it
+            return
+        entry = getattr(request, 'page_cache_entry', None)
+        if entry is not None:
+            key, policy, capture = entry
+            self.page_cache.store_response(key, policy, handler, capture)
+        if self.metrics is not None:
+            self.metrics.observe_request(
+                getattr(request, 'route_pattern', '<unmatched>'),
+                request.method, handler.get_status(), request.request_time())
+        super(Application, self).log_request(handler)
+
+    @property
+    def executor(self):
+        """The default thread pool
+        """
+        return self.get_executor('default')
+
+    def get_executor(self, name='default'):
+        """Returns the thread pool called name, 'process' is the process pool
+
+        Pools are created on first use, so every forked worker gets its own
+        threads and processes.
+        """
+        pool = self._executors.get(name)
+        if pool is not None:
+            return pool
+        on_wait = None
+        if self.metrics is not None:
+            on_wait = functools.partial(self.metrics.observe_executor_wait,
+                                        name)
+        if name == 'process':
+            pool = ProcessPool(self.settings.get('process_pool'),
+                               name=name, on_wait=on_wait, inline=self._wsgi)
+        else:
+            config = self.settings.get('executors', {}).get(name, 10)
+            if not isinstance(config, dict):
+                config = {'threads': config}
+            pool = ThreadPool(config.get('threads', 10), name=name,
+                              max_queue=config.get('max_queue', 0),
+                              on_wait=on_wait, inline=self._wsgi)
+        self._executors[name] = pool
+        if self.metrics is not None:
+            self.metrics.executors[name] = pool
+        return pool
+
+    def body_policy(self, request):
+        """Returns (size limit, receiver) for the body of request
+
+        Called by whirly.httpserver.HTTPConnection once the headers are
+        read, a None receiver buffers the body the way tornado does.
+        """
+        handler_class = None
+        handlers = self._get_host_handlers(request)
+        if handlers:
+            spec, match = handlers.match(h.escape.url_unescape(request.path))
+            if spec is not None:
+                handler_class = spec.handler_class
+        limit = getattr(handler_class, 'max_body_size', None)
+        if limit is None:
+            limit = self.settings.get('max_body_size')
+
+        if getattr(handler_class, 'stream_request_body', False):
+            request.body_stream = BodyStream()
+            return limit, request.body_stream
+        if request.method in ("POST", "PUT"):
+            boundary = multipart_boundary(
+                request.headers.get("Content-Type", ""))
+            if boundary:
+                return limit, MultipartReceiver(request, boundary,
+                    self.settings.get('upload_spool_size', 1024 * 1024),
+                    self.settings.get('upload_tmp_dir'))
+        return limit, None
+
+    def connection_closed(self, handler):
+        """Called when the client of handler goes away, the request is not
+        waited for any more even if handler never finishes it
+        """
+        self._active_requests.discard(handler.request)
+        handler.on_connection_close()
+
+    def in_flight(self):
+        """Number of requests which are not finished yet
+        """
+        return len(self._active_requests)
+
+    def drain(self):
+        """Closes every connection after its current request
+
+        Called when the process stops accepting connections, keep-alive
+        connections would otherwise hold it up to the deadline.
+        """
+        self.draining = True
+        for request in self._active_requests:
+            if request.connection is not None:
+                request.connection.no_keep_alive = True
+
+    def add_handlers(self, host_pattern, host_handlers):
+        super(Application, self).add_handlers(host_pattern, host_handlers)
+        # rebuild the route index, routes are normally added once at startup
+        self._host_index = HostIndex(self.handlers)
+        if hasattr(self, 'extensions'):
+            self._resolve_extension_chains()
+
+    def _get_host_handlers(self, request):
+        """Returns the RouteIndex for the host of request
+        """
+        host = request.host.lower().split(':')[0]
+        routes = self._host_index.lookup(host)
+        # Look for default host if not behind load balancer (for debugging)
+        if routes is None and "X-Real-Ip" not in request.headers:
+            routes = self._host_index.lookup(self.default_host)
+        return routes
+
+    def _load_tracer(self):
+        sample_rate = self.settings.get('trace_sample_rate', 0)
+        if not sample_rate:
+            self.tracer = None
+            return
+        path = self.settings.get('trace_file', os.path.join(
+            whirly.project.project_directory(), 'data', 'trace', 'trace.json'))
+        self.tracer = tracing.Tracer(sample_rate,
+                                     tracing.ChromeTraceExporter(path))
+        logging.info("Tracing %s%% of requests into %s" % (
+            sample_rate * 100, path))
+
+    def _load_static_handler(self):
+        """Serves static_path with whirly.static.StaticFileHandler instead of
+        tornado's, which reads the whole file for every request
+        """
+        self.static_cache = StaticCache(
+            self.settings.get('static_cache_size', 32 * 1024 * 1024),
+            self.settings.get('static_cache_max_file', 1024 * 1024))
+        for host_pattern, specs in self.handlers:
+            for spec in specs:
+                if spec.handler_class is StaticFileHandler:
+                    spec.handler_class = WhirlyStaticFileHandler
+        static_path = self.settings['static_path']
+        # logical name -> fingerprinted name, see whirly.static
+        self.static_manifest = None
+        self.static_fingerprinted = frozenset()
+        if not self.settings.get('debug'):
+            self.static_manifest = load_manifest(self.settings.get(
+                'static_manifest', os.path.join(static_path, MANIFEST_NAME)))
+            if self.static_manifest is not None:
+                self.static_fingerprinted = frozenset(
+                    self.static_manifest.itervalues())
+        if self.settings.get('static_precompress',
+                             not self.settings.get('debug')) and \
+           os.path.isdir(static_path):
+            try:
+                written = precompress(static_path)
+            except (IOError, OSError), e:
+                logging.warning("Could not precompress the static files: %s",
+                                e)
+            else:
+                if written:
+                    logging.info("%d compressed static files written",
+                                 written)
+
+    def _load_compressor(self):
+        """Compresses the responses with whirly.compression instead of
+        tornado's GZipContentEncoding
+        """
+        self.compressor = None
+        if not self.settings.get('compress', self.settings.get('gzip')):
+            return
+        self.compressor = Compressor(
+            self.settings.get('compress_level', 6),
+            self.settings.get('compress_min_size', 256),
+            self.settings.get('compress_types', CONTENT_TYPES))
+        transforms = [t for t in self.transforms
+                      if t is not GZipContentEncoding]
+        # the body is compressed before it is framed
+        if ChunkedTransferEncoding in transforms:
+            position = transforms.index(ChunkedTransferEncoding)
+        else:
+            position = len(transforms)
+        transforms.insert(position, self.compressor.transform)
+        self.transforms = transforms
+
+    def _load_page_cache(self):
+        """Creates the page cache of whirly.pagecache, handlers opt in with
+        their page_cache attribute
+        """
+        self.page_cache = None
+        if self._wsgi:
+            # a hit is written straight to the connection
+            return
+        if self.settings.get('page_cache_store', 'memory') == 'cache':
+            from whirly.extensions.cache import WC
+            store = WC
+        else:
+            store = MemoryStore(self.settings.get('page_cache_size',
+                                                  16 * 1024 * 1024),
+                                sizeof=page_size)
+        private_cookies = self.settings.get('page_cache_private_cookies')
+        if private_cookies is None:
+            private_cookies = (self.settings.get('session_cookie_name',
+                                                 'session_id'),
+                               'flash_message')
+        encoding = None
+        if self.compressor is not None:
+            # pages are stored compressed, one per encoding
+            encoding = self.compressor.negotiate
+        self.page_cache = PageCache(store,
+                                    self.settings.get('page_cache_vary', ()),
+                                    private_cookies, encoding)
+        if self.metrics is not None:
+            self.metrics.page_cache = self.page_cache
+
     def _load_template_engine(self):
         self.template_engine = TemplateEngineDelegate()
+        self.template_engine.watcher = self.file_watcher
+
+    def _check_files(self):
+        hashes = getattr(RequestHandler, '_static_hashes', None)
+        if hashes:
+            for path in hashes.keys():
+                self.file_watcher.watch(path, self._static_file_changed)
+        for path in self.file_watcher.check():
+            logging.info("%s changed", path)
+
+    def _static_file_changed(self, path):
+        RequestHandler._static_hashes.pop(path, None)
 
     def _load_extensions(self, extensions):
         if extensions is None:
             self.extensions = []
         else:
             self.extensions = extensions
+        self._extension_chains = {}
+        self._resolve_extension_chains()
 
-    def _apply_extensions(self, handler):
-        """Apply extensions to given handler
+    def _resolve_extension_chains(self):
+        """Resolve the extension chain of every routed handler class
         """
+        for host_pattern, specs in self.handlers:
+            for spec in specs:
+                self._extension_chain(spec.handler_class)
+
+    def _extension_chain(self, handler_class):
+        """Returns the extensions to apply to handler_class, in order
+
+        The chain is resolved once per handler class from its `extensions`
+        attribute, the extensions they require are added and run first.
+        """
+        try:
+            return self._extension_chains[handler_class]
+        except KeyError:
+            pass
+
+        if issubclass(handler_class, (ErrorHandler, StaticFileHandler)):
+            chain = []
+        else:
+            names = getattr(handler_class, 'extensions', None)
+            if names is None:
+                names = [e.name for e in self.extensions]
+            chain = self._order_extensions(names, handler_class)
+        self._extension_chains[handler_class] = chain
+        return chain
+
+    def _order_extensions(self, names, handler_class):
+        by_name = {}
         for extension in self.extensions:
-            handler = extension(handler)
+            by_name.setdefault(extension.name, []).append(extension)
+
+        chain = []
+        visiting = set()
+
+        def visit(name):
+            if name not in by_name:
+                logging.error("Extension '%s' needed by %s is not "
+                              "configured" % (name, handler_class.__name__))
+                sys.exit(1)
+            if name in visiting:
+                logging.error("Circular extension requirement on '%s'" % name)
+                sys.exit(1)
+            visiting.add(name)
+            for extension in by_name[name]:
+                for required in extension.requires:
+                    visit(required)
+            visiting.discard(name)
+            for extension in by_name[name]:
+                if extension not in chain:
+                    chain.append(extension)
+
+        # keep the configured order where the requirements allow it
+        wanted = set(names)
+        for extension in self.extensions:
+            if extension.name in wanted:
+                visit(extension.name)
+        for name in names:
+            visit(name)
+        return chain
+
+    def _apply_extensions(self, handler, trace=None, start=0):
+        """Apply the extension chain of its class to given handler
+
+        Returns the handler, or a Future of it when an extension returned
+        one, the rest of the chain runs after it resolves.
+        """
+        chain = self._extension_chain(handler.__class__)
+        for index in xrange(start, len(chain)):
+            result = chain[index](handler)
+            if is_future(result):
+                return concurrent.chain(result, functools.partial(
+                    self._resume_extensions, trace=trace, start=index + 1))
+            handler = result
         return handler
 
+    def _resume_extensions(self, handler, trace, start):
+        tracing.resume(trace)
+        return self._apply_extensions(handler, trace, start)
+
     def _adjust_settings(self, settings):
         serve_type = settings.get('serve_type', 'tornado')
         if serve_type != 'wsgi':
@@ -186,11 +637,7 @@ class Application(TornadoApplication):
         if not settings.get('error_page'):
             settings['error_page'] = ErrorPage
 
-        project_path = whirly.project.project_directory()
-        project_name = whirly.project.project_name()
-        static_path = settings.get('static_path', os.path.join(project_path,
-            project_name, 'static'))
-        settings['static_path'] = static_path
+        settings.setdefault('static_path', whirly.project.static_directory())
 
         return settings
 
@@ -15,32 +15,210 @@
 # under the License.
 
 
+"""Serving the application with any WSGI server
+
+    application = WSGIApplication(handlers=routes, extensions=extensions,
+                                  **settings)
+
+The request is built from the environ as the handler asks for it: the
+headers, the arguments and the body are only parsed on first access. The
+response body is returned as the handler wrote it, chunk by chunk, or as
+the iterable the handler gave to wsgi_body:
+
+    class Export(BaseHandler):
+        def get(self):
+            self.set_header('Content-Type', 'text/csv')
+            self.wsgi_body = iter_rows()
+
+Handlers can not flush() or be asynchronous in WSGI mode.
+"""
+
+
+__all__ = ['WSGIApplication', 'WSGIRequest']
+
+
+import os
+import cgi
+import time
+import urllib
 import httplib
 import logging
 
-from tornado.wsgi import HTTPRequest, WSGIContainer
+from tornado import httputil
+from tornado.wsgi import HTTPRequest as TornadoWSGIRequest
 
 from whirly.web import Application
+from whirly.static import FileRange
+
+
+# "200 OK" for every status code, built once
+_STATUS_LINES = dict((code, "%d %s" % (code, reason))
+                     for code, reason in httplib.responses.iteritems())
+
+# environ keys which are headers without the HTTP_ prefix
+_CONTENT_HEADERS = (("CONTENT_TYPE", "Content-Type"),
+                    ("CONTENT_LENGTH", "Content-Length"))
+
+
+class WSGIRequest(object):
+    """Mimics httpserver.HTTPRequest, from a WSGI environ
+
+    Unlike tornado.wsgi.HTTPRequest nothing is parsed or read up front.
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ["REQUEST_METHOD"]
+        self.path = urllib.quote(environ.get("SCRIPT_NAME", "") +
+                                 environ.get("PATH_INFO", ""))
+        self.query = environ.get("QUERY_STRING", "")
+        if self.query:
+            self.uri = self.path + "?" + self.query
+        else:
+            self.uri = self.path
+        self.version = environ.get("SERVER_PROTOCOL", "HTTP/1.0")
+        self.protocol = environ["wsgi.url_scheme"]
+        self.remote_ip = environ.get("REMOTE_ADDR", "")
+        self.host = environ.get("HTTP_HOST") or environ["SERVER_NAME"]
+        self._headers = None
+        self._arguments = None
+        self._body = None
+        self._files = None
+        self._start_time = time.time()
+        self._finish_time = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            headers = httputil.HTTPHeaders()
+            environ = self.environ
+            for key, name in _CONTENT_HEADERS:
+                if environ.get(key):
+                    headers[name] = environ[key]
+            for key in environ:
+                if key.startswith("HTTP_"):
+                    headers[key[5:].replace("_", "-")] = environ[key]
+            self._headers = headers
+        return self._headers
+
+    @property
+    def body(self):
+        if self._body is None:
+            try:
+                length = int(self.environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                length = 0
+            if length > 0:
+                self._body = self.environ["wsgi.input"].read(length)
+            else:
+                self._body = ""
+        return self._body
+
+    @property
+    def arguments(self):
+        if self._arguments is None:
+            self._parse_arguments()
+        return self._arguments
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._parse_arguments()
+        return self._files
+
+    def _parse_arguments(self):
+        self._arguments = {}
+        self._files = {}
+        if self.query:
+            for name, values in cgi.parse_qs(self.query).iteritems():
+                values = [v for v in values if v]
+                if values:
+                    self._arguments[name] = values
+        if self.method not in ("POST", "PUT"):
+            return
+        content_type = self.environ.get("CONTENT_TYPE", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            for name, values in cgi.parse_qs(self.body).iteritems():
+                self._arguments.setdefault(name, []).extend(values)
+        elif content_type.startswith("multipart/form-data"):
+            if 'boundary=' in content_type:
+                boundary = content_type.split('boundary=', 1)[1]
+                if boundary:
+                    self._parse_mime_body(boundary)
+            else:
+                logging.warning("Invalid multipart/form-data")
+
+    def _parse_mime_body(self, boundary):
+        # fills self.arguments and self.files the way tornado does
+        TornadoWSGIRequest._parse_mime_body.im_func(self, boundary)
+
+    def supports_http_1_1(self):
+        return self.version == "HTTP/1.1"
+
+    def full_url(self):
+        return self.protocol + "://" + self.host + self.uri
+
+    def request_time(self):
+        if self._finish_time is None:
+            return time.time() - self._start_time
+        return self._finish_time - self._start_time
+
+    def __repr__(self):
+        attrs = ("protocol", "host", "method", "uri", "version", "remote_ip")
+        args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
+        return "%s(%s, headers=%s)" % (
+            self.__class__.__name__, args, dict(self.headers))
 
 
 class WSGIApplication(Application):
     def __init__(self, handlers=None, default_host="", extensions=None,
                  **settings):
+        settings.setdefault('serve_type', 'wsgi')
         super(WSGIApplication, self).__init__(handlers, default_host,
             [], extensions, wsgi=True, **settings)
 
     def __call__(self, environ, start_response):
-        handler = Application.__call__(self, HTTPRequest(environ))
-        status = "%s %s" % (str(handler._status_code),
-                            httplib.responses[handler._status_code])
-        headers = handler._headers.items()
-        for cookie_dict in getattr(handler, "_new_cookies", []):
+        request = WSGIRequest(environ)
+        handler = Application.__call__(self, request)
+        request._finish_time = time.time()
+        self.log_request(handler)
+
+        headers = handler._headers
+        body = getattr(handler, 'wsgi_body', None)
+        if body is None:
+            body = handler._write_buffer
+            if handler._transforms:
+                # the compression, tornado only applies them in flush()
+                chunk = "".join(body)
+                for transform in handler._transforms:
+                    headers, chunk = transform.transform_first_chunk(
+                        headers, chunk, True)
+                body = [chunk]
+        elif isinstance(body, FileRange):
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None and body.start == 0 and \
+               body.end == _file_size(body.file):
+                # the server may send it with sendfile
+                body = file_wrapper(body.file, body.chunk_size)
+        if request.method == "HEAD" or handler._status_code == 304:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+            body = []
+
+        status = _STATUS_LINES.get(handler._status_code)
+        if status is None:
+            status = "%d Unknown" % handler._status_code
+        headers = [(name, str(value)) for name, value in headers.iteritems()]
+        for cookie_dict in getattr(handler, "_new_cookies", ()):
             for cookie in cookie_dict.values():
                 headers.append(("Set-Cookie", cookie.OutputString(None)))
         start_response(status, headers)
-        return handler._write_buffer
+        return body
+
+
+def _file_size(f):
+    return os.fstat(f.fileno()).st_size
 
 
 ### EOF ###
 # vim:smarttab:sts=4:sw=4:et:ai:tw=80:
-